@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+from src.dupimage.Benchmark import VARIANTS
+from src.dupimage.Benchmark import generate_corpus
+from src.dupimage.Benchmark import run_benchmark
+from src.dupimage.Clustering import CLUSTERINGS
+from src.dupimage.Clustering import CLUSTERING_GREEDY
+from src.dupimage.Hashing import DEFAULT_ALGORITHM
+from src.dupimage.Hashing import INDEXABLE_ALGORITHMS
+from src.dupimage.Matcher import ENGINES
+from src.dupimage.Matcher import ENGINE_THREAD
+from src.dupimage.Search import INDEXES
+from src.dupimage.Search import INDEX_POPCOUNT
+from src.dupimage.Store import BACKENDS
+from src.dupimage.Store import BACKEND_SQLITE
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+parser = argparse.ArgumentParser(description="Benchmark the stages of a run on a synthetic corpus")
+parser.add_argument("--images", type=int, default=1000, help="Number of distinct base images of the corpus")
+parser.add_argument("--variants", nargs="*", choices=VARIANTS, default=list(VARIANTS),
+                    help="Near duplicates generated for each base image")
+parser.add_argument("--size", type=int, default=256, help="Side of the base images in pixels")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus")
+parser.add_argument("--corpus", type=str, default=None,
+                    help="Folder of the corpus, generated if it does not exist and kept (default: temporary)")
+parser.add_argument("--threshold", type=float, default=0.1, help="Similarity threshold")
+parser.add_argument("--engine", choices=ENGINES, default=ENGINE_THREAD, help="Hashing engine")
+parser.add_argument("--workers", type=int, default=None, help="Number of hashing workers (default: number of CPUs)")
+parser.add_argument("--store", choices=BACKENDS, default=BACKEND_SQLITE, help="Backend of the hashes")
+parser.add_argument("--index", choices=INDEXES, default=INDEX_POPCOUNT, help="Search index")
+parser.add_argument("--clustering", choices=CLUSTERINGS, default=CLUSTERING_GREEDY, help="Grouping of the duplicates")
+parser.add_argument("--hash", dest="algorithm", choices=INDEXABLE_ALGORITHMS, default=DEFAULT_ALGORITHM,
+                    help="Hashing algorithm")
+parser.add_argument("--fast-decode", dest="decode_size", type=int, default=None, metavar="SIZE",
+                    help="Decode the images at a reduced size (at least SIZE pixels) before hashing")
+parser.add_argument("--sample", type=int, default=1000,
+                    help="Number of images decoded, hashed and queried one at a time to measure the latencies")
+parser.add_argument("--move", action="store_true",
+                    help="Also measure the moves of the duplicates (requires a temporary corpus)")
+parser.add_argument("--output", type=str, default=None, help="JSON file of the results (default: stdout)")
+
+
+def main():
+    args = parser.parse_args()
+    if args.move and args.corpus is not None:
+        parser.error("--move would change the --corpus folder")
+    work_folder = tempfile.mkdtemp(prefix="dupimage-benchmark-")
+    try:
+        corpus = os.path.join(work_folder, "corpus") if args.corpus is None else args.corpus
+        if not os.path.exists(corpus):
+            n_files = generate_corpus(corpus, args.images, size=args.size, variants=args.variants, seed=args.seed)
+            print("# Generated %d images" % n_files, file=sys.stderr)
+        results = run_benchmark(corpus, work_folder, threshold=args.threshold, engine=args.engine,
+                                workers=args.workers, backend=args.store, index_backend=args.index,
+                                clustering=args.clustering, algorithm=args.algorithm, decode_size=args.decode_size,
+                                sample=args.sample, move=args.move)
+    finally:
+        shutil.rmtree(work_folder)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as hand:
+            json.dump(results, hand, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,56 @@
 #!/usr/bin/env python3
 
 from src.dupimage.Matcher import find_similar
+from src.dupimage.Matcher import find_exact
+from src.dupimage.Matcher import ENGINES
+from src.dupimage.Matcher import ENGINE_THREAD
+from src.dupimage.Metrics import Metrics
+from src.dupimage.Metrics import MetricsFile
+from src.dupimage.Metrics import Progress
+from src.dupimage.Metrics import REPORT_INTERVAL
+from src.dupimage.Metrics import profile
+from src.dupimage.Mover import MOVE_WORKERS
+from src.dupimage.Output import FORMATS as OUTPUT_FORMATS
+from src.dupimage.Output import STDOUT
+from src.dupimage.Output import open_sink
+from src.dupimage.Store import BACKENDS
+from src.dupimage.Store import BACKEND_SQLITE
+from src.dupimage.Store import CHECKPOINT_FILES
+from src.dupimage.Store import CHECKPOINT_SECONDS
+from src.dupimage.Store import DIGESTS_FILE_NAME
+from src.dupimage.Store import prepare_hash_store
+from src.dupimage.Store import prepare_false_positives_store
+from src.dupimage.Store import search_index_path
+from src.dupimage.Ranking import DEFAULT_RANKING
+from src.dupimage.Ranking import parse_ranking
+from src.dupimage.Search import INDEXES
+from src.dupimage.Search import INDEX_POPCOUNT
+from src.dupimage.Clustering import CLUSTERINGS
+from src.dupimage.Clustering import CLUSTERING_GREEDY
+from src.dupimage.Common import PERSISTENCE_FOLDER_NAME
+from src.dupimage.Scanner import FILTERS
+from src.dupimage.Scanner import FILTER_NONE
+from src.dupimage.Scanner import scan_paths
+from src.dupimage.Hashing import ALGORITHMS
+from src.dupimage.Hashing import DEFAULT_ALGORITHM
+from src.dupimage.Hashing import algorithm_tag
+from src.dupimage.Hashing import INDEXABLE_ALGORITHMS
+from src.dupimage.Hashing import validate_fast_decode
+from src.dupimage.Sharding import SHARD_BY_PATH
+from src.dupimage.Sharding import SHARD_STRATEGIES
+from src.dupimage.Sharding import find_shard_stores
+from src.dupimage.Sharding import hash_shard
+from src.dupimage.Sharding import merge_stores
+from src.dupimage.Watcher import POLL_INTERVAL
+from src.dupimage.Watcher import watch
 import argparse
 import os
+import sys
 
 
+# Decode size checked by --validate-fast-decode if --fast-decode is not given
+DEFAULT_DECODE_SIZE = 256
+
 parser = argparse.ArgumentParser(description="Find duplicate images")
 parser.add_argument("folder", help="Folder to look in")
 parser.add_argument("--recursive", action="store_true", default=True,
@@ -12,30 +58,197 @@ parser.add_argument("--recursive", action="store_true", default=True,
 parser.add_argument("--threshold", type=float, default=0.1, help="Similarity threshold")
 parser.add_argument("--move-duplicates", dest="duplicates_folder", type=str, default=None,
                     help="Folder to move duplicates to")
+parser.add_argument("--move-workers", type=int, default=MOVE_WORKERS,
+                    help="Number of groups of duplicates moved in parallel")
 parser.add_argument("--persist", action="store_true", help="Persist the image hashses and false duplicates")
+parser.add_argument("--engine", choices=ENGINES, default=ENGINE_THREAD,
+                    help="Hashing engine: threads or worker processes")
+parser.add_argument("--workers", type=int, default=None,
+                    help="Number of hashing workers (default: number of CPUs)")
+parser.add_argument("--store", choices=BACKENDS, default=BACKEND_SQLITE,
+                    help="Backend of the persisted hashes, an existing shelve db is migrated automatically")
+parser.add_argument("--index", choices=INDEXES, default=INDEX_POPCOUNT,
+                    help="Search index used to find similar hashes")
+parser.add_argument("--clustering", choices=CLUSTERINGS, default=CLUSTERING_GREEDY,
+                    help="Group duplicates greedily or by connected components (deterministic)")
+parser.add_argument("--fast-decode", dest="decode_size", type=int, default=None, metavar="SIZE",
+                    help="Decode the JPEG images at a reduced size (at least SIZE pixels) before hashing, "
+                         "the other formats are reduced after a full decode")
+parser.add_argument("--validate-fast-decode", action="store_true",
+                    help="Report how often the --fast-decode hashes differ from the full decode ones and exit")
+parser.add_argument("--hash", dest="algorithm", choices=INDEXABLE_ALGORITHMS, default=DEFAULT_ALGORITHM,
+                    help="Hashing algorithm used to find the candidate duplicates")
+parser.add_argument("--confirm-hash", dest="confirm_algorithm", choices=list(ALGORITHMS), default=None,
+                    help="Second hashing algorithm the candidate duplicates must match")
+parser.add_argument("--confirm-threshold", type=float, default=0.1,
+                    help="Similarity threshold of --confirm-hash")
+parser.add_argument("--filter", dest="file_filter", choices=FILTERS, default=FILTER_NONE,
+                    help="Try to open every file (default), or select the image files by extension or by magic number")
+parser.add_argument("--exact-prepass", action="store_true",
+                    help="Find the byte-identical files first and hash each distinct content only once")
+parser.add_argument("--exact-only", action="store_true",
+                    help="Only find the byte-identical files, without hashing the images")
+parser.add_argument("--incremental", action="store_true",
+                    help="With --persist, keep the search index in the persistence folder and only look "
+                         "for the duplicates of the new or changed images")
+parser.add_argument("--watch", action="store_true",
+                    help="Keep running, watch the folder and look for the duplicates of the new images as they arrive")
+parser.add_argument("--socket", dest="socket_path", type=str, default=None,
+                    help="With --watch, path of a Unix socket answering the duplicates queries")
+parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                    help="With --watch, seconds between two scans when watchdog is not installed")
+parser.add_argument("--shard", type=str, default=None, metavar="K/N",
+                    help="With --persist, only hash the shard K of N (0 <= K < N) in its own hash store and exit")
+parser.add_argument("--shard-by", choices=SHARD_STRATEGIES, default=SHARD_BY_PATH,
+                    help="Split the shards by file path or by top level subfolder")
+parser.add_argument("--merge-shards", type=int, nargs="?", const=0, default=None, metavar="N",
+                    help="With --persist, merge the hash stores of the N shards before looking for duplicates "
+                         "(N is required if the stores of runs with different numbers of shards are found)")
+parser.add_argument("--checkpoint-files", type=int, default=CHECKPOINT_FILES,
+                    help="Save the persisted hashes every N hashed images, an interrupted run is resumed "
+                         "from the last checkpoint")
+parser.add_argument("--checkpoint-interval", type=float, default=CHECKPOINT_SECONDS,
+                    help="Save the persisted hashes every T seconds")
+parser.add_argument("--rank", dest="ranking", type=str, default=",".join(DEFAULT_RANKING),
+                    help="Comma separated keys choosing the image kept in each group: pixels, size, format, "
+                         "bit_depth, exif, mtime; prefix a key with - to prefer the lowest value (e.g. -mtime)")
+parser.add_argument("--output", dest="output_path", type=str, default=None,
+                    help="Write each group of duplicates to a file as soon as it is found, - for stdout")
+parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default=None,
+                    help="Format of --output, csv for the .csv files and jsonl otherwise")
+parser.add_argument("--progress", action="store_true",
+                    help="Print the progress of the hashing with its rate and ETA")
+parser.add_argument("--metrics", dest="metrics_path", type=str, default=None,
+                    help="Write the counters and the stage timers to a file: a JSON line per report, "
+                         "or the Prometheus text format if the file name ends with .prom")
+parser.add_argument("--metrics-interval", type=float, default=REPORT_INTERVAL,
+                    help="Seconds between two reports of --progress and --metrics")
+parser.add_argument("--profile", dest="profile_path", type=str, default=None,
+                    help="Profile the run with cProfile and save the statistics to a file")
+
+
+def _parse_shard(shard):
+    try:
+        shard, n_shards = (int(value) for value in shard.split("/"))
+    except ValueError:
+        parser.error("--shard must be K/N")
+    if not 0 <= shard < n_shards:
+        parser.error("--shard K/N requires 0 <= K < N")
+    return shard, n_shards
+
+
+def main():
+    args = parser.parse_args()
+    folder = args.folder
+    recursive = args.recursive
+    threshold = args.threshold
+    duplicates_folder = args.duplicates_folder
+    persistence = args.persist
+
+    if args.validate_fast_decode:
+        iterator = scan_paths(folder, recursive=recursive, file_filter=args.file_filter)
+        validate_fast_decode(iterator, args.decode_size or DEFAULT_DECODE_SIZE, threshold=threshold)
+        return
+
+    db_path = None
+    false_positives_db_path = None
+    index_path = None
+    digests_db_path = None
+    if persistence:
+        persistence_folder = os.path.join(folder, PERSISTENCE_FOLDER_NAME)
+        if not os.path.exists(persistence_folder):
+            os.mkdir(persistence_folder)
+        db_path = prepare_hash_store(persistence_folder, args.store)
+        false_positives_db_path = prepare_false_positives_store(persistence_folder)
+        digests_db_path = os.path.join(persistence_folder, DIGESTS_FILE_NAME)
+        if args.incremental or args.watch:
+            index_path = search_index_path(persistence_folder, algorithm_tag(args.decode_size, args.algorithm))
+
+    if args.shard is not None or args.merge_shards is not None:
+        if not persistence:
+            parser.error("--shard and --merge-shards require --persist")
+    try:
+        args.ranking = parse_ranking(args.ranking)
+    except ValueError as e:
+        parser.error(str(e))
+
+    reporters = []
+    if args.progress:
+        # Keep the standard output for the groups when they are written to it
+        reporters.append(Progress(sys.stderr if args.output_path == STDOUT else None))
+    if args.metrics_path is not None:
+        reporters.append(MetricsFile(args.metrics_path))
+    metrics = Metrics(reporters, interval=args.metrics_interval)
+
+    if args.shard is not None:
+        shard, n_shards = _parse_shard(args.shard)
+        shard_path, n_images = hash_shard(folder, persistence_folder, shard, n_shards, strategy=args.shard_by,
+                                          backend=args.store, recursive=recursive, engine=args.engine,
+                                          workers=args.workers, decode_size=args.decode_size,
+                                          algorithms=[name for name in (args.algorithm, args.confirm_algorithm)
+                                                      if name is not None],
+                                          file_filter=args.file_filter,
+                                          exclude_paths=() if duplicates_folder is None else (duplicates_folder,),
+                                          checkpoint_files=args.checkpoint_files,
+                                          checkpoint_interval=args.checkpoint_interval, metrics=metrics)
+        metrics.tick(force=True)
+        print("# Shard %d/%d: %d images in %s" % (shard, n_shards, n_images, shard_path))
+        return
+    if args.merge_shards is not None:
+        try:
+            shard_paths = find_shard_stores(persistence_folder, args.store, n_shards=args.merge_shards or None)
+        except ValueError as e:
+            parser.error(str(e))
+        merged = merge_stores(shard_paths, db_path, backend=args.store)
+        print("# Merged %d entries from %d shards" % (merged, len(shard_paths)))
+
+    # The groups written to stdout replace the text output
+    print_result = duplicates_folder is None and args.output_path != STDOUT
+
+    if duplicates_folder is not None:
+        if not os.path.exists(duplicates_folder):
+            os.makedirs(duplicates_folder)
+
+    if args.watch:
+        watch(folder, db_path, index_path, threshold=threshold, duplicates_folder=duplicates_folder,
+              false_positives_db_path=false_positives_db_path, recursive=recursive, file_filter=args.file_filter,
+              decode_size=args.decode_size, algorithm=args.algorithm, socket_path=args.socket_path,
+              workers=args.workers, poll_interval=args.poll_interval, move_workers=args.move_workers,
+              ranking=args.ranking)
+        return
+
+    if args.output_path is None:
+        _find_duplicates(args, None, folder, recursive, threshold, db_path, false_positives_db_path, print_result,
+                         duplicates_folder, index_path, digests_db_path, metrics)
+    else:
+        with open_sink(args.output_path, args.output_format) as sink:
+            _find_duplicates(args, sink, folder, recursive, threshold, db_path, false_positives_db_path,
+                             print_result, duplicates_folder, index_path, digests_db_path, metrics)
+
+
+def _find_duplicates(args, sink, folder, recursive, threshold, db_path, false_positives_db_path, print_result,
+                     duplicates_folder, index_path, digests_db_path, metrics):
+    # The groups are printed or written to the sink, there is no need to keep them
+    if args.exact_only:
+        find_exact(folder, recursive=recursive, false_positives_db_path=false_positives_db_path,
+                   print_result=print_result, duplicates_folder=duplicates_folder, file_filter=args.file_filter,
+                   move_workers=args.move_workers, sink=sink, keep_result=False, quiet=args.output_path == STDOUT,
+                   ranking=args.ranking, digests_db_path=digests_db_path)
+        return
+
+    with profile(args.profile_path):
+        find_similar(folder, recursive=recursive, threshold=threshold, db_path=db_path,
+                     false_positives_db_path=false_positives_db_path, print_result=print_result,
+                     duplicates_folder=duplicates_folder, engine=args.engine, workers=args.workers,
+                     db_backend=args.store, index_backend=args.index,
+                     clustering=args.clustering, decode_size=args.decode_size, algorithm=args.algorithm,
+                     confirm_algorithm=args.confirm_algorithm, confirm_threshold=args.confirm_threshold,
+                     file_filter=args.file_filter, exact_prepass=args.exact_prepass, move_workers=args.move_workers,
+                     index_path=index_path, incremental=args.incremental, checkpoint_files=args.checkpoint_files,
+                     checkpoint_interval=args.checkpoint_interval, metrics=metrics, sink=sink, keep_result=False,
+                     quiet=args.output_path == STDOUT, ranking=args.ranking, digests_db_path=digests_db_path)
+
 
-args = parser.parse_args()
-folder = args.folder
-recursive = args.recursive
-threshold = args.threshold
-duplicates_folder = args.duplicates_folder
-persistence = args.persist
-
-db_path = None
-false_positives_db_path = None
-if persistence:
-    persistence_folder = os.path.join(folder, ".duplicate-image-finder")
-    if not os.path.exists(persistence_folder):
-        os.mkdir(persistence_folder)
-    db_path = os.path.join(persistence_folder, "hashes.db")
-    false_positives_db_path = os.path.join(persistence_folder, "false-positives.db")
-
-print_result = duplicates_folder is None
-
-if duplicates_folder is not None:
-    if not os.path.exists(duplicates_folder):
-        os.makedirs(duplicates_folder)
-
-find_similar(folder, recursive=recursive, threshold=threshold, db_path=db_path,
-             false_positives_db_path=false_positives_db_path, print_result=print_result,
-             duplicates_folder=duplicates_folder)
+if __name__ == "__main__":
+    # The guard is required by the process engine on platforms using spawn
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import os
+import platform
+import subprocess
+import sys
+import time
+import concurrent.futures
+import numpy as np
+from PIL import Image
+from PIL import ImageEnhance
+
+from .Clustering import CLUSTERING_GREEDY
+from .Clustering import find_groups
+from .Hashing import DEFAULT_ALGORITHM
+from .Hashing import compute_hashes
+from .Matcher import ENGINE_THREAD
+from .Matcher import _build_graph
+from .Matcher import _build_tree
+from .Matcher import _get_all_hashes
+from .Matcher import _plan_moves
+from .Matcher import index_folder
+from .Mover import apply_plan
+from .Scanner import FILTER_EXTENSION
+from .Scanner import scan
+from .Search import INDEX_POPCOUNT
+from .Search import hex_to_packed
+from .Search import threshold_to_distance
+from .Store import BACKEND_FILE_NAMES
+from .Store import BACKEND_SQLITE
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Version of the format of the results, bumped when the fields change
+RESULTS_VERSION = 1
+
+VARIANT_RESIZED = "resized"
+VARIANT_RECOMPRESSED = "recompressed"
+VARIANT_CROPPED = "cropped"
+VARIANT_COLOUR_SHIFTED = "colour_shifted"
+VARIANTS = (VARIANT_RESIZED, VARIANT_RECOMPRESSED, VARIANT_CROPPED, VARIANT_COLOUR_SHIFTED)
+
+# Number of images of a subfolder of the corpus
+CORPUS_FOLDER_SIZE = 1000
+# Number of base images generated by a worker task
+CORPUS_CHUNK_SIZE = 64
+# Side of the random grid the base images are interpolated from
+_PATTERN_SIZE = 8
+
+
+def _base_image(rng, size):
+    """
+    :param rng: numpy random Generator
+    :param size: side of the image in pixels
+    :return: RGB image of a smooth random pattern, the patterns of different seeds hash apart
+    """
+    grid = rng.integers(0, 256, size=(_PATTERN_SIZE, _PATTERN_SIZE, 3), dtype=np.uint8)
+    image = Image.fromarray(grid, "RGB").resize((size, size), Image.BICUBIC)
+    # Some noise, so the files do not compress to nothing
+    noise = rng.integers(-8, 9, size=(size, size, 3))
+    return Image.fromarray(np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8), "RGB")
+
+
+def _save_variant(image, variant, path):
+    """
+    Save a near duplicate of an image.
+
+    :param image: base image
+    :param variant: one of VARIANTS
+    :param path: path without extension
+    :return:
+    """
+    width, height = image.size
+    if variant == VARIANT_RESIZED:
+        image.resize((width // 2, height // 2), Image.LANCZOS).save(path + ".png")
+    elif variant == VARIANT_RECOMPRESSED:
+        image.save(path + ".jpg", quality=40)
+    elif variant == VARIANT_CROPPED:
+        border = width // 20
+        image.crop((border, border, width - border, height - border)).save(path + ".png")
+    elif variant == VARIANT_COLOUR_SHIFTED:
+        ImageEnhance.Color(ImageEnhance.Brightness(image).enhance(1.1)).enhance(0.8).save(path + ".jpg", quality=90)
+    else:
+        raise ValueError("Unknown variant %s" % variant)
+
+
+def _generate_chunk(folder, start, stop, size, variants, seed):
+    for i in range(start, stop):
+        subfolder = os.path.join(folder, "%04d" % (i // CORPUS_FOLDER_SIZE))
+        os.makedirs(subfolder, exist_ok=True)
+        image = _base_image(np.random.default_rng((seed, i)), size)
+        path = os.path.join(subfolder, "%07d" % i)
+        image.save(path + "_base.png")
+        for variant in variants:
+            _save_variant(image, variant, "%s_%s" % (path, variant))
+    return stop - start
+
+
+def generate_corpus(folder, n_images, size=256, variants=VARIANTS, seed=0, workers=None):
+    """
+    Generate a synthetic corpus: n_images distinct base images, each one with a near
+    duplicate for every variant. The images are spread in subfolders of CORPUS_FOLDER_SIZE
+    base images, so a corpus of millions of files does not end up in a single folder.
+    The same seed always generates the same corpus.
+
+    :param folder: destination folder
+    :param n_images: number of base images
+    :param size: side of the base images in pixels
+    :param variants: list of VARIANTS
+    :param seed:
+    :param workers: number of processes generating the images, defaults to the number of CPUs
+    :return: number of generated files
+    """
+    os.makedirs(folder, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_generate_chunk, folder, start, min(start + CORPUS_CHUNK_SIZE, n_images),
+                                   size, tuple(variants), seed)
+                   for start in range(0, n_images, CORPUS_CHUNK_SIZE)]
+        generated = sum(future.result() for future in futures)
+    return generated * (len(variants) + 1)
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of the process so far in MiB, None if it cannot be read
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _latency_summary(latencies):
+    """
+    :param latencies: list of seconds
+    :return: map with the mean and the percentiles in milliseconds
+    """
+    if len(latencies) == 0:
+        return None
+    milliseconds = np.array(latencies) * 1000
+    return {'mean_ms': float(np.mean(milliseconds)),
+            'p50_ms': float(np.percentile(milliseconds, 50)),
+            'p95_ms': float(np.percentile(milliseconds, 95)),
+            'p99_ms': float(np.percentile(milliseconds, 99))}
+
+
+class _Stage:
+    """
+    Measure a stage of the benchmark, use as a context manager.
+    The peak RSS is the one of the whole process at the end of the stage,
+    so the stages are run from the lightest to the heaviest.
+    """
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.items = 0
+        self.latencies = []
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def timed(self, function, *args):
+        """
+        Call a function and record its latency as one item of the stage.
+
+        :return: the result of the function
+        """
+        start = time.perf_counter()
+        value = function(*args)
+        self.latencies.append(time.perf_counter() - start)
+        self.items += 1
+        return value
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        seconds = time.perf_counter() - self.start
+        self.results[self.name] = {
+            'seconds': seconds,
+            'items': self.items,
+            'throughput': self.items / seconds if seconds > 0 else None,
+            'latency': _latency_summary(self.latencies),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+
+def _decode(path):
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(folder, work_folder, threshold=0.1, engine=ENGINE_THREAD, workers=None, backend=BACKEND_SQLITE,
+                  index_backend=INDEX_POPCOUNT, clustering=CLUSTERING_GREEDY, algorithm=DEFAULT_ALGORITHM,
+                  decode_size=None, sample=1000, move=False):
+    """
+    Measure the stages of a run on a corpus: scan, decode, hash (on a sample of images),
+    the hashing pipeline, db load, index build, neighbour queries, grouping and, optionally, the moves.
+
+    :param folder: corpus, see generate_corpus
+    :param work_folder: folder for the hash store and the duplicates
+    :param threshold: threshold under which images are considered duplicates
+    :param engine: hashing engine, one of Matcher.ENGINES
+    :param workers: number of hashing workers, defaults to the number of CPUs
+    :param backend: hash store backend, one of Store.BACKENDS
+    :param index_backend: search index, one of Search.INDEXES
+    :param clustering: one of Clustering.CLUSTERINGS
+    :param algorithm: hashing algorithm, one of Hashing.INDEXABLE_ALGORITHMS
+    :param decode_size: decode the images at a reduced size, at least decode_size pixels
+    :param sample: number of images decoded, hashed and queried one at a time to measure the latencies
+    :param move: True to move the duplicates out of the corpus in the work folder
+    :return: JSON serialisable map with the parameters, the environment and the measures of each stage
+    """
+    stages = dict()
+    db_path = os.path.join(work_folder, BACKEND_FILE_NAMES[backend])
+    with _Stage(stages, "scan") as stage:
+        entries = list(scan(folder, file_filter=FILTER_EXTENSION))
+        stage.items = len(entries)
+    sample_paths = [entry.path for entry in entries[::max(1, len(entries) // sample)][:sample]]
+    with _Stage(stages, "decode") as stage:
+        images = [stage.timed(_decode, path) for path in sample_paths]
+    with _Stage(stages, "hash") as stage:
+        for image in images:
+            stage.timed(compute_hashes, image, [algorithm], decode_size)
+    del images
+    with _Stage(stages, "hash_pipeline") as stage:
+        stage.items = index_folder(folder, db_path, db_backend=backend, decode_size=decode_size,
+                                   algorithms=(algorithm,), engine=engine, workers=workers, entries=entries)
+    with _Stage(stages, "db_load") as stage:
+        files_by_hash, hash_strs, n_bits, _, metadata = _get_all_hashes(
+            folder, db_path, db_flag='r', db_backend=backend, decode_size=decode_size, algorithm=algorithm,
+            entries=entries)
+        stage.items = sum(len(files) for files in files_by_hash)
+    with _Stage(stages, "build_tree") as stage:
+        packed = hex_to_packed(hash_strs, n_bits)
+        tree = _build_tree(packed, n_bits, index_backend=index_backend)
+        stage.items = len(tree)
+    with _Stage(stages, "query") as stage:
+        max_distance = threshold_to_distance(threshold, n_bits)
+        for hash_id in range(0, len(packed), max(1, len(packed) // sample)):
+            stage.timed(tree.query_radius, packed[hash_id:hash_id + 1], max_distance)
+    with _Stage(stages, "neighbours") as stage:
+        graph = _build_graph(tree, threshold)
+        stage.items = len(tree)
+    with _Stage(stages, "grouping") as stage:
+        groups = list(find_groups(graph, files_by_hash, dict(), clustering=clustering))
+        stage.items = len(groups)
+    if move:
+        with _Stage(stages, "move") as stage:
+            duplicates_folder = os.path.join(work_folder, "duplicates")
+            plan = _plan_moves(duplicates_folder, groups, metadata)
+            apply_plan(duplicates_folder, plan, metadata, workers=workers or os.cpu_count())
+            stage.items = sum(len(group.duplicates) for group in plan)
+    return {
+        'version': RESULTS_VERSION,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {'files': len(entries), 'threshold': threshold, 'engine': engine, 'workers': workers,
+                       'backend': backend, 'index': index_backend, 'clustering': clustering,
+                       'algorithm': algorithm, 'decode_size': decode_size, 'sample': sample},
+        'groups': len(groups),
+        'duplicates': sum(len(duplicates) for _, duplicates in groups),
+        'stages': stages,
+    }
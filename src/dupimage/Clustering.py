@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+CLUSTERING_GREEDY = "greedy"
+CLUSTERING_COMPONENTS = "components"
+CLUSTERINGS = (CLUSTERING_GREEDY, CLUSTERING_COMPONENTS)
+
+
+def neighbours(graph, hash_id):
+    """
+    :param graph: CSR adjacency matrix of the hashes
+    :param hash_id:
+    :return: array with the ids of the hashes close to hash_id
+    """
+    return graph.indices[graph.indptr[hash_id]:graph.indptr[hash_id + 1]]
+
+
+def greedy_groups(graph, files_by_hash, false_positives):
+    """
+    Group the duplicates greedily.
+    The hashes are visited in order and the first file of each hash is the anchor
+    of a group with all the files of the neighbouring hashes. Files already
+    grouped are not used as anchors, but can be part of more than one group.
+
+    :param graph: CSR adjacency matrix of the hashes
+    :param files_by_hash: list with the files of each hash, indexed by hash id
+    :param false_positives: map from path to the set of its false positives
+    :return: iterator of 2-ples (anchor, sorted list of duplicates)
+    """
+    marked_duplicates = set()  # Paths already marked as duplicates
+    for hash_id, files in enumerate(files_by_hash):
+        path = files[0]
+        if path in marked_duplicates:
+            # Path already marked as duplicate,
+            # do not look for duplicates of duplicates
+            continue
+        # Get the false positives from this path
+        path_false_positives = false_positives.get(path, ())
+        all_duplicates = []
+        # Add the files with the same hash and the files of every neighbouring hash
+        for index in [hash_id] + neighbours(graph, hash_id).tolist():
+            for match in files_by_hash[index]:
+                if match != path and match not in path_false_positives:
+                    all_duplicates.append(match)
+                    marked_duplicates.add(match)
+        if len(all_duplicates) > 0:
+            yield path, sorted(all_duplicates)
+
+
+class UnionFind:
+    """
+    Disjoint sets over the integers 0, ..., size - 1
+    with union by size and path halving.
+    """
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, element):
+        parent = self.parent
+        while parent[element] != element:
+            parent[element] = parent[parent[element]]
+            element = parent[element]
+        return element
+
+    def union(self, first, second):
+        first = self.find(first)
+        second = self.find(second)
+        if first == second:
+            return
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+
+
+def _is_false_positive(false_positives, first, second):
+    return second in false_positives.get(first, ()) or first in false_positives.get(second, ())
+
+
+def component_groups(graph, files_by_hash, false_positives):
+    """
+    Group the duplicates in the connected components of the files graph.
+    Two files are connected if they have the same or neighbouring hashes
+    and they are not false positives. A connection that would put two false
+    positives in the same component is dropped, so they are never grouped.
+    Without false positives the groups do not depend on the order of the hashes:
+    the anchor of a group is its first path in sorted order and the groups are sorted by anchor.
+
+    :param graph: CSR adjacency matrix of the hashes
+    :param files_by_hash: list with the files of each hash, indexed by hash id
+    :param false_positives: map from path to the set of its false positives
+    :return: iterator of 2-ples (anchor, sorted list of duplicates)
+    """
+    # Files involved in a false positive need to be connected one by one,
+    # all the others are connected through a representative of their hash
+    flagged = set(false_positives.keys())
+    for values in false_positives.values():
+        flagged.update(values)
+    files = []
+    representatives = []  # File id of a not flagged file of each hash, or None
+    flagged_by_hash = []  # File ids of the flagged files of each hash
+    for hash_files in files_by_hash:
+        representative = None
+        hash_flagged = []
+        for path in hash_files:
+            file_id = len(files)
+            files.append(path)
+            if path in flagged:
+                hash_flagged.append(file_id)
+            elif representative is None:
+                representative = file_id
+        representatives.append(representative)
+        flagged_by_hash.append(hash_flagged)
+    sets = UnionFind(len(files))
+    # Map from the root of a component to the flagged paths in it
+    flagged_members = {file_id: {path} for file_id, path in enumerate(files) if path in flagged}
+
+    def union(first, second):
+        first = sets.find(first)
+        second = sets.find(second)
+        if first == second:
+            return
+        first_flagged = flagged_members.get(first, ())
+        second_flagged = flagged_members.get(second, ())
+        if any(_is_false_positive(false_positives, path, other_path)
+               for path in first_flagged for other_path in second_flagged):
+            return
+        sets.union(first, second)
+        merged = flagged_members.pop(first, set()) | flagged_members.pop(second, set())
+        if len(merged) > 0:
+            flagged_members[sets.find(first)] = merged
+
+    file_id = 0
+    for hash_id, hash_files in enumerate(files_by_hash):
+        # Files with the same hash
+        for path in hash_files:
+            if path not in flagged and representatives[hash_id] != file_id:
+                union(representatives[hash_id], file_id)
+            file_id += 1
+        # Files with neighbouring hashes (and the same hash for the flagged files)
+        for other_id in [hash_id] + neighbours(graph, hash_id).tolist():
+            if other_id > hash_id and representatives[hash_id] is not None \
+                    and representatives[other_id] is not None:
+                union(representatives[hash_id], representatives[other_id])
+            for flagged_id in flagged_by_hash[hash_id]:
+                if representatives[other_id] is not None:
+                    union(flagged_id, representatives[other_id])
+                for other_flagged_id in flagged_by_hash[other_id]:
+                    if other_flagged_id != flagged_id:
+                        union(flagged_id, other_flagged_id)
+    components = dict()
+    for file_id, path in enumerate(files):
+        components.setdefault(sets.find(file_id), []).append(path)
+    groups = [sorted(paths) for paths in components.values() if len(paths) > 1]
+    for group in sorted(groups):
+        yield group[0], group[1:]
+
+
+def find_groups(graph, files_by_hash, false_positives, clustering=CLUSTERING_GREEDY):
+    """
+    Group the duplicates.
+
+    :param graph: CSR adjacency matrix of the hashes
+    :param files_by_hash: list with the files of each hash, indexed by hash id
+    :param false_positives: map from path to the set of its false positives
+    :param clustering: one of CLUSTERINGS
+    :return: iterator of 2-ples (anchor, sorted list of duplicates)
+    """
+    if clustering == CLUSTERING_GREEDY:
+        return greedy_groups(graph, files_by_hash, false_positives)
+    elif clustering == CLUSTERING_COMPONENTS:
+        return component_groups(graph, files_by_hash, false_positives)
+    raise ValueError("Unknown clustering %s" % clustering)
@@ -2,36 +2,19 @@
 
 import os
 import json
-import shelve
 import sys
 import hashlib
+import threading
+from queue import Full
+from queue import Queue
 
 INFO_FILE_NAME = "info.json"
-
-
-class open_shelve_db:
-    """
-    Open a shelve db.
-    Allows empty db_path, in that case the returned db will be a
-    dictionary.
-    """
-
-    def __init__(self, db_path, **kwargs):
-        self.db_path = db_path
-        self.kwargs = kwargs
-
-    def __enter__(self):
-        if self.db_path is None:
-            self.db = dict()
-            self.close_db = False
-        else:
-            self.db = shelve.open(self.db_path, **self.kwargs)
-            self.close_db = True
-        return self.db
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.close_db:
-            self.db.close()
+# Folder with the hashes and the false positives, inside the scanned folder
+PERSISTENCE_FOLDER_NAME = ".duplicate-image-finder"
+# Read buffer used to digest the files
+DIGEST_BLOCK_SIZE = 1024 * 1024
+# Seconds the prefetch thread waits on a full queue before checking if the consumer stopped
+PREFETCH_PUT_TIMEOUT = 0.1
 
 
 def iter_folder(folder):
@@ -40,20 +23,71 @@ def iter_folder(folder):
         yield os.path.abspath(path)
 
 
-def iter_recursive(folder):
-    for dirpath, dirnames, filenames in os.walk(folder):
-        for name in filenames:
-            path = os.path.join(dirpath, name)
-            yield os.path.abspath(path)
-
-
-def write_info_file(folder, basepath, duplicates):
+def iter_prefetch(iterator, maxsize):
+    """
+    Consume an iterator on a background thread.
+    At most maxsize elements are read ahead, the background thread
+    blocks until the caller consumes them. It stops, and closes the iterator,
+    when the caller stops early (an exception or the returned iterator being closed).
+
+    :param iterator: iterator to consume
+    :param maxsize: maximum number of elements to read ahead
+    :return: iterator with the same elements
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        """
+        :return: False if the consumer stopped before the item was queued
+        """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=PREFETCH_PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for element in iterator:
+                if not put((element, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+            return
+        finally:
+            # e.g. release the scandir handles of a scan generator
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+        put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            element, error = queue.get()
+            if element is end:
+                if error is not None:
+                    raise error
+                break
+            yield element
+    finally:
+        stop.set()
+        thread.join()
+
+
+def write_info_file(folder, basepath, duplicates, content_ids=None):
     """
     Write the info file in the duplicates folder.
 
     :param folder: Folder with the duplicates file
     :param basepath: Best duplicate file (symlinked in the duplicates folder)
     :param duplicates: List of 2-ples (name of the file in the duplicates folder, original path)
+    :param content_ids: Map from original path to content id (see HashCache.content_id)
     :return:
     """
     duplicates_structured = list(map(lambda duplicate: {'name': duplicate[0], 'path': duplicate[1]}, duplicates))
@@ -61,6 +95,8 @@ def write_info_file(folder, basepath, duplicates):
         'basefile': basepath,
         'duplicates': duplicates_structured
     }
+    if content_ids:
+        data['content_ids'] = content_ids
     path = os.path.join(folder, INFO_FILE_NAME)
     with open(path, "w") as hand:
         json.dump(data, hand)
@@ -84,6 +120,21 @@ def read_info_file(folder):
     return data['basefile'], duplicates
 
 
+def read_content_ids(folder):
+    """
+    Read the content ids of the info file
+
+    :param folder:
+    :return: map from original path to content id, empty for the info files written by older versions
+    """
+    path = os.path.join(folder, INFO_FILE_NAME)
+    if not os.path.exists(path):
+        return dict()
+    with open(path, "r") as hand:
+        data = json.load(hand)
+    return data.get('content_ids', dict())
+
+
 def remove_info_file(folder):
     path = os.path.join(folder, INFO_FILE_NAME)
     if os.path.exists(path):
@@ -128,6 +179,27 @@ def print_to_stdout(text):
     sys.stdout.flush()
 
 
+def digest_file(filepath, digest, block_size=DIGEST_BLOCK_SIZE):
+    """
+    Feed a file to a hashlib digest.
+    The file is read in large blocks into a single reused buffer.
+
+    :param filepath:
+    :param digest: hashlib object
+    :param block_size: size of the read buffer
+    :return: the hex digest
+    """
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(filepath, "rb", buffering=0) as hand:
+        while True:
+            read = hand.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
 def compute_sha256(filepath):
     """
     Return the sha256 of a file.
@@ -138,9 +210,4 @@ def compute_sha256(filepath):
     """
     if not os.path.exists(filepath):
         return None
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as hand:
-        for byte_block in iter(lambda: hand.read(4096), b""):
-            sha256_hash.update(byte_block)
-        readable_hash = sha256_hash.hexdigest()
-    return readable_hash
+    return digest_file(filepath, hashlib.sha256())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import concurrent.futures
+from collections import namedtuple
+from PIL import Image
+
+from .Hashing import ALGORITHMS
+from .Hashing import DEFAULT_ALGORITHM
+from .Hashing import INDEXABLE_ALGORITHMS
+from .Hashing import algorithm_tag
+from .Hashing import compute_hashes
+from .Hashing import serialize_hashes
+from .Search import bytes_to_packed
+from .Search import hex_to_packed
+from .Search import threshold_to_distance
+from .Store import SearchIndexStore
+from .Store import open_hash_store
+
+# A duplicate found by a query, distance is the number of different bits of the hashes
+Match = namedtuple('Match', ['path', 'distance'])
+
+# Number of threads hashing the images of a batch
+QUERY_WORKERS = os.cpu_count()
+
+
+class DuplicateIndex:
+    """
+    Query an archive of hashes for the duplicates of images, e.g. to check the uploads.
+    The images can be given as paths, bytes, file objects or PIL images.
+    Queries do not change the index, so they can run in parallel.
+    """
+
+    def __init__(self, index, algorithm=DEFAULT_ALGORITHM, decode_size=None, threshold=0.1):
+        """
+        :param index: Store.SearchIndexStore with the hashes of the archive
+        :param algorithm: hashing algorithm of the index, one of Hashing.INDEXABLE_ALGORITHMS
+        :param decode_size: decode the images at a reduced size, as the images of the index were
+        :param threshold: default threshold under which images are considered duplicates
+        """
+        if algorithm not in INDEXABLE_ALGORITHMS:
+            raise ValueError("Algorithm %s cannot be used by the search index" % algorithm)
+        self.index = index
+        self.algorithm = algorithm
+        self.decode_size = decode_size
+        self.threshold = threshold
+        self.tag = algorithm_tag(decode_size, algorithm)
+        self.n_bits = ALGORITHMS[algorithm].n_bits
+
+    def __len__(self):
+        return len(self.index)
+
+    def hash(self, image):
+        """
+        :param image: path, bytes, binary file object or PIL image
+        :return: the serialized hash of the image, None if it cannot be read
+        """
+        if isinstance(image, Image.Image):
+            return serialize_hashes(compute_hashes(image, [self.algorithm], self.decode_size))[self.algorithm]
+        if isinstance(image, (bytes, bytearray)):
+            image = io.BytesIO(image)
+        try:
+            with Image.open(image) as opened:
+                return self.hash(opened)
+        except Exception:
+            return None
+
+    def query_hashes(self, hash_strs, threshold=None, exclude=None):
+        """
+        Find the duplicates of serialized hashes with a single batched search.
+
+        :param hash_strs: list of serialized hashes
+        :param threshold: threshold under which images are considered duplicates, the default one if None
+        :param exclude: list with a path not to return for each hash (e.g. the queried image), or None
+        :return: list with the Match list of each hash, sorted by distance
+        """
+        threshold = self.threshold if threshold is None else threshold
+        exclude = [None] * len(hash_strs) if exclude is None else exclude
+        results = self.index.query(hex_to_packed(hash_strs, self.n_bits),
+                                   threshold_to_distance(threshold, self.n_bits))
+        return [sorted((Match(path, int(distance)) for path, distance in zip(paths, distances) if path != excluded),
+                       key=lambda match: (match.distance, match.path))
+                for (paths, distances), excluded in zip(results, exclude)]
+
+    def query(self, image, threshold=None):
+        """
+        Find the duplicates of an image.
+
+        :param image: path, bytes, binary file object or PIL image
+        :param threshold: threshold under which images are considered duplicates, the default one if None
+        :return: list of Match sorted by distance, None if the image cannot be read
+        """
+        return self.query_batch([image], threshold, workers=1)[0]
+
+    def query_batch(self, images, threshold=None, workers=QUERY_WORKERS):
+        """
+        Find the duplicates of several images.
+        The images are hashed in parallel and searched with a single batched query.
+
+        :param images: list of paths, bytes, binary file objects or PIL images
+        :param threshold: threshold under which images are considered duplicates, the default one if None
+        :param workers: number of threads hashing the images
+        :return: list with the Match list of each image (see query)
+        """
+        if workers == 1:
+            hash_strs = [self.hash(image) for image in images]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                hash_strs = list(executor.map(self.hash, images))
+        readable = [i for i, hash_str in enumerate(hash_strs) if hash_str is not None]
+        # An indexed image queried by path is not a duplicate of itself
+        exclude = [os.path.abspath(images[i]) if isinstance(images[i], (str, os.PathLike)) else None
+                   for i in readable]
+        matches = self.query_hashes([hash_strs[i] for i in readable], threshold, exclude)
+        results = [None] * len(images)
+        for i, image_matches in zip(readable, matches):
+            results[i] = image_matches
+        return results
+
+    def close(self):
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_duplicate_index(index_path=None, db_path=None, algorithm=DEFAULT_ALGORITHM, decode_size=None,
+                         threshold=0.1, db_backend=None):
+    """
+    Load the hashes of an archive to query it, see DuplicateIndex.
+    The search index persisted by the incremental runs is loaded if it exists,
+    otherwise the index is built in memory from the hash store.
+
+    :param index_path: search index file, see Store.search_index_path
+    :param db_path: hash store
+    :param algorithm: hashing algorithm, one of Hashing.INDEXABLE_ALGORITHMS
+    :param decode_size: decode size used to compute the hashes
+    :param threshold: default threshold under which images are considered duplicates
+    :param db_backend: hash store backend, guessed from db_path by default
+    :return: DuplicateIndex
+    """
+    tag = algorithm_tag(decode_size, algorithm)
+    n_bits = ALGORITHMS[algorithm].n_bits
+    if index_path is not None and os.path.exists(index_path):
+        index = SearchIndexStore(index_path, tag, n_bits, flag='r')
+    elif db_path is not None:
+        index = SearchIndexStore(None, tag, n_bits)
+        with open_hash_store(db_path, backend=db_backend, flag='r') as db:
+            paths, matrix = db.load_matrix(tag)
+        index.add(paths, bytes_to_packed(matrix, n_bits))
+    else:
+        raise ValueError("A search index or a hash store is required")
+    return DuplicateIndex(index, algorithm, decode_size, threshold)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import hashlib
+import concurrent.futures
+
+from .Common import digest_file
+
+# Bytes hashed at the start and at the end of a file by the partial digest
+PARTIAL_DIGEST_SIZE = 4096
+# Number of threads reading the files, the digests are I/O bound
+EXACT_WORKERS = 8
+# Algorithm version of the full digests cached in the digest store
+FULL_DIGEST_ALGORITHM = "blake2b-v1"
+
+
+def partial_digest(path, size):
+    """
+    Digest of the first and last PARTIAL_DIGEST_SIZE bytes of a file.
+    Files smaller than 2 * PARTIAL_DIGEST_SIZE are digested completely.
+
+    :param path:
+    :param size: size of the file
+    :return: hex digest
+    """
+    digest = hashlib.blake2b()
+    with open(path, "rb") as hand:
+        digest.update(hand.read(PARTIAL_DIGEST_SIZE))
+        if size > PARTIAL_DIGEST_SIZE:
+            hand.seek(max(PARTIAL_DIGEST_SIZE, size - PARTIAL_DIGEST_SIZE))
+            digest.update(hand.read())
+    return digest.hexdigest()
+
+
+def full_digest(path):
+    """
+    :param path:
+    :return: hex digest of the whole file
+    """
+    return digest_file(path, hashlib.blake2b())
+
+
+def _digest_or_none(function, *args):
+    try:
+        return function(*args)
+    except OSError:
+        return None
+
+
+def _split_groups(groups, keys):
+    """
+    Split the groups by key, keep only the sub-groups with at least 2 entries.
+
+    :param groups: list of lists of entries
+    :param keys: list of lists of keys, same shape of groups (None keys are dropped)
+    :return: list of lists of entries
+    """
+    result = []
+    for group, group_keys in zip(groups, keys):
+        by_key = dict()
+        for entry, key in zip(group, group_keys):
+            if key is not None:
+                by_key.setdefault(key, []).append(entry)
+        result.extend(sub_group for sub_group in by_key.values() if len(sub_group) > 1)
+    return result
+
+
+def _map_groups(executor, function, groups):
+    flat = [entry for group in groups for entry in group]
+    keys = iter(list(executor.map(function, flat)))
+    return [[next(keys) for _ in group] for group in groups]
+
+
+def find_exact_groups(entries, workers=EXACT_WORKERS, store=None):
+    """
+    Group the byte-identical files.
+    Files are grouped by size, then by a digest of their first and last bytes
+    and finally by a digest of the whole content. Each stage only reads the
+    files that are still candidates.
+
+    :param entries: iterable of Scanner.ScanEntry
+    :param workers: number of threads reading the files
+    :param store: Store.DigestStore caching the full digests, or None
+    :return: list of groups of paths, each group is sorted and has at least 2 paths
+    """
+    by_size = dict()
+    stats = dict()
+    for path, stat in entries:
+        by_size.setdefault(stat.st_size, []).append(path)
+        stats[path] = stat
+    groups = [group for group in by_size.values() if len(group) > 1]
+    sizes = {path: size for size, group in by_size.items() if len(group) > 1 for path in group}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        groups = _split_groups(groups, _map_groups(
+            executor, lambda path: _digest_or_none(partial_digest, path, sizes[path]), groups))
+        # The partial digest of the small files already covers the whole content
+        small = [group for group in groups if sizes[group[0]] <= 2 * PARTIAL_DIGEST_SIZE]
+        large = [group for group in groups if sizes[group[0]] > 2 * PARTIAL_DIGEST_SIZE]
+        cached = dict()
+        if store is not None:
+            for path in (path for group in large for path in group):
+                digest = store.get_digest(path, stats[path], FULL_DIGEST_ALGORITHM)
+                if digest is not None:
+                    cached[path] = digest
+        keys = _map_groups(executor, lambda path: cached.get(path) or _digest_or_none(full_digest, path), large)
+    if store is not None:
+        for group, group_keys in zip(large, keys):
+            for path, key in zip(group, group_keys):
+                if key is not None and path not in cached:
+                    store.put_digest(path, stats[path], key, FULL_DIGEST_ALGORITHM)
+    large = _split_groups(large, keys)
+    return sorted(sorted(group) for group in small + large)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import os
+from collections import namedtuple
+
+# Version of the hashing algorithm, stored with every entry.
+# Change it whenever the hashes computed for the same file change.
+HASH_ALGORITHM = "whash-v1"
+
+# Metadata of an image, read while hashing.
+# size is the file size, sha256 is computed only when needed (None until then),
+# bits is the number of bits per pixel, exif is True if the image has EXIF data
+# (both None for the entries cached by older versions), mtime_ns is the modification time of the file.
+ImageMetadata = namedtuple('ImageMetadata', ['width', 'height', 'format', 'size', 'sha256', 'bits', 'exif',
+                                             'mtime_ns'], defaults=(None, None, None))
+
+# Prefix of the content ids, they are stored with the paths in the false positives
+CONTENT_ID_PREFIX = "content:"
+
+
+def make_entry(stat, hash_str, algorithm=HASH_ALGORITHM, metadata=None):
+    """
+    Create a cache entry for a file.
+
+    :param stat: os.stat_result of the file
+    :param hash_str: serialized hash of the file
+    :param algorithm: hashing algorithm version
+    :param metadata: ImageMetadata of the file or None
+    :return: the entry to store in the db
+    """
+    return {
+        'hash': hash_str,
+        'algorithm': algorithm,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'ino': stat.st_ino,
+        'dev': stat.st_dev,
+        'width': None if metadata is None else metadata.width,
+        'height': None if metadata is None else metadata.height,
+        'format': None if metadata is None else metadata.format,
+        'sha256': None if metadata is None else metadata.sha256,
+        'bits': None if metadata is None else metadata.bits,
+        'exif': None if metadata is None or metadata.exif is None else int(metadata.exif),
+    }
+
+
+def entry_metadata(entry):
+    """
+    :param entry: entry read from the db
+    :return: the ImageMetadata of the entry, None if the entry was written without metadata
+    """
+    if entry.get('width') is None:
+        return None
+    exif = entry.get('exif')
+    return ImageMetadata(entry['width'], entry['height'], entry['format'], entry['size'], entry.get('sha256'),
+                         entry.get('bits'), None if exif is None else bool(exif), entry.get('mtime_ns'))
+
+
+def entry_matches(entry, stat, algorithm=HASH_ALGORITHM):
+    """
+    Return True if the entry can be trusted for a file with the given stat.
+    Entries written by older versions (bare hash strings) are never trusted.
+
+    :param entry: entry read from the db
+    :param stat: os.stat_result of the file
+    :param algorithm: hashing algorithm version
+    :return:
+    """
+    if not isinstance(entry, dict):
+        return False
+    return entry.get('algorithm') == algorithm \
+        and entry.get('size') == stat.st_size \
+        and entry.get('mtime_ns') == stat.st_mtime_ns \
+        and entry.get('ino') == stat.st_ino \
+        and entry.get('dev') == stat.st_dev
+
+
+def _find_entry(store, path, stat, algorithm):
+    """
+    :return: 2-ple (entry or None, path the entry is stored under)
+    """
+    entry = store.get_entry(path, algorithm)
+    if entry_matches(entry, stat, algorithm):
+        return entry, path
+    previous_path = store.get_path_by_inode(stat.st_dev, stat.st_ino)
+    if previous_path is None or previous_path == path:
+        return None, path
+    entry = store.get_entry(previous_path, algorithm)
+    if entry_matches(entry, stat, algorithm):
+        return entry, previous_path
+    return None, path
+
+
+def lookup_entries(store, path, stat, algorithms):
+    """
+    Return the cache entries of a file for several algorithms.
+    The entries of a moved file are stored under its new path, so the next
+    lookups do not go through its inode again.
+
+    :param store: HashStore
+    :param path: absolute path of the file
+    :param stat: os.stat_result of the file
+    :param algorithms: list of hashing algorithm versions
+    :return: map from algorithm to entry, None if any of them is not cached
+    """
+    entries = dict()
+    previous_path = None
+    for algorithm in algorithms:
+        entry, entry_path = _find_entry(store, path, stat, algorithm)
+        if entry is None:
+            return None
+        entries[algorithm] = entry
+        if entry_path != path:
+            previous_path = entry_path
+    if previous_path is not None:
+        if not os.path.exists(previous_path):
+            # The file was moved, forget the old location
+            store.delete_entry(previous_path)
+        for entry in entries.values():
+            store.put_entry(path, entry)
+    return entries
+
+
+def store_hashes(store, path, stat, hashes, metadata=None):
+    """
+    Save the hashes of a file computed with several algorithms.
+
+    :param store: HashStore
+    :param path: absolute path of the file
+    :param stat: os.stat_result of the file
+    :param hashes: map from algorithm version to serialized hash
+    :param metadata: ImageMetadata of the file, stored with every hash
+    :return:
+    """
+    previous_path = store.get_path_by_inode(stat.st_dev, stat.st_ino)
+    if previous_path is not None and previous_path != path and not os.path.exists(previous_path):
+        # The file was moved, forget the old location
+        store.delete_entry(previous_path)
+    for algorithm, hash_str in hashes.items():
+        store.put_entry(path, make_entry(stat, hash_str, algorithm, metadata))
+
+
+def store_digest(store, path, sha256, algorithms):
+    """
+    Add the sha256 digest to the entries of a file.
+    The entries are updated only if the file did not change since they were written.
+
+    :param store: HashStore
+    :param path: absolute path of the file
+    :param sha256: hex digest of the file
+    :param algorithms: algorithm versions of the entries to update
+    :return:
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    for algorithm in algorithms:
+        entry = store.get_entry(path, algorithm)
+        if entry_matches(entry, stat, algorithm) and entry.get('sha256') != sha256:
+            store.put_entry(path, dict(entry, sha256=sha256))
+
+
+def content_prefix(algorithm, hash_str):
+    """
+    :param algorithm: hash algorithm version
+    :param hash_str: serialized perceptual hash of the file
+    :return: the part of the content id given by the perceptual hash
+    """
+    return "%s%s:%s:" % (CONTENT_ID_PREFIX, algorithm, hash_str)
+
+
+def content_id(algorithm, hash_str, sha256):
+    """
+    Identity of the content of a file, independent of its path.
+    The perceptual hash comes first, so the files that cannot match a stored
+    content id are told apart without computing their digest.
+
+    :param algorithm: hash algorithm version
+    :param hash_str: serialized perceptual hash of the file
+    :param sha256: hex digest of the file
+    :return:
+    """
+    return content_prefix(algorithm, hash_str) + sha256
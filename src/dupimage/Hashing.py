@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import imagehash
+import numpy as np
+from collections import namedtuple
+from functools import partial
+from PIL import Image
+
+from .Common import print_to_stdout
+from .HashCache import HASH_ALGORITHM
+from .Search import hex_to_packed
+from .Search import pair_distances
+from .Search import threshold_to_distance
+
+# Hex length of a segment of a crop resistant hash (dhash with hash_size 8)
+_SEGMENT_HEX_LENGTH = 16
+
+
+def _serialize_multihash(multi_hash):
+    # Concatenate the segments so the hash is a plain hex string, like the other algorithms
+    return "".join(str(segment) for segment in multi_hash.segment_hashes)
+
+
+def _deserialize_multihash(hash_str):
+    return imagehash.ImageMultiHash([imagehash.hex_to_hash(hash_str[i:i + _SEGMENT_HEX_LENGTH])
+                                     for i in range(0, len(hash_str), _SEGMENT_HEX_LENGTH)])
+
+
+# A hashing algorithm.
+# tag: algorithm version stored with the hashes
+# n_bits: number of bits of the hash, None if it cannot be indexed (variable length)
+# grayscale: True if the hash only needs the luminance of the image
+Algorithm = namedtuple('Algorithm', ['tag', 'function', 'n_bits', 'grayscale', 'serialize', 'deserialize'])
+
+ALGORITHMS = {
+    'whash': Algorithm(HASH_ALGORITHM, imagehash.whash, 64, True, str, imagehash.hex_to_hash),
+    'phash': Algorithm("phash-v1", imagehash.phash, 64, True, str, imagehash.hex_to_hash),
+    'dhash': Algorithm("dhash-v1", imagehash.dhash, 64, True, str, imagehash.hex_to_hash),
+    'ahash': Algorithm("ahash-v1", imagehash.average_hash, 64, True, str, imagehash.hex_to_hash),
+    'colorhash': Algorithm("colorhash-v1", imagehash.colorhash, 42, False, str,
+                           partial(imagehash.hex_to_flathash, hashsize=3)),
+    'crop_resistant': Algorithm("crop_resistant-v1", imagehash.crop_resistant_hash, None, True,
+                                _serialize_multihash, _deserialize_multihash),
+}
+DEFAULT_ALGORITHM = 'whash'
+# Algorithms with fixed length hashes, they can be used by the search index
+INDEXABLE_ALGORITHMS = tuple(name for name, algorithm in ALGORITHMS.items() if algorithm.n_bits is not None)
+
+
+def algorithm_tag(decode_size=None, name=DEFAULT_ALGORITHM):
+    """
+    Return the algorithm version stored with the hashes.
+    Hashes computed from a reduced decode can differ from the full decode ones,
+    so they are cached under a different tag.
+
+    :param decode_size: size of the reduced decode, None for a full decode
+    :param name: algorithm name, one of ALGORITHMS
+    :return:
+    """
+    tag = ALGORITHMS[name].tag
+    if decode_size is None:
+        return tag
+    return "%s@%d" % (tag, decode_size)
+
+
+# PIL modes that Image.reduce does not handle, or that must not be averaged (palette indexes)
+_UNREDUCIBLE_MODES = ('1', 'P', 'PA', 'I;16', 'I;16L', 'I;16B', 'I;16N')
+
+
+def reduce_image(image, decode_size, grayscale=True):
+    """
+    Reduce an image, keeping its smaller side at least decode_size.
+    Only JPEG images are decoded faster: they are decoded at 1/2, 1/4 or 1/8 of their size (draft mode).
+    The other formats are fully decoded and then reduced by an integer factor, which saves
+    no decode time but keeps their hashes consistent with the JPEG ones for the same decode_size.
+
+    :param image: PIL image, not loaded yet
+    :param decode_size: minimum size of the reduced image, None to keep the full image
+    :param grayscale: True to decode JPEG images in grayscale, and to convert the modes
+                      that cannot be reduced (e.g. palette images) to grayscale instead of RGB
+    :return: the reduced image
+    """
+    if decode_size is None:
+        return image
+    if image.format == 'JPEG':
+        image.draft('L' if grayscale else None, (decode_size, decode_size))
+        return image
+    factor = min(image.size) // decode_size
+    if factor < 2:
+        return image
+    if image.mode in _UNREDUCIBLE_MODES:
+        # Image.reduce fails on these modes, and averaging palette indexes is meaningless
+        image = image.convert('L' if grayscale else 'RGB')
+    return image.reduce(factor)
+
+
+def compute_hashes(image, names, decode_size=None):
+    """
+    Compute several hashes of an image with a single decode.
+    The image is converted to grayscale once for all the algorithms that need it.
+
+    :param image: PIL image, not loaded yet
+    :param names: list of algorithm names, see ALGORITHMS
+    :param decode_size: see reduce_image
+    :return: map from algorithm name to hash
+    """
+    algorithms = [ALGORITHMS[name] for name in names]
+    image = reduce_image(image, decode_size, grayscale=all(algorithm.grayscale for algorithm in algorithms))
+    gray_image = image.convert('L') if any(algorithm.grayscale for algorithm in algorithms) else None
+    return {name: algorithm.function(gray_image if algorithm.grayscale else image)
+            for name, algorithm in zip(names, algorithms)}
+
+
+def hash_image(image, decode_size=None, name=DEFAULT_ALGORITHM):
+    """
+    Compute the hash of an image.
+
+    :param image: PIL image, not loaded yet
+    :param decode_size: see reduce_image
+    :param name: algorithm name, one of ALGORITHMS
+    :return: the ImageHash
+    """
+    return compute_hashes(image, [name], decode_size)[name]
+
+
+def serialize_hashes(hashes):
+    """
+    :param hashes: map from algorithm name to hash, see compute_hashes
+    :return: map from algorithm name to serialized hash
+    """
+    return {name: ALGORITHMS[name].serialize(image_hash) for name, image_hash in hashes.items()}
+
+
+def confirm_pairs(hash_strs, rows, cols, name, threshold):
+    """
+    Check pairs of candidate duplicates with a second (stricter) algorithm.
+
+    :param hash_strs: serialized hashes of the algorithm
+    :param rows: first element of the pairs, indexes of hash_strs
+    :param cols: second element of the pairs, indexes of hash_strs
+    :param name: algorithm name, one of ALGORITHMS
+    :param threshold: similarity threshold, for crop resistant hashes the bit error rate of a segment match
+    :return: bool array, True if the pair is confirmed
+    """
+    algorithm = ALGORITHMS[name]
+    if algorithm.n_bits is not None:
+        packed = hex_to_packed(hash_strs, algorithm.n_bits)
+        distances = pair_distances(packed[rows], packed[cols])
+        return distances <= threshold_to_distance(threshold, algorithm.n_bits)
+    hashes = dict()
+    confirmed = np.zeros(len(rows), dtype=bool)
+    for i, (row, col) in enumerate(zip(rows, cols)):
+        for hash_id in (row, col):
+            if hash_id not in hashes:
+                hashes[hash_id] = algorithm.deserialize(hash_strs[hash_id])
+        confirmed[i] = hashes[row].matches(hashes[col], bit_error_rate=threshold)
+    return confirmed
+
+
+def validate_fast_decode(paths, decode_size, threshold=0.0, quiet=False):
+    """
+    Compare the hashes computed from a reduced decode with the ones computed
+    from the full image.
+
+    :param paths: iterator of image paths
+    :param decode_size: size of the reduced decode
+    :param threshold: similarity threshold above which a hash is reported
+    :param quiet: True if no output
+    :return: dict with the number of images, of different hashes, of hashes above
+             the threshold and the mean and max distance
+    """
+    n_images = 0
+    n_different = 0
+    n_above = 0
+    total_distance = 0
+    max_found = 0
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                full_hash = hash_image(image)
+            with Image.open(path) as image:
+                fast_hash = hash_image(image, decode_size)
+        except Exception:
+            continue
+        distance = full_hash - fast_hash
+        max_distance = threshold_to_distance(threshold, full_hash.hash.size)
+        n_images += 1
+        n_different += distance > 0
+        total_distance += distance
+        max_found = max(max_found, distance)
+        if distance > max_distance:
+            n_above += 1
+            not quiet and print_to_stdout("%s: %d bits differ" % (path, distance))
+    report = {
+        'images': n_images,
+        'different': n_different,
+        'above_threshold': n_above,
+        'mean_distance': total_distance / n_images if n_images > 0 else 0,
+        'max_distance': max_found,
+    }
+    not quiet and print_to_stdout("# %(images)d images, %(different)d different hashes, "
+                                  "%(above_threshold)d above the threshold, "
+                                  "mean distance %(mean_distance).3f, max distance %(max_distance)d" % report)
+    return report
@@ -1,21 +1,76 @@
 #!/usr/bin/env python3
 
-import imagehash
 import os
-import shutil
-from PIL import Image
-from sklearn.neighbors import BallTree
 import numpy as np
-import concurrent  # Requires Python 3.2
-from queue import Queue
+from PIL import Image
+import concurrent.futures  # Requires Python 3.2
+from collections import namedtuple
+from functools import partial
 
-from .Common import write_info_file
 from .Common import write_restore_info
-from .Common import iter_folder
-from .Common import iter_recursive
-from .Common import open_shelve_db
+from .Common import iter_prefetch
 from .Common import print_to_stdout
-from .Common import compute_sha256
+from .HashCache import CONTENT_ID_PREFIX
+from .HashCache import ImageMetadata
+from .HashCache import content_prefix
+from .HashCache import entry_metadata
+from .HashCache import lookup_entries
+from .HashCache import store_digest
+from .HashCache import store_hashes
+from .Hashing import ALGORITHMS
+from .Hashing import DEFAULT_ALGORITHM
+from .Hashing import INDEXABLE_ALGORITHMS
+from .Hashing import algorithm_tag
+from .Hashing import compute_hashes
+from .Hashing import confirm_pairs
+from .Hashing import serialize_hashes
+from .Exact import find_exact_groups
+from .Metrics import Metrics
+from .Mover import MOVE_WORKERS
+from .Mover import apply_plan
+from .Mover import get_sha256
+from .Mover import plan_group
+from .Mover import resume_moves
+from .Output import GroupRecord
+from .Output import make_record
+from .Ranking import DEFAULT_RANKING
+from .Ranking import image_info
+from .Ranking import rank_images
+from .Scanner import FILTER_NONE
+from .Scanner import scan
+from .Store import open_hash_store
+from .Store import open_false_positives_store
+from .Store import CHECKPOINT_FILES
+from .Store import CHECKPOINT_SECONDS
+from .Store import Checkpointer
+from .Store import DigestStore
+from .Store import SearchIndexStore
+from .Search import INDEX_POPCOUNT
+from .Search import build_index
+from .Search import filter_graph
+from .Search import graph_pairs
+from .Search import hex_to_packed
+from .Search import radius_graph
+from .Search import threshold_to_distance
+from .Clustering import CLUSTERING_GREEDY
+from .Clustering import find_groups
+
+ENGINE_THREAD = "thread"
+ENGINE_PROCESS = "process"
+ENGINES = (ENGINE_THREAD, ENGINE_PROCESS)
+
+# Result of the hashing pipeline.
+# hashes is a map from algorithm version to serialized hash,
+# cached is True if the hashes were read from the db,
+# metadata is the ImageMetadata of the file (None if it was cached by an older version).
+HashResult = namedtuple('HashResult', ['path', 'hashes', 'stat', 'cached', 'metadata'])
+
+# Number of paths sent to a worker process in a single task
+PROCESS_CHUNK_SIZE = 32
+# Number of paths the directory walk can read ahead of the hashing
+MAX_PENDING_PATHS = 1024
+# Number of tasks in flight per worker
+MAX_PENDING_TASKS_PER_WORKER = 4
 
 
 class _open_image:
@@ -47,144 +102,322 @@ def _load_false_positives(db_path):
     """
     Load false positives in memory
     :param db_path: false positives db path
-    :return: a map from path to list of false positives
+    :return: a map from path (or content id) to the set of its false positives
     """
     false_positives_map = {}
-    if db_path is None or not os.path.exists(db_path):
+    if db_path is None:
         return false_positives_map
-    with open_shelve_db(db_path, flag='r') as db:
-        for path in db:
-            false_positives_map[path] = [false_path for false_path in db.get(path)]
+    store = open_false_positives_store(db_path, flag='r')
+    if store is None:
+        return false_positives_map
+    with store:
+        for first, second in store.iter_pairs():
+            false_positives_map.setdefault(first, set()).add(second)
+            false_positives_map.setdefault(second, set()).add(first)
     return false_positives_map
 
 
-def _numpy_hash_to_str(arr):
-    """
-    This function is a copy of _binary_array_to_hex
-    in imagehash.
-
-    :param arr:
-    :return:
-    """
-    bit_string = ''.join(str(b) for b in 1 * arr.flatten())
-    width = int(np.ceil(len(bit_string) / 4))
-    return '{:0>{width}x}'.format(int(bit_string, 2), width=width)
-
-
-def index_folder(folder, db_path, recursive=True):
+def index_folder(folder, db_path, recursive=True, db_backend=None, decode_size=None,
+                 algorithms=(DEFAULT_ALGORITHM,), file_filter=FILTER_NONE, engine=ENGINE_THREAD, workers=None,
+                 entries=None, checkpoint_files=CHECKPOINT_FILES, checkpoint_interval=CHECKPOINT_SECONDS,
+                 metrics=None):
     """
     Save all the image hashes on a database.
+    The hashes already cached for the unchanged files are not computed again.
 
     :param folder:
     :param db_path:
     :param recursive:
-    :return:
+    :param db_backend: hash store backend, guessed from db_path by default
+    :param decode_size: decode the images at a reduced size, at least decode_size pixels
+    :param algorithms: names of the hashing algorithms, see Hashing.ALGORITHMS
+    :param file_filter: filter of the scanned files, one of Scanner.FILTERS
+    :param engine: hashing engine, ENGINE_THREAD or ENGINE_PROCESS
+    :param workers: number of hashing workers, defaults to the number of CPUs
+    :param entries: iterable of Scanner.ScanEntry to hash instead of scanning the folder
+    :param checkpoint_files: checkpoint the database every checkpoint_files hashed images
+    :param checkpoint_interval: checkpoint the database every checkpoint_interval seconds
+    :param metrics: Metrics.Metrics updated while hashing
+    :return: number of images in the database for the folder
     """
-    with open_shelve_db(db_path, flag='c', writeback=True) as db:
-        iterator = iter_recursive(folder) if recursive else iter_folder(folder)
-        for path in iterator:
-            with _open_image(path) as image:
-                if image is None:
-                    continue
-                db[path] = str(imagehash.whash(image))
-
-
-def _compute_hash(path, hash_str):
+    n_images = 0
+    with open_hash_store(db_path, backend=db_backend, flag='c') as db:
+        checkpointer = Checkpointer(db, checkpoint_files, checkpoint_interval)
+        iterator = _compute_hash_iterator(folder, db, recursive=recursive, engine=engine, workers=workers,
+                                          decode_size=decode_size, algorithms=algorithms,
+                                          file_filter=file_filter, entries=entries, metrics=metrics)
+        for path, hashes, stat, cached, metadata in iterator:
+            if not cached:
+                store_hashes(db, path, stat, hashes, metadata)
+                checkpointer.update()
+            n_images += 1
+            metrics is not None and metrics.tick()
+    return n_images
+
+
+def _compute_hashes(path, algorithms=(DEFAULT_ALGORITHM,), decode_size=None):
     """
-    Compute the hash for a path.
-    If hash_str is provided will return is de-serialization.
+    Compute the hashes of a path, the image is decoded only once.
+    The size, the format, the bit depth and the EXIF presence of the image are read before it is decoded.
 
     :param path:
-    :param hash_str: Serialized hash retrived from the db.
-    :return:
+    :param algorithms: names of the hashing algorithms, see Hashing.ALGORITHMS
+    :param decode_size: decode the image at a reduced size, at least decode_size pixels
+    :return: 2-ple (hashes, image_info), hashes is a map from algorithm version to serialized hash
+             and image_info is the 5-ple of Ranking.image_info; (None, None) if the path is not an image
     """
-    if hash_str is None:
-        # Re-compute the image hash
-        with _open_image(path) as image:
-            if image is None:
-                return None, None
-            image_hash = imagehash.whash(image)
-        hash_str = str(image_hash)
-    else:
-        image_hash = imagehash.hex_to_hash(hash_str)
-    return image_hash, hash_str
+    with _open_image(path) as image:
+        if image is None:
+            return None, None
+        info = image_info(image)
+        hashes = serialize_hashes(compute_hashes(image, algorithms, decode_size))
+    return {algorithm_tag(decode_size, name): hash_str for name, hash_str in hashes.items()}, info
 
 
-def _compute_hash_and_put(path, hash_str, queue):
+def _compute_hash_batch(paths, algorithms=(DEFAULT_ALGORITHM,), decode_size=None):
+    """
+    Compute the hashes for a batch of paths.
+    Runs on the engine workers: the image is decoded in the worker
+    and only the serialized hashes are sent back to the caller.
+
+    :param paths: list of paths
+    :param algorithms: names of the hashing algorithms, see Hashing.ALGORITHMS
+    :param decode_size: decode the images at a reduced size, at least decode_size pixels
+    :return: list of 3-ples (path, hashes, image_info), see _compute_hashes
     """
-    Compute the hash for an image and put it on a queue.
+    return [(path,) + _compute_hashes(path, algorithms, decode_size) for path in paths]
 
-    :param path:
-    :param hash_str:
-    :param queue:
-    :return:
+
+def _lookup_cached_hashes(entries, db, algorithms, metrics):
+    """
+    Read the cached hashes from the db.
+    Cached hashes are used only if the file did not change since they were computed.
+    Runs on the caller thread since the stores do not support concurrent read/write.
+
+    :param entries: iterator of Scanner.ScanEntry
+    :param db:
+    :param algorithms: algorithm versions of the hashes
+    :param metrics: Metrics.Metrics
+    :return: iterator of 4-ples (path, stat, hashes, metadata), hashes is None if any of them is not cached
     """
-    image_hash, hash_str = _compute_hash(path, hash_str)
-    queue.put((path, image_hash, hash_str))
-
-
-def _compute_hash_iterator(folder, db, recursive=False):
-    queue = Queue()
-    # Submit all the jobs
-    iterator = iter_recursive(folder) if recursive else iter_folder(folder)
-    expected_results = 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        for path in iterator:
-            # Read from the DB before submitting
-            # since shelve concurrent read/write is not supported
-            hash_str = db.get(path)
-            executor.submit(_compute_hash_and_put, path, hash_str, queue)
-            expected_results += 1
-    # Wait on the queue
-    received_results = 0
-    while received_results < expected_results:
-        path, image_hash, hash_str = queue.get()
-        received_results += 1
-        if image_hash is None:
+    for path, stat in entries:
+        metrics.increment('files_scanned')
+        cached = lookup_entries(db, path, stat, algorithms)
+        if cached is None:
+            metrics.increment('cache_misses')
+            yield path, stat, None, None
             continue
-        yield path, image_hash, hash_str
+        metrics.increment('cache_hits')
+        hashes = {algorithm: entry['hash'] for algorithm, entry in cached.items()}
+        yield path, stat, hashes, entry_metadata(cached[algorithms[0]])
+    metrics.set_gauge('scan_complete', 1)
+
+
+def _iter_completed(futures, stats, metrics):
+    for future in futures:
+        for path, hashes, info in future.result():
+            stat = stats.pop(path)
+            metrics.increment('bytes_read', stat.st_size)
+            if hashes is None:
+                metrics.increment('decode_failures')
+                continue
+            metrics.increment('hashes_computed')
+            width, height, image_format, bits, exif = info
+            yield HashResult(path, hashes, stat, False, ImageMetadata(width, height, image_format, stat.st_size, None,
+                                                                      bits, exif, stat.st_mtime_ns))
+
+
+def _iter_engine(executor, task, lookups, chunk_size, max_pending, metrics):
+    """
+    Hash the images not in cache on the executor.
+    At most max_pending tasks are in flight: the lookups are not consumed
+    until a task completes, so memory does not depend on the number of files.
+
+    :param executor:
+    :param task: function hashing a list of paths, see _compute_hash_batch
+    :param lookups: iterator of 4-ples (path, stat, cached hashes, cached metadata)
+    :param chunk_size: number of paths per task
+    :param max_pending: maximum number of tasks in flight
+    :param metrics: Metrics.Metrics, the tasks and files in flight are its gauges
+    :return: iterator of HashResult in completion order
+    """
+    pending = set()
+    stats = dict()  # Stats of the paths in flight
+    chunk = []
+    for path, stat, hashes, metadata in lookups:
+        if hashes is not None:
+            # Cached hashes, no need to involve the workers
+            yield HashResult(path, hashes, stat, True, metadata)
+            continue
+        stats[path] = stat
+        chunk.append(path)
+        if len(chunk) < chunk_size:
+            continue
+        metrics.set_gauge('pending_tasks', len(pending))
+        metrics.set_gauge('pending_files', len(stats))
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from _iter_completed(done, stats, metrics)
+        pending.add(executor.submit(task, chunk))
+        chunk = []
+    if len(chunk) > 0:
+        pending.add(executor.submit(task, chunk))
+    yield from _iter_completed(concurrent.futures.as_completed(pending), stats, metrics)
+    metrics.set_gauge('pending_tasks', 0)
+    metrics.set_gauge('pending_files', 0)
+
+
+def _compute_hash_iterator(folder, db, recursive=False, engine=ENGINE_THREAD, workers=None, decode_size=None,
+                           algorithms=(DEFAULT_ALGORITHM,), file_filter=FILTER_NONE, exclude_paths=(), entries=None,
+                           metrics=None):
+    """
+    Iterate over the hashes of the images in a folder.
+    The directory walk, the db lookup and the hashing run as a pipeline
+    with bounded buffers between the stages.
 
+    :param folder:
+    :param db: db to read the cached hashes from
+    :param recursive:
+    :param engine: ENGINE_THREAD or ENGINE_PROCESS
+    :param workers: number of workers, defaults to the number of CPUs
+    :param decode_size: decode the images at a reduced size, at least decode_size pixels
+    :param algorithms: names of the hashing algorithms, see Hashing.ALGORITHMS
+    :param file_filter: filter of the scanned files, one of Scanner.FILTERS
+    :param exclude_paths: folders not to scan
+    :param entries: iterable of Scanner.ScanEntry to hash instead of scanning the folder
+    :param metrics: Metrics.Metrics updated by the stages
+    :return: iterator of HashResult
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if workers is None:
+        workers = os.cpu_count()
+    if engine == ENGINE_THREAD:
+        executor_class = concurrent.futures.ThreadPoolExecutor
+        chunk_size = 1
+    elif engine == ENGINE_PROCESS:
+        executor_class = concurrent.futures.ProcessPoolExecutor
+        chunk_size = PROCESS_CHUNK_SIZE
+    else:
+        raise ValueError("Unknown engine %s" % engine)
+    max_pending = workers * MAX_PENDING_TASKS_PER_WORKER
+    task = partial(_compute_hash_batch, algorithms=tuple(algorithms), decode_size=decode_size)
+    tags = [algorithm_tag(decode_size, name) for name in algorithms]
+    if entries is None:
+        entries = scan(folder, recursive=recursive, file_filter=file_filter, exclude_paths=exclude_paths)
+    return _iter_pipeline(entries, db, executor_class, workers, task, chunk_size, max_pending, tags, metrics)
+
+
+def _iter_pipeline(entries, db, executor_class, workers, task, chunk_size, max_pending, tags, metrics):
+    lookups = _lookup_cached_hashes(iter_prefetch(entries, MAX_PENDING_PATHS), db, tags, metrics)
+    with executor_class(max_workers=workers) as executor:
+        yield from _iter_engine(executor, task, lookups, chunk_size, max_pending, metrics)
 
-def _get_all_hashes(folder, db_path=None, db_flag='c', recursive=True):
-    with open_shelve_db(db_path, flag=db_flag, writeback=True) as db:
-        paths = []
-        hashes_matrix = []
-        hash_to_file = dict()  # Map from hash to list of files with that hash
+
+def _get_all_hashes(folder, db_path=None, db_flag='c', recursive=True, engine=ENGINE_THREAD, workers=None,
+                    db_backend=None, decode_size=None, algorithm=DEFAULT_ALGORITHM, confirm_algorithm=None,
+                    file_filter=FILTER_NONE, exclude_paths=(), entries=None, exact_groups=(),
+                    checkpoint_files=CHECKPOINT_FILES, checkpoint_interval=CHECKPOINT_SECONDS, metrics=None):
+    """
+    Hash all the images in a folder.
+    When a confirmation algorithm is given the files are grouped by the pair
+    (hash, confirmation hash), so the same hash can appear more than once.
+    Only the first file of each group of exact duplicates is hashed, the
+    others get the same hash.
+    The db is checkpointed while hashing, so a run interrupted after a checkpoint
+    is resumed by running it again: the recorded files are read from the cache.
+
+    :return: 5-ple (files_by_hash, hash_strs, n_bits, confirm_strs, metadata), hash_strs and confirm_strs are
+             the serialized hashes and confirmation hashes by hash id (confirm_strs is None if there is no
+             confirmation algorithm), metadata is a map from path to ImageMetadata
+    """
+    if algorithm not in INDEXABLE_ALGORITHMS:
+        raise ValueError("Algorithm %s cannot be used by the search index" % algorithm)
+    algorithms = [algorithm] if confirm_algorithm is None else [algorithm, confirm_algorithm]
+    tag = algorithm_tag(decode_size, algorithm)
+    confirm_tag = None if confirm_algorithm is None else algorithm_tag(decode_size, confirm_algorithm)
+    copies = {group[0]: group[1:] for group in exact_groups}
+    if len(copies) > 0:
+        skipped = {path for group in exact_groups for path in group[1:]}
+        entries = [entry for entry in entries if entry.path not in skipped]
+    with open_hash_store(db_path, backend=db_backend, flag=db_flag) as db:
+        files_by_hash = []  # List of files with each hash, indexed by hash id
+        hash_strs = []
+        confirm_strs = []
+        metadata = dict()
+        hash_ids = dict()  # Map from hash to hash id
+        checkpointer = Checkpointer(db, checkpoint_files, checkpoint_interval)
         # Add hashes from the folder
-        iterator = _compute_hash_iterator(folder, db, recursive=recursive)
-        for path, image_hash, hash_str in iterator:
-            if db_path is not None:
+        iterator = _compute_hash_iterator(folder, db, recursive=recursive, engine=engine, workers=workers,
+                                          decode_size=decode_size, algorithms=algorithms,
+                                          file_filter=file_filter, exclude_paths=exclude_paths, entries=entries,
+                                          metrics=metrics)
+        for path, hashes, stat, cached, image_metadata in iterator:
+            metrics is not None and metrics.tick()
+            if db_path is not None and not cached:
                 # Save on DB
-                # (shelve concurrent read/write is not supported so this should be done on the main thread)
-                db[path] = hash_str
+                # (stores do not support concurrent read/write so this should be done on the main thread)
+                store_hashes(db, path, stat, hashes, image_metadata)
+                checkpointer.update()
+            if image_metadata is not None:
+                metadata[path] = image_metadata
+                # The exact copies have the same metadata
+                metadata.update((copy, image_metadata) for copy in copies.get(path, ()))
+            key = (hashes[tag], hashes.get(confirm_tag))
             # Check If I already have this hash
-            if hash_str not in hash_to_file:
+            if key not in hash_ids:
                 # New hash!
-                hash_to_file[hash_str] = [path]
+                hash_ids[key] = len(files_by_hash)
+                files_by_hash.append([path])
                 # Add to hash_matrix
-                paths.append(path)
-                # Add internal hash (numpy array) with shape (0, n_features)
-                hashes_matrix.append(image_hash.hash.reshape(1, -1))
+                hash_strs.append(hashes[tag])
+                confirm_strs.append(hashes.get(confirm_tag))
             else:
                 # Old hash
-                hash_to_file[hash_str].append(path)
-    hashes_matrix = np.concatenate(hashes_matrix)  # final shape should be (n_samples, n_features)
-    return paths, hashes_matrix, hash_to_file
+                files_by_hash[hash_ids[key]].append(path)
+            files_by_hash[hash_ids[key]].extend(copies.get(path, ()))
+    n_bits = ALGORITHMS[algorithm].n_bits
+    return files_by_hash, hash_strs, n_bits, None if confirm_algorithm is None else confirm_strs, metadata
 
 
-def _build_tree(hashes_matrix):
-    return BallTree(hashes_matrix, metric='hamming')
+def _build_tree(hashes_matrix, n_bits, index_backend=INDEX_POPCOUNT):
+    return build_index(hashes_matrix, n_bits, backend=index_backend)
 
 
-def _find_similar_hashes(hash, tree, threshold):
-    needle = hash.reshape(1, -1)
-    result = tree.query_radius(needle, threshold)
-    return result[0]
+def _build_graph(tree, threshold):
+    """
+    Find all the pairs of similar hashes with a single batched query.
+
+    :param tree: search index
+    :param threshold: threshold under which images are considered duplicates
+    :return: CSR adjacency matrix of the hashes
+    """
+    return radius_graph(tree, threshold_to_distance(threshold, tree.n_bits))
+
+
+def _confirm_graph(graph, confirm_strs, confirm_algorithm, confirm_threshold):
+    """
+    Keep only the edges of the graph confirmed by a second algorithm.
+
+    :param graph: CSR adjacency matrix of the hashes
+    :param confirm_strs: serialized confirmation hashes by hash id
+    :param confirm_algorithm: name of the confirmation algorithm
+    :param confirm_threshold: similarity threshold of the confirmation algorithm
+    :return: CSR adjacency matrix of the hashes
+    """
+    rows, cols, _ = graph_pairs(graph)
+    keep = confirm_pairs(confirm_strs, rows, cols, confirm_algorithm, confirm_threshold)
+    return filter_graph(graph, keep)
 
 
 def find_similar(folder, recursive=True, threshold=0.1, db_path=None,
                  false_positives_db_path=None, print_result=False, duplicates_folder=None,
-                 quiet=False):
+                 quiet=False, engine=ENGINE_THREAD, workers=None, db_backend=None,
+                 index_backend=INDEX_POPCOUNT, clustering=CLUSTERING_GREEDY, decode_size=None,
+                 algorithm=DEFAULT_ALGORITHM, confirm_algorithm=None, confirm_threshold=0.1,
+                 file_filter=FILTER_NONE, exact_prepass=False, move_workers=MOVE_WORKERS, index_path=None,
+                 incremental=False, checkpoint_files=CHECKPOINT_FILES, checkpoint_interval=CHECKPOINT_SECONDS,
+                 metrics=None, sink=None, keep_result=True, ranking=DEFAULT_RANKING, digests_db_path=None):
     """
     Find duplicate images in a folder
 
@@ -196,128 +429,340 @@ def find_similar(folder, recursive=True, threshold=0.1, db_path=None,
     :param print_result: True if I should print the result to screen
     :param duplicates_folder: folder where the duplicate files will be moved to
     :param quiet: True if no output
-    :return:
+    :param engine: hashing engine, ENGINE_THREAD or ENGINE_PROCESS
+    :param workers: number of hashing workers, defaults to the number of CPUs
+    :param db_backend: hash store backend, guessed from db_path by default
+    :param index_backend: search index, one of Search.INDEXES
+    :param clustering: CLUSTERING_GREEDY or CLUSTERING_COMPONENTS (deterministic groups
+                       with the transitive duplicates)
+    :param decode_size: decode the images at a reduced size, at least decode_size pixels
+                        (faster, but the hashes can differ from the full decode ones)
+    :param algorithm: hashing algorithm used to find the candidate duplicates, one of Hashing.INDEXABLE_ALGORITHMS
+    :param confirm_algorithm: hashing algorithm the candidates must also match, None to skip the confirmation
+    :param confirm_threshold: similarity threshold of the confirmation algorithm
+    :param file_filter: filter of the scanned files, one of Scanner.FILTERS
+    :param exact_prepass: True to find the byte-identical files first and hash each content only once
+    :param move_workers: number of groups of duplicates moved in parallel
+    :param index_path: search index persisted across runs, see Store.SearchIndexStore
+    :param incremental: True to only look for the duplicates of the images that are new or changed since
+                        the index was saved (requires index_path)
+    :param checkpoint_files: checkpoint the hash db every checkpoint_files hashed images
+    :param checkpoint_interval: checkpoint the hash db every checkpoint_interval seconds
+    :param metrics: Metrics.Metrics with the timers of the stages and the counters of the pipeline
+    :param sink: sink the groups are written to as soon as they are found, see Output.open_sink
+    :param keep_result: False not to keep the groups in the result (they are still kept to move them)
+    :param ranking: keys ranking the image kept in each group, see Ranking.RANK_KEYS
+    :param digests_db_path: Store.DigestStore caching the digests of the exact prepass, None not to cache them
+    :return: map from path to the list of its duplicates
     """
+    if metrics is None:
+        metrics = Metrics()
     not quiet and print_to_stdout("# Loading images")
     result = dict()
     # Save restore info
     if duplicates_folder is not None:
-        write_restore_info(duplicates_folder, false_positives_db_path)
+        _prepare_duplicates_folder(duplicates_folder, false_positives_db_path, move_workers, quiet)
+    # Never scan the duplicates moved by a previous run
+    exclude_paths = () if duplicates_folder is None else (duplicates_folder,)
     # Read the false positives
     FALSE_POSITIVES = _load_false_positives(false_positives_db_path)
+    entries = None
+    exact_groups = ()
+    if exact_prepass:
+        with metrics.stage("exact"):
+            entries = list(scan(folder, recursive=recursive, file_filter=file_filter, exclude_paths=exclude_paths))
+            exact_groups = _find_exact_groups(entries, digests_db_path)
+        not quiet and print_to_stdout("# Found %d groups of exact duplicates" % len(exact_groups))
     # Read data from folder and db
-    paths, hashes_matrix, hash_to_file = _get_all_hashes(folder, db_path, recursive=recursive)
+    with metrics.stage("hash"):
+        files_by_hash, hash_strs, n_bits, confirm_strs, metadata = _get_all_hashes(
+            folder, db_path, recursive=recursive, engine=engine, workers=workers, db_backend=db_backend,
+            decode_size=decode_size, algorithm=algorithm, confirm_algorithm=confirm_algorithm,
+            file_filter=file_filter, exclude_paths=exclude_paths, entries=entries, exact_groups=exact_groups,
+            checkpoint_files=checkpoint_files, checkpoint_interval=checkpoint_interval, metrics=metrics)
+    # Pack the hashes in uint64 words, final shape is (n_samples, n_words)
+    hashes_matrix = hex_to_packed(hash_strs, n_bits)
+    tag = algorithm_tag(decode_size, algorithm)
+    changed = None
+    index = None
+    if index_path is not None:
+        index = SearchIndexStore(index_path, tag, n_bits)
+        indexed = len(index) > 0
+        changed = _update_search_index(index, files_by_hash, hashes_matrix)
+        if incremental and indexed:
+            # Keep only the hashes of the changed files and their neighbours
+            selected = _changed_hash_ids(index, files_by_hash, hashes_matrix, changed,
+                                         threshold_to_distance(threshold, n_bits))
+            not quiet and print_to_stdout("# %d new or changed images" % len(changed))
+            files_by_hash = [files_by_hash[hash_id] for hash_id in selected]
+            hash_strs = [hash_strs[hash_id] for hash_id in selected]
+            confirm_strs = None if confirm_strs is None else [confirm_strs[hash_id] for hash_id in selected]
+            hashes_matrix = hashes_matrix[selected]
+        else:
+            changed = None
     # Build the tree
     not quiet and print_to_stdout("# Setting up index")
-    ball_tree = _build_tree(hashes_matrix)
-    marked_duplicates = dict()  # A list of paths already marked as duplicates
+    with metrics.stage("index"):
+        ball_tree = _build_tree(hashes_matrix, n_bits, index_backend=index_backend)
+    with metrics.stage("neighbours"):
+        graph = _build_graph(ball_tree, threshold)
+        if confirm_algorithm is not None:
+            graph = _confirm_graph(graph, confirm_strs, confirm_algorithm, confirm_threshold)
+        metrics.observe('neighbours', np.diff(graph.indptr))
+    digests = dict()
+    _add_content_false_positives(FALSE_POSITIVES, graph, files_by_hash, hash_strs, tag, metadata, digests)
     # Find all the matches
     not quiet and print_to_stdout("# Marking duplicates")
-    for i in range(len(paths)):
-        path = paths[i]
-        if path in marked_duplicates:
-            # Path already marked as duplicate,
-            # do not look for duplicates of duplicates
+    keep_result = keep_result or duplicates_folder is not None
+    hash_ids = None
+    if sink is not None:
+        hash_ids = {path: hash_id for hash_id, files in enumerate(files_by_hash) for path in files}
+    with metrics.stage("grouping"):
+        for path, all_duplicates in find_groups(graph, files_by_hash, FALSE_POSITIVES, clustering=clustering):
+            if changed is not None and path not in changed and changed.isdisjoint(all_duplicates):
+                # Already reported by a previous run
+                continue
+            metrics.increment('groups')
+            if sink is not None:
+                sink.write_group(make_record(metrics.counters['groups'], path, all_duplicates, hash_ids,
+                                             hashes_matrix, metadata, digests))
+            _handle_duplicates(result, path, all_duplicates, duplicates_folder, print_result, keep_result)
+    if duplicates_folder is not None:
+        # Keep the best image of each group and move the others to duplicates
+        not quiet and print_to_stdout("# Moving duplicates")
+        with metrics.stage("move"):
+            plan = _plan_moves(duplicates_folder, result.items(), metadata, ranking)
+            content_prefixes = _content_prefixes(files_by_hash, hash_strs, tag, plan)
+            digests.update(apply_plan(duplicates_folder, plan, metadata, workers=move_workers,
+                                      content_prefixes=content_prefixes))
+            metrics.increment('files_moved', sum(len(move.duplicates) for move in plan))
+    if db_path is not None and len(digests) > 0:
+        # Save the digests of the files that were not moved
+        tags = [algorithm_tag(decode_size, name) for name in (algorithm, confirm_algorithm) if name is not None]
+        with open_hash_store(db_path, backend=db_backend, flag='c') as db:
+            for path, sha256 in digests.items():
+                store_digest(db, path, sha256, tags)
+    if index is not None:
+        # Saved only once the groups are handled, so the groups of an interrupted run are reported again
+        index.close()
+    return result
+
+
+def _update_search_index(index, files_by_hash, hashes_matrix):
+    """
+    Synchronise a persisted search index with the scanned files.
+
+    :param index: Store.SearchIndexStore
+    :param files_by_hash: list with the files of each hash, indexed by hash id
+    :param hashes_matrix: packed hashes by hash id
+    :return: set of the new and changed paths
+    """
+    paths = [path for files in files_by_hash for path in files]
+    hash_ids = np.repeat(np.arange(len(files_by_hash)), [len(files) for files in files_by_hash])
+    return {paths[i] for i in index.update(paths, hashes_matrix[hash_ids])}
+
+
+def _changed_hash_ids(index, files_by_hash, hashes_matrix, changed, max_distance):
+    """
+    Find the hashes involved in a match with a changed file.
+
+    :param index: Store.SearchIndexStore, already updated
+    :param files_by_hash: list with the files of each hash, indexed by hash id
+    :param hashes_matrix: packed hashes by hash id
+    :param changed: set of the new and changed paths
+    :param max_distance: maximum number of different bits
+    :return: sorted list of the hash ids of the changed files and of their neighbours
+    """
+    hash_ids = {path: hash_id for hash_id, files in enumerate(files_by_hash) for path in files}
+    changed_ids = sorted({hash_ids[path] for path in changed})
+    selected = set(changed_ids)
+    for paths, _ in index.query(hashes_matrix[changed_ids], max_distance):
+        selected.update(hash_ids[path] for path in paths if path in hash_ids)
+    return sorted(selected)
+
+
+def _add_content_false_positives(false_positives, graph, files_by_hash, hash_strs, tag, metadata, digests):
+    """
+    Add to the false positives the pairs of files whose content ids are false positives.
+    Only the files of the hashes with a neighbour or with other files, and whose
+    perceptual hash starts a stored content id, are digested.
+
+    :param false_positives: map from path (or content id) to the set of its false positives, updated
+    :param graph: CSR adjacency matrix of the hashes
+    :param files_by_hash: list with the files of each hash, indexed by hash id
+    :param hash_strs: serialized hashes by hash id
+    :param tag: hash algorithm version of hash_strs
+    :param metadata: map from path to ImageMetadata, the cached digests are used
+    :param digests: map from path to sha256, the computed digests are added
+    :return:
+    """
+    prefixes = _false_positive_content_prefixes(false_positives)
+    if len(prefixes) == 0:
+        return
+    candidates = ((content_prefix(tag, hash_strs[hash_id]), path) for hash_id, files in enumerate(files_by_hash)
+                  if len(files) > 1 or graph.indptr[hash_id] != graph.indptr[hash_id + 1] for path in files)
+    for path, paths in _content_false_positives(false_positives, prefixes, candidates, metadata, digests).items():
+        false_positives.setdefault(path, set()).update(paths)
+
+
+def _false_positive_content_prefixes(false_positives):
+    """
+    :param false_positives: map from path (or content id) to the set of its false positives
+    :return: set of the HashCache.content_prefix of the stored content ids
+    """
+    return {key[:key.rindex(":") + 1] for key in false_positives if key.startswith(CONTENT_ID_PREFIX)}
+
+
+def _content_false_positives(false_positives, prefixes, candidates, metadata, digests):
+    """
+    Find the pairs of files whose content ids are false positives.
+
+    :param false_positives: map from path (or content id) to the set of its false positives
+    :param prefixes: see _false_positive_content_prefixes
+    :param candidates: iterable of 2-ples (HashCache.content_prefix, path),
+                       only the files whose prefix is in prefixes are digested
+    :param metadata: map from path to ImageMetadata, the cached digests are used
+    :param digests: map from path to sha256, the computed digests are added
+    :return: map from path to the set of its false positives
+    """
+    files_by_content = dict()
+    for prefix, path in candidates:
+        if prefix not in prefixes:
+            continue
+        try:
+            sha256 = get_sha256(path, metadata, digests)
+        except OSError:
             continue
-        # Get the false positives from this path
-        path_false_positives = []
-        if path in FALSE_POSITIVES:
-            path_false_positives = FALSE_POSITIVES[path]
-        hash = hashes_matrix[i]
-        all_duplicates = []
-        # Find similar hashes
-        similar = _find_similar_hashes(hash, ball_tree, threshold=threshold)
-        for index in similar:
-            # Add the paths for every matched hash
-            dup_hash = hashes_matrix[index]
-            dup_hash_str = _numpy_hash_to_str(dup_hash)
-            for match in hash_to_file[dup_hash_str]:
-                if match != path and match not in path_false_positives:
-                    all_duplicates.append(match)
-                    marked_duplicates[match] = True
-        # Print the results or move the duplicates
+        files_by_content.setdefault(prefix + sha256, []).append(path)
+    result = dict()
+    for key, paths in files_by_content.items():
+        for other_key in false_positives.get(key, ()):
+            for other_path in files_by_content.get(other_key, ()):
+                for path in paths:
+                    result.setdefault(path, set()).add(other_path)
+    return result
+
+
+def _content_prefixes(files_by_hash, hash_strs, tag, plan):
+    """
+    :return: map from the paths of a move plan to their HashCache.content_prefix
+    """
+    paths = {path for move in plan for path in [move.best] + [path for _, path in move.duplicates]}
+    return {path: content_prefix(tag, hash_strs[hash_id])
+            for hash_id, files in enumerate(files_by_hash) for path in files if path in paths}
+
+
+def find_exact(folder, recursive=True, false_positives_db_path=None, print_result=False, duplicates_folder=None,
+               quiet=False, file_filter=FILTER_NONE, move_workers=MOVE_WORKERS, sink=None, keep_result=True,
+               ranking=DEFAULT_RANKING, digests_db_path=None):
+    """
+    Find the byte-identical files in a folder, no image is decoded.
+    The file kept in each group is ranked from the image headers, the files that
+    are not readable images keep the order of the paths.
+    Only the false positives by path apply: the files of a group have the same
+    content id and a content id is never stored as a false positive of itself.
+
+    :param folder: Folder to look for images
+    :param recursive: true if should look under subfolders recursively
+    :param false_positives_db_path: db to load the false positives from
+    :param print_result: True if I should print the result to screen
+    :param duplicates_folder: folder where the duplicate files will be moved to
+    :param quiet: True if no output
+    :param file_filter: filter of the scanned files, one of Scanner.FILTERS
+    :param move_workers: number of groups of duplicates moved in parallel
+    :param sink: sink the groups are written to as soon as they are found, see Output.open_sink
+    :param keep_result: False not to keep the groups in the result (they are still kept to move them)
+    :param ranking: keys ranking the image kept in each group, see Ranking.RANK_KEYS
+    :param digests_db_path: Store.DigestStore caching the digests of the files, None not to cache them
+    :return: map from path to the list of its exact duplicates
+    """
+    not quiet and print_to_stdout("# Loading files")
+    result = dict()
+    if duplicates_folder is not None:
+        _prepare_duplicates_folder(duplicates_folder, false_positives_db_path, move_workers, quiet)
+    exclude_paths = () if duplicates_folder is None else (duplicates_folder,)
+    FALSE_POSITIVES = _load_false_positives(false_positives_db_path)
+    entries = scan(folder, recursive=recursive, file_filter=file_filter, exclude_paths=exclude_paths)
+    not quiet and print_to_stdout("# Marking duplicates")
+    keep_result = keep_result or duplicates_folder is not None
+    group_id = 0
+    exact_groups = _find_exact_groups(entries, digests_db_path)
+    for group in exact_groups:
+        path = group[0]
+        all_duplicates = [duplicate for duplicate in group[1:] if duplicate not in FALSE_POSITIVES.get(path, ())]
         if len(all_duplicates) > 0:
-            all_duplicates = sorted(all_duplicates)
-            result[path] = all_duplicates
-            if duplicates_folder is not None:
-                # Keep the file with higher size
-                # and move the other to duplicates
-                # Also save a file with original paths
-                _move_to_duplicates_folder(len(result), duplicates_folder, path, *all_duplicates)
-            elif print_result:
-                print("Duplicates found for %s" % path)
-                for dup in all_duplicates:
-                    print(dup)
-                print("========================")
+            group_id += 1
+            if sink is not None:
+                size = len(all_duplicates) + 1
+                sink.write_group(GroupRecord(group_id, path, all_duplicates, [[0] * size] * size,
+                                             [True] * len(all_duplicates)))
+            _handle_duplicates(result, path, all_duplicates, duplicates_folder, print_result, keep_result)
+    if duplicates_folder is not None:
+        apply_plan(duplicates_folder, _plan_moves(duplicates_folder, result.items(), ranking=ranking),
+                   workers=move_workers)
     return result
 
 
-def _move_to_duplicates_folder(id, folder, *all_paths):
+def _find_exact_groups(entries, digests_db_path):
+    if digests_db_path is None:
+        return find_exact_groups(entries)
+    with DigestStore(digests_db_path) as store:
+        return find_exact_groups(entries, store=store)
+
+
+def _prepare_duplicates_folder(duplicates_folder, false_positives_db_path, move_workers, quiet):
+    write_restore_info(duplicates_folder, false_positives_db_path)
+    # Complete the moves of an interrupted run before scanning the folder
+    resumed = resume_moves(duplicates_folder, workers=move_workers)
+    if resumed > 0:
+        not quiet and print_to_stdout("# Completed %d groups of an interrupted run" % resumed)
+
+
+def _handle_duplicates(result, path, all_duplicates, duplicates_folder, print_result, keep_result=True):
+    # Save the result, the duplicates are moved once all the groups are found
+    if keep_result:
+        result[path] = all_duplicates
+    if duplicates_folder is None and print_result:
+        print("Duplicates found for %s" % path)
+        for dup in all_duplicates:
+            print(dup)
+        print("========================")
+
+
+def _plan_moves(folder, groups, metadata=None, ranking=DEFAULT_RANKING):
     """
-    Keep the best image where it is and move all the others
-    to a subfolder. Save a file with the original paths.
+    Plan the moves of the duplicates: the best image of each group is
+    kept where it is and the others are moved to a subfolder.
+    All the images are ranked at once, from the metadata read while hashing.
 
-    :param id: unique id for the folder, used to avoid name clashing
     :param folder: folder where to move the files
-    :param all_paths: duplicate files, will move everything except the best file
-    :return: best path
-    """
-    # Consider a file only if it was not moved before
-    # Note: a file can be considered a duplicate of 2 different files
-    # i.e. a file can belong to two different clusters of duplicates
-    paths = list(filter(lambda path: os.path.exists(path), all_paths))
-    if len(paths) < 2:
-        return paths[0]
-    # Find the best image
-    best = _get_best_image(paths)
-    # Compute the best sha256
-    best_sha256 = compute_sha256(best)
-    # Create target folder and move the duplicates (except the best image)
-    best_name = os.path.basename(best)
-    subfolder_name = "%d_%s" % (id, best_name)
-    target_folder = os.path.join(folder, subfolder_name)
-    os.makedirs(target_folder, exist_ok=True)
-    # Create symlink to best image (use abs path)
-    best_link = os.path.join(target_folder, "0_%s" % best_name)
-    best_abspath = os.path.abspath(best)
-    os.symlink(best_abspath, best_link)
-    # Move files
-    duplicates = []
-    fileid = 1
-    for path in paths:
-        if path != best:
-            duplicate_sha256 = compute_sha256(path)
-            basename = os.path.basename(path)
-            target_name = "%d_%s" % (fileid, basename)
-            if duplicate_sha256 == best_sha256:
-                target_name = "%d_DUP_%s" % (fileid, basename)
-            target_path = os.path.join(target_folder, target_name)
-            duplicates.append((target_name, path))
-            shutil.move(path, target_path)
-            fileid += 1
-    write_info_file(target_folder, best_abspath, duplicates)
-    return best
-
-
-def _get_best_image(paths):
-    """
-    Return the best image.
-    We will return the image with the highest resolution.
-    In case of a tie PNG > ... > webp
-
-    :param paths:
-    :return: path of the best image
-    """
-    best = None
-    best_res = None
-    best_format = None
-    for path in paths:
-        with Image.open(path) as image:
-            _, resolution = image.size
-            img_format = image.format
-            if best is None or resolution > best_res or (resolution == best_res and \
-                                                         (image.format == 'PNG' or best_format == 'WEBP')):
-                best = path
-                best_res = resolution
-                best_format = img_format
-    return best
+    :param groups: iterator of 2-ples (path, duplicates) in result order
+    :param metadata: map from path to ImageMetadata read while hashing
+    :param ranking: keys ranking the image kept in each group, see Ranking.RANK_KEYS
+    :return: list of Mover.GroupMove
+    """
+    groups = [[path] + list(all_duplicates) for path, all_duplicates in groups]
+    existing = [path for path in dict.fromkeys(path for paths in groups for path in paths) if os.path.exists(path)]
+    ranks = rank_images(existing, metadata, ranking)
+    plan = []
+    moved = set()
+    kept = set()
+    for group_id, paths in enumerate(groups, start=1):
+        # Consider a file only if it was not moved before
+        # Note: a file can be considered a duplicate of 2 different files
+        # i.e. a file can belong to two different clusters of duplicates
+        paths = [path for path in paths if path not in moved and path in ranks]
+        if len(paths) < 2:
+            continue
+        # Find the best image
+        best = min(paths, key=ranks.__getitem__)
+        # The groups are moved in parallel: never move a file another group keeps
+        duplicates = [path for path in paths if path != best and path not in kept]
+        if len(duplicates) == 0:
+            continue
+        move = plan_group(group_id, folder, best, [best] + duplicates)
+        moved.update(duplicates)
+        kept.add(best)
+        plan.append(move)
+    return plan
+
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+
+from .Common import print_to_stdout
+
+# Seconds between two reports of the progress and of the metrics
+REPORT_INTERVAL = 5.0
+
+FORMAT_JSONL = "jsonl"
+FORMAT_PROMETHEUS = "prometheus"
+FORMATS = (FORMAT_JSONL, FORMAT_PROMETHEUS)
+
+# Prefix of the Prometheus metric names
+_PROMETHEUS_PREFIX = "dupimage_"
+
+
+class Metrics:
+    """
+    Counters, gauges, summaries and stage timers of a run.
+    The pipeline updates them on the caller thread, tick calls the reporters
+    (e.g. Progress, MetricsFile) at most every interval seconds.
+
+    Counters used by the pipeline:
+        files_scanned, cache_hits, cache_misses, hashes_computed, decode_failures, bytes_read
+    Gauges: pending_tasks and pending_files (in flight on the hashing engine), scan_complete.
+    Summaries: neighbours (number of neighbours of each hash).
+    """
+
+    def __init__(self, reporters=(), interval=REPORT_INTERVAL):
+        """
+        :param reporters: callables taking the Metrics, called by tick
+        :param interval: minimum seconds between two reports
+        """
+        self.reporters = list(reporters)
+        self.interval = interval
+        self.counters = dict()
+        self.gauges = dict()
+        self.summaries = dict()  # Map from name to [count, sum, max]
+        self.stages = dict()  # Map from stage to seconds
+        self.stage_name = None
+        self.stage_start = None
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, values):
+        """
+        Add values to a summary.
+
+        :param name:
+        :param values: integer array
+        :return:
+        """
+        values = np.asarray(values)
+        summary = self.summaries.setdefault(name, [0, 0, 0])
+        summary[0] += len(values)
+        summary[1] += int(np.sum(values))
+        summary[2] = max(summary[2], int(np.max(values, initial=0)))
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the run, the reporters are called when it ends.
+
+        :param name:
+        :return:
+        """
+        self.stage_name = name
+        self.stage_start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - self.stage_start
+            self.stage_name = None
+            self.tick(force=True)
+
+    def tick(self, force=False):
+        """
+        Call the reporters if interval seconds passed since the last report.
+
+        :param force: True to call them anyway
+        :return:
+        """
+        now = time.monotonic()
+        if len(self.reporters) == 0 or (not force and now - self.last_report < self.interval):
+            return
+        self.last_report = now
+        for reporter in self.reporters:
+            reporter(self)
+
+    def snapshot(self):
+        """
+        :return: JSON serialisable map with the current values
+        """
+        return {
+            'time': time.time(),
+            'elapsed': time.monotonic() - self.start,
+            'stage': self.stage_name,
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'summaries': {name: {'count': count, 'sum': total, 'max': maximum}
+                          for name, (count, total, maximum) in self.summaries.items()},
+            'stages': dict(self.stages),
+        }
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Progress:
+    """
+    Reporter printing the progress of the hashing with its rate and ETA.
+    The ETA is known once the scan is complete, until then the total is a lower bound.
+    """
+
+    def __init__(self, hand=None):
+        """
+        :param hand: file the progress is written to, None for the standard output
+                     (e.g. sys.stderr when the groups are written to the standard output)
+        """
+        self.hand = hand
+
+    def __call__(self, metrics):
+        if metrics.stage_name is None:
+            return
+        scanned = metrics.counters.get('files_scanned', 0)
+        done = metrics.counters.get('cache_hits', 0) + metrics.counters.get('hashes_computed', 0) + \
+            metrics.counters.get('decode_failures', 0)
+        elapsed = time.monotonic() - metrics.stage_start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        if metrics.gauges.get('scan_complete'):
+            eta = _format_duration((scanned - done) / rate) if rate > 0 else "?"
+            total = "%d" % scanned
+        else:
+            eta = "?"
+            total = "%d+" % scanned
+        text = "# %s: %d/%s files, %.1f files/s, ETA %s, elapsed %s" % \
+            (metrics.stage_name, done, total, rate, eta, _format_duration(elapsed))
+        if self.hand is None:
+            print_to_stdout(text)
+        else:
+            self.hand.write(text + "\n")
+            self.hand.flush()
+
+
+def _prometheus_name(name):
+    return _PROMETHEUS_PREFIX + name
+
+
+def format_prometheus(snapshot):
+    """
+    :param snapshot: see Metrics.snapshot
+    :return: the snapshot in the Prometheus text format
+    """
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append("# TYPE %s counter" % _prometheus_name(name + "_total"))
+        lines.append("%s %s" % (_prometheus_name(name + "_total"), value))
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append("# TYPE %s gauge" % _prometheus_name(name))
+        lines.append("%s %s" % (_prometheus_name(name), float(value)))
+    for name, summary in sorted(snapshot['summaries'].items()):
+        lines.append("# TYPE %s summary" % _prometheus_name(name))
+        lines.append("%s_count %d" % (_prometheus_name(name), summary['count']))
+        lines.append("%s_sum %d" % (_prometheus_name(name), summary['sum']))
+        lines.append("# TYPE %s gauge" % _prometheus_name(name + "_max"))
+        lines.append("%s %d" % (_prometheus_name(name + "_max"), summary['max']))
+    lines.append("# TYPE %s gauge" % _prometheus_name("stage_seconds"))
+    for stage, seconds in sorted(snapshot['stages'].items()):
+        lines.append('%s{stage="%s"} %f' % (_prometheus_name("stage_seconds"), stage, seconds))
+    lines.append("# TYPE %s gauge" % _prometheus_name("elapsed_seconds"))
+    lines.append("%s %f" % (_prometheus_name("elapsed_seconds"), snapshot['elapsed']))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsFile:
+    """
+    Reporter writing the metrics to a file: a JSON line is appended at every report,
+    or the file is replaced with the Prometheus text format (e.g. for the textfile
+    collector of the node exporter).
+    """
+
+    def __init__(self, path, file_format=None):
+        """
+        :param path:
+        :param file_format: one of FORMATS, FORMAT_PROMETHEUS for the .prom files and FORMAT_JSONL otherwise
+        """
+        if file_format is None:
+            file_format = FORMAT_PROMETHEUS if path.endswith(".prom") else FORMAT_JSONL
+        if file_format not in FORMATS:
+            raise ValueError("Unknown metrics format %s" % file_format)
+        self.path = path
+        self.file_format = file_format
+
+    def __call__(self, metrics):
+        snapshot = metrics.snapshot()
+        if self.file_format == FORMAT_JSONL:
+            with open(self.path, "a") as hand:
+                hand.write(json.dumps(snapshot) + "\n")
+            return
+        # Replace the file atomically, so a scrape never reads half of it
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as hand:
+            hand.write(format_prometheus(snapshot))
+        os.replace(tmp_path, self.path)
+
+
+@contextmanager
+def profile(path):
+    """
+    Profile the caller thread with cProfile, the statistics are saved for pstats
+    (e.g. python -m pstats path). Nothing is profiled if path is None.
+
+    :param path: file of the statistics, or None
+    :return:
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
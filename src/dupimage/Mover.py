@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import errno
+import json
+import os
+import shutil
+import concurrent.futures
+from collections import namedtuple
+
+from .Common import compute_sha256
+from .Common import write_info_file
+
+# Journal of the moves in progress, in the duplicates folder
+JOURNAL_FILE_NAME = ".moves-journal.jsonl"
+# Number of groups moved in parallel
+MOVE_WORKERS = 4
+
+# Planned move of a group of duplicates.
+# folder: subfolder of the duplicates folder
+# best: absolute path of the image kept in place
+# duplicates: list of 2-ples (file id, path) of the files to move
+GroupMove = namedtuple('GroupMove', ['folder', 'best', 'duplicates'])
+
+
+def plan_group(group_id, folder, best, paths):
+    """
+    Plan the move of a group of duplicates.
+
+    :param group_id: unique id for the group, used to avoid name clashing
+    :param folder: duplicates folder
+    :param best: path of the image kept in place
+    :param paths: all the paths of the group, best included
+    :return: GroupMove
+    """
+    best_name = os.path.basename(best)
+    target_folder = os.path.join(folder, "%d_%s" % (group_id, best_name))
+    duplicates = [path for path in paths if path != best]
+    return GroupMove(target_folder, os.path.abspath(best), list(enumerate(duplicates, start=1)))
+
+
+def next_group_id(folder):
+    """
+    :param folder: duplicates folder
+    :return: id following the largest one of the group folders (<id>_<name>), 1 if there is none
+    """
+    group_ids = [0]
+    with os.scandir(folder) as iterator:
+        for entry in iterator:
+            prefix, separator, _ = entry.name.partition("_")
+            if separator and prefix.isdigit() and entry.is_dir():
+                group_ids.append(int(prefix))
+    return max(group_ids) + 1
+
+
+def _move_file(source, target):
+    try:
+        # Fast path, a single metadata operation on the same filesystem
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, target)
+
+
+def get_sha256(path, metadata, digests):
+    """
+    Return the sha256 of a file, computing it only if it is not known yet.
+
+    :param path:
+    :param metadata: map from path to HashCache.ImageMetadata
+    :param digests: map from path to the sha256 computed in this run, updated
+    :return:
+    """
+    if path in digests:
+        return digests[path]
+    info = metadata.get(path)
+    if info is not None and info.sha256 is not None:
+        return info.sha256
+    digests[path] = compute_sha256(path)
+    return digests[path]
+
+
+def apply_group(move, metadata=None, digests=None, content_prefixes=None):
+    """
+    Move a group of duplicates: symlink the best image, move the others and
+    write the info file. A group partially moved by an interrupted run is completed.
+
+    :param move: GroupMove
+    :param metadata: map from path to HashCache.ImageMetadata
+    :param digests: map from path to sha256, the computed digests are added
+    :param content_prefixes: map from path to HashCache.content_prefix, the content ids
+                             of the files are written to the info file
+    :return:
+    """
+    metadata = dict() if metadata is None else metadata
+    digests = dict() if digests is None else digests
+    os.makedirs(move.folder, exist_ok=True)
+    best_name = os.path.basename(move.best)
+    best_link = os.path.join(move.folder, "0_%s" % best_name)
+    if not os.path.lexists(best_link):
+        os.symlink(move.best, best_link)
+    content_prefixes = dict() if content_prefixes is None else content_prefixes
+    best_sha256 = get_sha256(move.best, metadata, digests)
+    sha256s = {move.best: best_sha256}
+    duplicates = []
+    for fileid, path in move.duplicates:
+        basename = os.path.basename(path)
+        names = ["%d_DUP_%s" % (fileid, basename), "%d_%s" % (fileid, basename)]
+        if not os.path.exists(path):
+            # Moved before the interruption
+            moved = [name for name in names if os.path.lexists(os.path.join(move.folder, name))]
+            duplicates.extend((name, path) for name in moved[:1])
+            continue
+        sha256s[path] = get_sha256(path, metadata, digests)
+        target_name = names[0] if sha256s[path] == best_sha256 else names[1]
+        _move_file(path, os.path.join(move.folder, target_name))
+        duplicates.append((target_name, path))
+    content_ids = {path: content_prefixes[path] + sha256 for path, sha256 in sha256s.items()
+                   if path in content_prefixes}
+    write_info_file(move.folder, move.best, duplicates, content_ids)
+
+
+def _journal_path(folder):
+    return os.path.join(folder, JOURNAL_FILE_NAME)
+
+
+def _write_journal_line(hand, data):
+    hand.write(json.dumps(data) + "\n")
+    hand.flush()
+
+
+def apply_plan(folder, plan, metadata=None, workers=MOVE_WORKERS, done=None, content_prefixes=None):
+    """
+    Apply a move plan on a pool of workers.
+    The plan and the completed groups are written to a journal in the duplicates folder,
+    the journal is removed when all the groups are moved.
+
+    :param folder: duplicates folder
+    :param plan: list of GroupMove
+    :param metadata: map from path to HashCache.ImageMetadata
+    :param workers: number of groups moved in parallel
+    :param done: indexes of the groups already moved, when resuming an interrupted run
+    :param content_prefixes: map from path to HashCache.content_prefix, see apply_group
+    :return: map from path to the sha256 computed while moving
+    """
+    digests = dict()
+    journal_path = _journal_path(folder)
+    if len(plan) == 0 and done is None:
+        return digests
+    os.makedirs(folder, exist_ok=True)
+    with open(journal_path, "a") as journal:
+        if done is None:
+            _write_journal_line(journal, {'plan': [move._asdict() for move in plan]})
+            done = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(apply_group, move, metadata, digests, content_prefixes): i
+                       for i, move in enumerate(plan) if i not in done}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                _write_journal_line(journal, {'done': futures[future]})
+    os.remove(journal_path)
+    return digests
+
+
+def read_journal(folder):
+    """
+    Read the journal of an interrupted run.
+
+    :param folder: duplicates folder
+    :return: 2-ple (plan, done), None if there is no journal
+    """
+    journal_path = _journal_path(folder)
+    if not os.path.exists(journal_path):
+        return None
+    plan = []
+    done = set()
+    with open(journal_path) as hand:
+        for line in hand:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                # Last line truncated by the interruption
+                continue
+            if 'plan' in data:
+                plan = [GroupMove(move['folder'], move['best'], [tuple(duplicate) for duplicate in move['duplicates']])
+                        for move in data['plan']]
+            elif 'done' in data:
+                done.add(data['done'])
+    return plan, done
+
+
+def resume_moves(folder, workers=MOVE_WORKERS):
+    """
+    Complete the moves of an interrupted run.
+
+    :param folder: duplicates folder
+    :param workers: number of groups moved in parallel
+    :return: number of groups moved, 0 if there was nothing to resume
+    """
+    journal = read_journal(folder)
+    if journal is None:
+        return 0
+    plan, done = journal
+    apply_plan(folder, plan, workers=workers, done=done)
+    return len(plan) - len(done)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from .Mover import get_sha256
+from .Search import hamming_distances
+
+FORMAT_JSONL = "jsonl"
+FORMAT_CSV = "csv"
+FORMATS = (FORMAT_JSONL, FORMAT_CSV)
+
+# Path of the standard output for open_sink
+STDOUT = "-"
+
+# A group of duplicates as it is written by the sinks.
+# group_id matches the numbering of the duplicates folder, anchor is the file the others were matched to,
+# distances is the matrix of the hash distances of [anchor] + members, exact tells for each member
+# whether it is byte-identical to the anchor.
+GroupRecord = namedtuple('GroupRecord', ['group_id', 'anchor', 'members', 'distances', 'exact'])
+
+_CSV_HEADER = ('group', 'anchor', 'member', 'distance', 'exact')
+
+
+class JsonlSink:
+    """
+    Write each group as a JSON line as soon as it is found.
+    """
+
+    def __init__(self, hand):
+        self.hand = hand
+
+    def write_group(self, record):
+        self.hand.write(json.dumps({'group': record.group_id, 'anchor': record.anchor,
+                                    'members': record.members, 'distances': record.distances,
+                                    'exact': record.exact}) + "\n")
+        self.hand.flush()
+
+
+class CsvSink:
+    """
+    Write a CSV row for each member of a group as soon as the group is found,
+    with its distance from the anchor.
+    """
+
+    def __init__(self, hand):
+        self.hand = hand
+        self.writer = csv.writer(hand)
+        self.writer.writerow(_CSV_HEADER)
+
+    def write_group(self, record):
+        for i, member in enumerate(record.members, start=1):
+            self.writer.writerow((record.group_id, record.anchor, member, record.distances[0][i],
+                                  int(record.exact[i - 1])))
+        self.hand.flush()
+
+
+class open_sink:
+    """
+    Open a sink for the groups of duplicates, use as a context manager.
+    """
+
+    def __init__(self, path, file_format=None):
+        """
+        :param path: output file, STDOUT for the standard output
+        :param file_format: one of FORMATS, FORMAT_CSV for the .csv files and FORMAT_JSONL otherwise
+        """
+        if file_format is None:
+            file_format = FORMAT_CSV if path.endswith(".csv") else FORMAT_JSONL
+        if file_format not in FORMATS:
+            raise ValueError("Unknown output format %s" % file_format)
+        self.path = path
+        self.file_format = file_format
+        self.hand = None
+
+    def __enter__(self):
+        if self.path == STDOUT:
+            self.hand = sys.stdout
+        else:
+            self.hand = open(self.path, "w", newline="")
+        return JsonlSink(self.hand) if self.file_format == FORMAT_JSONL else CsvSink(self.hand)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.hand is not sys.stdout:
+            self.hand.close()
+
+
+def _is_exact(anchor, member, metadata, digests):
+    """
+    :return: True if two files with the same hash are byte-identical, only the files
+             with the same size are digested
+    """
+    anchor_info = metadata.get(anchor)
+    member_info = metadata.get(member)
+    if anchor_info is not None and member_info is not None and anchor_info.size != member_info.size:
+        return False
+    try:
+        return get_sha256(anchor, metadata, digests) == get_sha256(member, metadata, digests)
+    except OSError:
+        return False
+
+
+def make_record(group_id, anchor, members, hash_ids, hashes_matrix, metadata, digests):
+    """
+    Describe a group of duplicates.
+
+    :param group_id:
+    :param anchor: path
+    :param members: list of paths
+    :param hash_ids: map from path to hash id
+    :param hashes_matrix: packed hashes by hash id
+    :param metadata: map from path to ImageMetadata, the cached digests are used
+    :param digests: map from path to sha256, the computed digests are added
+    :return: GroupRecord
+    """
+    ids = [hash_ids[path] for path in [anchor] + list(members)]
+    packed = hashes_matrix[ids]
+    distances = hamming_distances(packed, packed).astype(np.int64).tolist()
+    exact = [distances[0][i] == 0 and _is_exact(anchor, member, metadata, digests)
+             for i, member in enumerate(members, start=1)]
+    return GroupRecord(group_id, anchor, list(members), distances, exact)
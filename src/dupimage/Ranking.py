@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from PIL import Image
+
+from .HashCache import ImageMetadata
+
+# Ranking keys, a higher value is better unless the key is prefixed by REVERSE_PREFIX
+RANK_PIXELS = "pixels"
+RANK_SIZE = "size"
+RANK_FORMAT = "format"
+RANK_BIT_DEPTH = "bit_depth"
+RANK_EXIF = "exif"
+RANK_MTIME = "mtime"
+RANK_KEYS = (RANK_PIXELS, RANK_SIZE, RANK_FORMAT, RANK_BIT_DEPTH, RANK_EXIF, RANK_MTIME)
+# e.g. "-mtime" prefers the oldest file
+REVERSE_PREFIX = "-"
+
+# Best image first: the largest one, lossless formats on a tie
+DEFAULT_RANKING = (RANK_PIXELS, RANK_FORMAT, RANK_BIT_DEPTH, RANK_SIZE)
+
+# Formats from the best to the worst, the formats not listed come after them
+FORMAT_PRIORITY = ("PNG", "TIFF", "BMP", "JPEG", "GIF", "WEBP")
+
+# Bits per pixel of the PIL modes, the other modes count 8 bits per band
+_MODE_BITS = {'1': 1, 'P': 8, 'PA': 16, 'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'I': 32, 'F': 32}
+
+
+def image_info(image):
+    """
+    :param image: PIL image, the pixels are not decoded
+    :return: 5-ple (width, height, format, bits per pixel, True if the image has EXIF data)
+    """
+    bits = _MODE_BITS.get(image.mode, 8 * len(image.getbands()))
+    return image.size[0], image.size[1], image.format, bits, 'exif' in image.info
+
+
+def parse_ranking(text):
+    """
+    :param text: comma separated ranking keys, e.g. "pixels,format,-mtime"
+    :return: tuple of ranking keys
+    """
+    ranking = tuple(key.strip() for key in text.split(",") if key.strip() != "")
+    for key in ranking:
+        if key.lstrip(REVERSE_PREFIX) not in RANK_KEYS:
+            raise ValueError("Unknown ranking key %s, use one of %s" % (key, ", ".join(RANK_KEYS)))
+    return ranking
+
+
+def _read_metadata(path):
+    """
+    Metadata of an image that was not cached while hashing.
+    Only the size and the modification time are known for the files that are not readable images.
+
+    :param path:
+    :return: HashCache.ImageMetadata
+    """
+    stat = os.stat(path)
+    try:
+        with Image.open(path) as image:
+            width, height, image_format, bits, exif = image_info(image)
+    except (OSError, SyntaxError, ValueError):
+        # Not an image, or a truncated or corrupt one
+        width, height, image_format, bits, exif = None, None, None, None, None
+    return ImageMetadata(width, height, image_format, stat.st_size, None, bits, exif, stat.st_mtime_ns)
+
+
+def _key_column(key, infos):
+    """
+    :param key: one of RANK_KEYS
+    :param infos: list of ImageMetadata
+    :return: 2-ple of arrays (int64 values, higher is better; True where the value is unknown)
+    """
+    if key == RANK_PIXELS:
+        values = [None if info.width is None else info.width * info.height for info in infos]
+    elif key == RANK_SIZE:
+        values = [info.size for info in infos]
+    elif key == RANK_FORMAT:
+        priorities = {image_format: len(FORMAT_PRIORITY) - i for i, image_format in enumerate(FORMAT_PRIORITY)}
+        values = [priorities.get(info.format, 0) for info in infos]
+    elif key == RANK_BIT_DEPTH:
+        values = [info.bits for info in infos]
+    elif key == RANK_EXIF:
+        values = [None if info.exif is None else int(info.exif) for info in infos]
+    elif key == RANK_MTIME:
+        values = [info.mtime_ns for info in infos]
+    else:
+        raise ValueError("Unknown ranking key %s" % key)
+    unknown = np.array([value is None for value in values], dtype=bool)
+    return np.array([0 if value is None else value for value in values], dtype=np.int64), unknown
+
+
+def rank_images(paths, metadata=None, ranking=DEFAULT_RANKING):
+    """
+    Rank images with a single sort over the metadata read while hashing,
+    only the images without metadata are opened.
+    Images that are equal for every key keep the order of paths.
+
+    :param paths: list of distinct paths, e.g. all the files of all the groups
+    :param metadata: map from path to HashCache.ImageMetadata
+    :param ranking: ranking keys from the most to the least important, see RANK_KEYS
+    :return: map from path to its rank, 0 for the best image
+    """
+    metadata = dict() if metadata is None else metadata
+    infos = [metadata.get(path) or _read_metadata(path) for path in paths]
+    keys = [np.arange(len(paths))]  # Last resort, the order of the paths
+    for key in reversed(ranking):
+        column, unknown = _key_column(key.lstrip(REVERSE_PREFIX), infos)
+        # lexsort is ascending and its last key is the primary one: the better values come first
+        column = column if key.startswith(REVERSE_PREFIX) else -column
+        column[unknown] = np.iinfo(np.int64).max
+        keys.append(column)
+    order = np.lexsort(keys)
+    ranks = np.empty(len(paths), dtype=np.int64)
+    ranks[order] = np.arange(len(paths))
+    return dict(zip(paths, ranks.tolist()))
+
+
+def best_images(groups, metadata=None, ranking=DEFAULT_RANKING):
+    """
+    Pick the image to keep in every group, all the groups are ranked at once.
+
+    :param groups: list of lists of paths
+    :param metadata: map from path to HashCache.ImageMetadata
+    :param ranking: see rank_images
+    :return: list with the best path of each group
+    """
+    paths = list(dict.fromkeys(path for group in groups for path in group))
+    ranks = rank_images(paths, metadata, ranking)
+    return [min(group, key=ranks.__getitem__) for group in groups]
@@ -2,25 +2,27 @@
 
 import shutil
 import os
+from itertools import combinations
 
 from .Common import read_info_file
+from .Common import read_content_ids
 from .Common import read_restore_info
 from .Common import remove_info_file
 from .Common import iter_folder
-from .Common import open_shelve_db
+from .Store import open_false_positives_store
 from .Common import INFO_FILE_NAME
 
 
-def _save_false_positives(false_positives_db, false_positives_map):
-    with open_shelve_db(false_positives_db, writeback=True) as db:
-        for path in false_positives_map:
-            elements = db.get(path)
-            if elements is None:
-                elements = []
-                db[path] = elements
-            for false_positive in false_positives_map[path]:
-                if false_positive not in elements:
-                    elements.append(false_positive)
+def _save_false_positives(false_positives_db, groups):
+    """
+    Merge the restored groups in the false positives store.
+
+    :param false_positives_db:
+    :param groups: list of lists of paths or content ids, the elements of a group are not duplicates of each other
+    :return:
+    """
+    with open_false_positives_store(false_positives_db) as store:
+        store.add_pairs(pair for paths in groups for pair in combinations(paths, 2))
 
 
 def _get_original_symlink(path):
@@ -32,25 +34,8 @@ def _get_original_symlink(path):
     return original_symlink
 
 
-def _append_false_positives(false_positives_map, paths):
-    """
-    Append to the false_positives_map
-    :param false_positives_map:
-    :param paths:
-    :return:
-    """
-    # Must have at least 2 elements
-    if len(paths) <= 1:
-        return
-    for path in paths:
-        false_positives_map[path] = []
-        for false_path in paths:
-            if false_path != path:
-                false_positives_map[path].append(false_path)
-
-
 def restore(duplicates_path):
-    false_positives_map = {}
+    false_positives_groups = []
     empty_folders = []
     for path in iter_folder(duplicates_path):
         if not os.path.isdir(path):
@@ -59,6 +44,7 @@ def restore(duplicates_path):
         if info_file is None:
             continue
         basefile, duplicates = info_file
+        content_ids = read_content_ids(path)
         false_positives = [basefile]
         for name, dest_path in duplicates:
             src_path = os.path.join(path, name)
@@ -66,8 +52,14 @@ def restore(duplicates_path):
                 continue
             shutil.move(src_path, dest_path)
             false_positives.append(dest_path)
-        # Save the false positives
-        _append_false_positives(false_positives_map, false_positives)
+        # Save the false positives, a group must have at least 2 elements
+        if len(false_positives) > 1:
+            false_positives_groups.append(false_positives)
+            # Also by content, so the false positives survive renames and moves
+            false_positives_ids = [content_ids[false_positive] for false_positive in false_positives
+                                   if false_positive in content_ids]
+            if len(false_positives_ids) > 1:
+                false_positives_groups.append(false_positives_ids)
         # Remove original locations file
         remove_info_file(path)
         # Remove original symlink
@@ -81,9 +73,9 @@ def restore(duplicates_path):
         os.rmdir(path)
     # Store the false positives if possible
     restore_info = read_restore_info(duplicates_path)
-    if restore_info is not None and len(false_positives_map) > 0:
+    if restore_info is not None and len(false_positives_groups) > 0:
         false_positives_db_path = restore_info
-        _save_false_positives(false_positives_db_path, false_positives_map)
+        _save_false_positives(false_positives_db_path, false_positives_groups)
     # Cleanup
     rem_files = list(iter_folder(duplicates_path))
     if len(rem_files) == 1 and os.path.isfile(rem_files[0]):
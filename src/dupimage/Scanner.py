@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import concurrent.futures
+from collections import deque
+from collections import namedtuple
+from functools import lru_cache
+from functools import partial
+from PIL import Image
+
+from .Common import PERSISTENCE_FOLDER_NAME
+
+FILTER_NONE = "none"
+FILTER_EXTENSION = "extension"
+FILTER_MAGIC = "magic"
+FILTERS = (FILTER_NONE, FILTER_EXTENSION, FILTER_MAGIC)
+
+# Number of threads listing the directories, the scan is I/O bound
+SCAN_WORKERS = 8
+# Number of directories listed in parallel per thread
+MAX_PENDING_DIRECTORIES_PER_WORKER = 2
+
+# Directory names never scanned
+DEFAULT_EXCLUDE_NAMES = (PERSISTENCE_FOLDER_NAME,)
+
+# Number of bytes read to check the magic number of a file
+_MAGIC_SIZE = 12
+_MAGIC_NUMBERS = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG\r\n\x1a\n',
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',
+    b'II*\x00',  # TIFF, little endian
+    b'MM\x00*',  # TIFF, big endian
+    b'\x00\x00\x01\x00',  # ICO
+    b'\x00\x00\x00\x0cjP  ',  # JPEG 2000
+    b'\xff\x4f\xff\x51',  # JPEG 2000 codestream
+    b'8BPS',  # PSD
+    b'P1', b'P2', b'P3', b'P4', b'P5', b'P6',  # PBM, PGM, PPM
+)
+
+# A scanned file, stat is the os.stat_result read while listing the directory
+ScanEntry = namedtuple('ScanEntry', ['path', 'stat'])
+
+
+@lru_cache(maxsize=None)
+def _image_extensions():
+    return frozenset(extension.lower() for extension in Image.registered_extensions())
+
+
+def _has_image_magic(path):
+    try:
+        with open(path, "rb") as hand:
+            header = hand.read(_MAGIC_SIZE)
+    except OSError:
+        return False
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return True
+    return header.startswith(_MAGIC_NUMBERS)
+
+
+def accept_path(path, file_filter):
+    """
+    :param path: path of a file
+    :param file_filter: one of FILTERS
+    :return: True if the file passes the filter
+    """
+    if file_filter == FILTER_EXTENSION:
+        return os.path.splitext(path)[1].lower() in _image_extensions()
+    elif file_filter == FILTER_MAGIC:
+        return _has_image_magic(path)
+    return True
+
+
+def _scan_directory(path, recursive, file_filter, exclude_names, exclude_paths):
+    """
+    List a directory.
+    The DirEntry type information avoids a stat call per entry to tell files from
+    directories, the stat of the files is read once and sent along with the path.
+
+    :return: 2-ple (files, subfolders), files is a list of ScanEntry
+    """
+    files = []
+    subfolders = []
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and entry.name not in exclude_names and entry.path not in exclude_paths:
+                            subfolders.append(entry.path)
+                    elif entry.is_file() and accept_path(entry.path, file_filter):
+                        files.append(ScanEntry(entry.path, entry.stat()))
+                except OSError:
+                    # The entry was removed or cannot be read
+                    continue
+    except OSError:
+        pass
+    return files, subfolders
+
+
+def scan(folder, recursive=True, file_filter=FILTER_NONE, exclude_names=DEFAULT_EXCLUDE_NAMES, exclude_paths=(),
+         workers=SCAN_WORKERS):
+    """
+    Scan a folder for image files.
+    The directories are listed in parallel and the files are returned
+    as soon as their directory is listed.
+
+    :param folder:
+    :param recursive: True to scan the subfolders
+    :param file_filter: one of FILTERS, FILTER_EXTENSION keeps the extensions known by PIL,
+                        FILTER_MAGIC reads the first bytes of the files
+    :param exclude_names: names of the directories to skip
+    :param exclude_paths: paths of the directories to skip
+    :param workers: number of threads listing the directories
+    :return: iterator of ScanEntry with absolute paths, in no particular order
+    """
+    if file_filter not in FILTERS:
+        raise ValueError("Unknown filter %s" % file_filter)
+    task = partial(_scan_directory, recursive=recursive, file_filter=file_filter,
+                   exclude_names=frozenset(exclude_names),
+                   exclude_paths=frozenset(os.path.abspath(path) for path in exclude_paths))
+    folders = deque([os.path.abspath(folder)])
+    max_pending = workers * MAX_PENDING_DIRECTORIES_PER_WORKER
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(folders) > 0 or len(pending) > 0:
+            while len(folders) > 0 and len(pending) < max_pending:
+                pending.add(executor.submit(task, folders.popleft()))
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                folders.extend(subfolders)
+                yield from files
+
+
+def scan_paths(folder, recursive=True, **kwargs):
+    """
+    Same as scan, return only the paths.
+    """
+    for entry in scan(folder, recursive=recursive, **kwargs):
+        yield entry.path
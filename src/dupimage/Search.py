@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+
+from itertools import combinations
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+INDEX_POPCOUNT = "popcount"
+INDEX_BALLTREE = "balltree"
+INDEX_MIH = "mih"
+INDEXES = (INDEX_POPCOUNT, INDEX_BALLTREE, INDEX_MIH)
+
+# Number of hashes compared at once by the blocked searches.
+# A block of needles against a block of hashes XORs BLOCK_SIZE^2 uint64 words per word of the hashes,
+# i.e. 8 * BLOCK_SIZE^2 bytes (32 MiB), plus BLOCK_SIZE^2 uint8 bit counts per word and uint16 distances.
+BLOCK_SIZE = 2048
+
+# Minimum number of bits of a multi-index hashing substring
+MIH_MIN_SUBSTRING_BITS = 16
+# Maximum number of hashes added to a multi-index hashing index and searched by brute force
+# before they are merged in the tables
+MIH_MERGE_SIZE = 4096
+# Substrings up to this length are looked up with a direct address table (2^length entries)
+MIH_DIRECT_BITS = 24
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def threshold_to_distance(threshold, n_bits):
+    """
+    Convert a similarity threshold (fraction of different bits, as used by
+    the hamming metric) to a maximum number of different bits.
+
+    :param threshold:
+    :param n_bits: number of bits of the hashes
+    :return:
+    """
+    return int(np.floor(threshold * n_bits + 1e-9))
+
+
+def _n_words(n_bits):
+    return max(1, (n_bits + 63) // 64)
+
+
+def pack_hashes(bool_matrix):
+    """
+    Pack a boolean hash matrix (one hash per row) in uint64 words.
+    The bits are right aligned, so a 64 bit hash is packed in a single
+    word equal to the integer value of its hex string.
+
+    :param bool_matrix: array with shape (n_samples, n_bits)
+    :return: uint64 array with shape (n_samples, n_words)
+    """
+    n_samples, n_bits = bool_matrix.shape
+    n_words = _n_words(n_bits)
+    padded = np.zeros((n_samples, n_words * 64), dtype=bool)
+    padded[:, n_words * 64 - n_bits:] = bool_matrix
+    return np.packbits(padded, axis=1).view('>u8').astype(np.uint64)
+
+
+def unpack_hashes(packed, n_bits):
+    """
+    Inverse of pack_hashes.
+
+    :param packed: uint64 array with shape (n_samples, n_words)
+    :param n_bits: number of bits of the hashes
+    :return: bool array with shape (n_samples, n_bits)
+    """
+    bits = np.unpackbits(packed.astype('>u8').view(np.uint8), axis=1)
+    return bits[:, bits.shape[1] - n_bits:].astype(bool)
+
+
+def hex_to_packed(hash_strs, n_bits):
+    """
+    Pack serialized hashes (hex strings) in uint64 words, see pack_hashes.
+
+    :param hash_strs: list of hex strings
+    :param n_bits: number of bits of the hashes
+    :return: uint64 array with shape (n_samples, n_words)
+    """
+    n_words = _n_words(n_bits)
+    width = n_words * 16
+    buffer = "".join(hash_str.zfill(width) for hash_str in hash_strs)
+    packed = np.frombuffer(bytes.fromhex(buffer), dtype='>u8').astype(np.uint64)
+    return packed.reshape(len(hash_strs), n_words)
+
+
+def bytes_to_packed(matrix, n_bits):
+    """
+    Pack a uint8 hash matrix (one right aligned hash per row, see Store.HashStore.load_matrix)
+    in uint64 words, see pack_hashes.
+
+    :param matrix: uint8 array with shape (n_samples, n_bytes)
+    :param n_bits: number of bits of the hashes
+    :return: uint64 array with shape (n_samples, n_words)
+    """
+    n_bytes = _n_words(n_bits) * 8
+    width = min(matrix.shape[1], n_bytes)
+    padded = np.zeros((matrix.shape[0], n_bytes), dtype=np.uint8)
+    padded[:, n_bytes - width:] = matrix[:, matrix.shape[1] - width:]
+    return padded.view('>u8').astype(np.uint64)
+
+
+def packed_to_hex(row, n_bits):
+    """
+    Serialize a packed hash as the hex string used by imagehash.
+
+    :param row: uint64 array with shape (n_words,)
+    :param n_bits: number of bits of the hash
+    :return:
+    """
+    width = (n_bits + 3) // 4
+    return "".join("%016x" % word for word in row)[-width:]
+
+
+def popcount(words):
+    """
+    Count the bits set in each element of a uint64 array.
+
+    :param words:
+    :return: array of counts with the same shape
+    """
+    if hasattr(np, 'bitwise_count'):
+        # numpy >= 2.0
+        return np.bitwise_count(words)
+    counts = _POPCOUNT_TABLE[words.view(np.uint8)]
+    return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_distances(needles, packed):
+    """
+    Hamming distances between two sets of packed hashes.
+
+    :param needles: uint64 array with shape (n_needles, n_words)
+    :param packed: uint64 array with shape (n_samples, n_words)
+    :return: array with shape (n_needles, n_samples)
+    """
+    xor = np.bitwise_xor(needles[:, None, :], packed[None, :, :])
+    return popcount(xor).sum(axis=2, dtype=np.uint16)
+
+
+def pair_distances(first, second):
+    """
+    Hamming distances between pairs of packed hashes.
+
+    :param first: uint64 array with shape (n_pairs, n_words)
+    :param second: uint64 array with shape (n_pairs, n_words)
+    :return: array with shape (n_pairs,)
+    """
+    return popcount(np.bitwise_xor(first, second)).sum(axis=1, dtype=np.uint16)
+
+
+def _iter_pairs_by_query(index, max_distance):
+    """
+    All-pairs search running query_radius on blocks of the indexed hashes.
+
+    :param index:
+    :param max_distance: maximum number of different bits
+    :return: iterator of 3-ples of arrays (rows, cols, distances) with rows < cols
+    """
+    for start in range(0, len(index), BLOCK_SIZE):
+        needles = index.packed[start:min(start + BLOCK_SIZE, len(index))]
+        matches = index.query_radius(needles, max_distance)
+        rows = np.repeat(np.arange(start, start + len(needles)), [len(cols) for cols in matches])
+        cols = np.concatenate(matches).astype(np.int64) if len(matches) > 0 else np.zeros(0, dtype=np.int64)
+        upper = rows < cols
+        rows = rows[upper]
+        cols = cols[upper]
+        yield rows, cols, pair_distances(index.packed[rows], index.packed[cols])
+
+
+def _brute_force_matches(needles, packed, max_distance):
+    """
+    Compare every needle with every hash.
+
+    :return: 2-ple of arrays (needle indexes, hash indexes) of the matches
+    """
+    needle_indexes = [np.zeros(0, dtype=np.int64)]
+    indexes = [np.zeros(0, dtype=np.int64)]
+    for offset in range(0, len(packed), BLOCK_SIZE):
+        distances = hamming_distances(needles, packed[offset:offset + BLOCK_SIZE])
+        rows, cols = np.nonzero(distances <= max_distance)
+        needle_indexes.append(rows)
+        indexes.append(cols + offset)
+    return np.concatenate(needle_indexes), np.concatenate(indexes)
+
+
+class PopcountIndex:
+    """
+    Brute force search over packed hashes using vectorised XOR + popcount.
+    Uses 8 bytes per 64 bit hash.
+    """
+
+    def __init__(self, packed, n_bits):
+        self.packed = packed
+        self.n_bits = n_bits
+
+    def __len__(self):
+        return len(self.packed)
+
+    def query_radius(self, needles, max_distance):
+        """
+        Find the hashes within a distance from each needle.
+
+        :param needles: uint64 array with shape (n_needles, n_words)
+        :param max_distance: maximum number of different bits
+        :return: list with an array of indexes for each needle
+        """
+        result = []
+        for start in range(0, len(needles), BLOCK_SIZE):
+            block = needles[start:start + BLOCK_SIZE]
+            rows, cols = _brute_force_matches(block, self.packed, max_distance)
+            # Group the matches by needle
+            order = np.argsort(rows, kind='stable')
+            counts = np.bincount(rows, minlength=len(block))
+            result.extend(np.split(cols[order], np.cumsum(counts)[:-1]))
+        return result
+
+    def iter_pairs(self, max_distance):
+        """
+        Blocked all-pairs search.
+
+        :param max_distance: maximum number of different bits
+        :return: iterator of 3-ples of arrays (rows, cols, distances) with rows < cols
+        """
+        n_samples = len(self.packed)
+        for start in range(0, n_samples, BLOCK_SIZE):
+            block = self.packed[start:start + BLOCK_SIZE]
+            # Only the blocks on and above the diagonal are compared
+            for offset in range(start, n_samples, BLOCK_SIZE):
+                distances = hamming_distances(block, self.packed[offset:offset + BLOCK_SIZE])
+                rows, cols = np.nonzero(distances <= max_distance)
+                rows = rows + start
+                cols = cols + offset
+                upper = rows < cols
+                yield rows[upper], cols[upper], distances[rows[upper] - start, cols[upper] - offset]
+
+
+class BallTreeIndex:
+    """
+    Search with a scikit-learn BallTree over the unpacked hashes.
+    scikit-learn is imported only when this index is used.
+    """
+
+    def __init__(self, packed, n_bits):
+        from sklearn.neighbors import BallTree
+        self.n_bits = n_bits
+        self.packed = packed
+        self.tree = BallTree(unpack_hashes(packed, n_bits), metric='hamming')
+
+    def __len__(self):
+        return len(self.packed)
+
+    def query_radius(self, needles, max_distance):
+        return list(self.tree.query_radius(unpack_hashes(needles, self.n_bits), max_distance / self.n_bits))
+
+    def iter_pairs(self, max_distance):
+        return _iter_pairs_by_query(self, max_distance)
+
+
+def _extract_bits(packed, start, length):
+    """
+    Extract a substring of bits from packed hashes.
+
+    :param packed: uint64 array with shape (n_samples, n_words)
+    :param start: position of the first bit, counting from the most significant bit of the first word
+    :param length: number of bits, at most 64
+    :return: uint64 array with shape (n_samples,)
+    """
+    word, offset = divmod(start, 64)
+    end = offset + length
+    if end <= 64:
+        mask = np.uint64((1 << length) - 1)
+        return (packed[:, word] >> np.uint64(64 - end)) & mask
+    low_length = end - 64
+    high = packed[:, word] & np.uint64((1 << (64 - offset)) - 1)
+    low = packed[:, word + 1] >> np.uint64(64 - low_length)
+    return (high << np.uint64(low_length)) | low
+
+
+def _count_masks(length, radius):
+    count = 0
+    combinations_count = 1  # length choose n_flips
+    for n_flips in range(radius + 1):
+        count += combinations_count
+        combinations_count = combinations_count * (length - n_flips) // (n_flips + 1)
+    return count
+
+
+def _flip_masks(length, radius):
+    """
+    All the masks of a given length with at most radius bits set.
+
+    :return: uint64 array
+    """
+    masks = []
+    for n_flips in range(radius + 1):
+        for bits in combinations(range(length), n_flips):
+            masks.append(sum(1 << bit for bit in bits))
+    return np.array(masks, dtype=np.uint64)
+
+
+def _substring_count(n_hashes, n_bits):
+    """
+    :return: number of multi-index hashing substrings, about log2(n_hashes) bits each
+    """
+    substring_bits = max(MIH_MIN_SUBSTRING_BITS, int(np.ceil(np.log2(max(n_hashes, 2)))))
+    return max(1, n_bits // substring_bits)
+
+
+class MultiIndexHashIndex:
+    """
+    Multi-index hashing (Norouzi et al.).
+    The hashes are split in m disjoint substrings and every substring is
+    indexed in a sorted table. Two hashes within distance r have at least a
+    substring within distance r // m, so a query only probes the keys close
+    to the substrings of the needle and verifies the candidates with popcount.
+
+    Hashes can be added incrementally: they are kept in a buffer of at most
+    MIH_MERGE_SIZE hashes, searched by brute force, and then merged in the tables.
+    The number of substrings follows the size of the index, the tables are
+    rebuilt when a merge changes it.
+    """
+
+    def __init__(self, packed, n_bits, n_substrings=None):
+        """
+        :param packed: uint64 array with shape (n_samples, n_words)
+        :param n_bits: number of bits of the hashes
+        :param n_substrings: number of substrings, by default it depends on the number of hashes
+        """
+        self.n_bits = n_bits
+        self.fixed_substrings = n_substrings
+        self.packed = np.zeros((0, _n_words(n_bits)), dtype=np.uint64)
+        self.size = 0
+        self._partition(n_substrings or _substring_count(len(packed), n_bits))
+        self._masks = dict()
+        self.add(packed)
+        self.merge()
+
+    def _partition(self, n_substrings):
+        """
+        Split the hashes in substrings of (almost) the same length, the tables are emptied.
+        """
+        # The first bits of the first word are padding
+        padding = _n_words(self.n_bits) * 64 - self.n_bits
+        bounds = np.linspace(0, self.n_bits, n_substrings + 1).astype(int)
+        self.n_substrings = n_substrings
+        self.substrings = [(int(padding + bounds[i]), int(bounds[i + 1] - bounds[i])) for i in range(n_substrings)
+                           if bounds[i + 1] > bounds[i]]
+        # For every substring: the sorted keys, the ids sorted by key and, for short substrings,
+        # the position of the first id of every key
+        self.tables = [None for _ in self.substrings]
+        self.merged = 0  # Number of hashes in the tables, the others are in the buffer
+
+    def __len__(self):
+        return self.size
+
+    def add(self, packed):
+        """
+        Add hashes to the index. They get the next ids.
+
+        :param packed: uint64 array with shape (n_samples, n_words)
+        :return: the ids of the added hashes
+        """
+        ids = np.arange(self.size, self.size + len(packed))
+        if self.size + len(packed) > len(self.packed):
+            # Grow the storage geometrically
+            capacity = max(self.size + len(packed), 2 * len(self.packed))
+            grown = np.zeros((capacity, self.packed.shape[1]), dtype=np.uint64)
+            grown[:self.size] = self.packed[:self.size]
+            self.packed = grown
+        self.packed[self.size:self.size + len(packed)] = packed
+        self.size += len(packed)
+        if self.size - self.merged >= MIH_MERGE_SIZE:
+            self.merge()
+        return ids
+
+    def merge(self):
+        """
+        Merge the buffered hashes in the tables.
+        """
+        if self.merged == self.size and self.tables[0] is not None:
+            return
+        if self.fixed_substrings is None and _substring_count(self.size, self.n_bits) != self.n_substrings:
+            self._partition(_substring_count(self.size, self.n_bits))
+        for i, (start, length) in enumerate(self.substrings):
+            keys = _extract_bits(self.packed[self.merged:self.size], start, length)
+            ids = np.argsort(keys, kind='stable')
+            keys = keys[ids]
+            ids += self.merged
+            if self.tables[i] is not None:
+                # Insert the sorted buffer in the sorted table, after the ids with the same key
+                merged_keys, merged_ids, _ = self.tables[i]
+                positions = np.searchsorted(merged_keys, keys, side='right')
+                keys = np.insert(merged_keys, positions, keys)
+                ids = np.insert(merged_ids, positions, ids)
+            starts = None
+            if length <= MIH_DIRECT_BITS:
+                counts = np.bincount(keys.astype(np.int64), minlength=1 << length)
+                starts = np.concatenate([[0], np.cumsum(counts)])
+            self.tables[i] = (keys, ids, starts)
+        self.merged = self.size
+
+    def _get_masks(self, length, radius):
+        if (length, radius) not in self._masks:
+            self._masks[(length, radius)] = _flip_masks(length, radius)
+        return self._masks[(length, radius)]
+
+    def _table_matches(self, needles, max_distance):
+        """
+        Find the matches among the hashes merged in the tables.
+
+        :return: 2-ple of arrays (needle indexes, ids)
+        """
+        radius = max_distance // len(self.substrings)
+        n_probes = sum(_count_masks(length, radius) for _, length in self.substrings)
+        if n_probes >= self.merged:
+            # Probing the tables costs more than comparing all the hashes
+            return _brute_force_matches(needles, self.packed[:self.merged], max_distance)
+        needle_indexes = [np.zeros(0, dtype=np.int64)]
+        candidate_ids = [np.zeros(0, dtype=np.int64)]
+        for (start, length), (keys, ids, starts) in zip(self.substrings, self.tables):
+            masks = self._get_masks(length, radius)
+            probes = (_extract_bits(needles, start, length)[:, None] ^ masks[None, :]).ravel()
+            if starts is not None:
+                probes = probes.astype(np.int64)
+                lower = starts[probes]
+                upper = starts[probes + 1]
+            else:
+                lower = np.searchsorted(keys, probes, side='left')
+                upper = np.searchsorted(keys, probes, side='right')
+            counts = upper - lower
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Positions lower[i], ..., upper[i] - 1 for every probe i
+            offsets = np.repeat(lower - np.cumsum(counts) + counts, counts)
+            positions = offsets + np.arange(total)
+            needle_indexes.append(np.repeat(np.arange(len(probes)) // len(masks), counts))
+            candidate_ids.append(ids[positions])
+        # A candidate can be found in more than one substring
+        pairs = np.unique(np.stack([np.concatenate(needle_indexes), np.concatenate(candidate_ids)]), axis=1)
+        needle_indexes, ids = pairs[0], pairs[1]
+        close = pair_distances(needles[needle_indexes], self.packed[ids]) <= max_distance
+        return needle_indexes[close], ids[close]
+
+    def query_radius(self, needles, max_distance):
+        """
+        Find the hashes within a distance from each needle.
+
+        :param needles: uint64 array with shape (n_needles, n_words)
+        :param max_distance: maximum number of different bits
+        :return: list with an array of ids for each needle
+        """
+        result = []
+        for start in range(0, len(needles), BLOCK_SIZE):
+            block = needles[start:start + BLOCK_SIZE]
+            needle_indexes, ids = self._table_matches(block, max_distance)
+            # The buffered hashes are compared by brute force
+            buffer_indexes, buffer_ids = _brute_force_matches(block, self.packed[self.merged:self.size],
+                                                              max_distance)
+            needle_indexes = np.concatenate([needle_indexes, buffer_indexes])
+            ids = np.concatenate([ids, buffer_ids + self.merged])
+            order = np.argsort(needle_indexes, kind='stable')
+            counts = np.bincount(needle_indexes, minlength=len(block))
+            result.extend(np.split(ids[order], np.cumsum(counts)[:-1]))
+        return result
+
+    def iter_pairs(self, max_distance):
+        return _iter_pairs_by_query(self, max_distance)
+
+
+def radius_graph(index, max_distance):
+    """
+    Run a single batched all-pairs query on an index.
+
+    :param index:
+    :param max_distance: maximum number of different bits
+    :return: symmetric CSR matrix with shape (n_samples, n_samples), the data are
+             the distances between the neighbours (the diagonal is not stored)
+    """
+    rows = [np.zeros(0, dtype=np.int64)]
+    cols = [np.zeros(0, dtype=np.int64)]
+    distances = [np.zeros(0, dtype=np.uint16)]
+    for pair_rows, pair_cols, block_distances in index.iter_pairs(max_distance):
+        rows.extend([pair_rows, pair_cols])
+        cols.extend([pair_cols, pair_rows])
+        distances.extend([block_distances, block_distances])
+    return _pairs_to_csr(np.concatenate(rows), np.concatenate(cols),
+                         np.concatenate(distances).astype(np.uint16), len(index))
+
+
+def _pairs_to_csr(rows, cols, distances, n_samples):
+    # Build the CSR arrays directly, a distance 0 must not be dropped as an implicit zero
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_samples))])
+    return csr_matrix((distances[order], cols[order], indptr), shape=(n_samples, n_samples))
+
+
+def graph_pairs(graph):
+    """
+    :param graph: CSR matrix, see radius_graph
+    :return: 3-ple of arrays (rows, cols, distances) of the stored entries
+    """
+    rows = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    return rows, graph.indices, graph.data
+
+
+def filter_graph(graph, keep):
+    """
+    Remove edges from a graph.
+
+    :param graph: CSR matrix, see radius_graph
+    :param keep: bool array, True for the stored entries to keep (in graph_pairs order)
+    :return: CSR matrix with the kept edges
+    """
+    rows, cols, distances = graph_pairs(graph)
+    return _pairs_to_csr(rows[keep], cols[keep], distances[keep], graph.shape[0])
+
+
+def build_index(packed, n_bits, backend=INDEX_POPCOUNT):
+    """
+    Build a search index over packed hashes.
+
+    :param packed: uint64 array with shape (n_samples, n_words)
+    :param n_bits: number of bits of the hashes
+    :param backend: one of INDEXES
+    :return: the index
+    """
+    if backend == INDEX_POPCOUNT:
+        return PopcountIndex(packed, n_bits)
+    elif backend == INDEX_BALLTREE:
+        return BallTreeIndex(packed, n_bits)
+    elif backend == INDEX_MIH:
+        return MultiIndexHashIndex(packed, n_bits)
+    raise ValueError("Unknown index %s" % backend)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import zlib
+
+from .Hashing import DEFAULT_ALGORITHM
+from .Matcher import ENGINE_THREAD
+from .Matcher import index_folder
+from .Scanner import DEFAULT_EXCLUDE_NAMES
+from .Scanner import FILTER_NONE
+from .Scanner import scan
+from .Store import BACKEND_FILE_NAMES
+from .Store import BACKEND_SHELVE
+from .Store import CHECKPOINT_FILES
+from .Store import CHECKPOINT_SECONDS
+from .Store import open_hash_store
+from .Store import shelve_exists
+
+SHARD_BY_PATH = "path"
+SHARD_BY_SUBTREE = "subtree"
+SHARD_STRATEGIES = (SHARD_BY_PATH, SHARD_BY_SUBTREE)
+
+# Shard stores are named after the hash store, e.g. hashes.shard-3-of-8.sqlite
+_SHARD_NAME = "%s.shard-%d-of-%d%s"
+_SHARD_PATTERN = re.compile(r"^(.*)\.shard-(\d+)-of-(\d+)(\..*)?$")
+
+
+def shard_key(path, folder, strategy=SHARD_BY_PATH):
+    """
+    :param path: absolute path of a file
+    :param folder: absolute path of the sharded folder
+    :param strategy: one of SHARD_STRATEGIES
+    :return: string deciding the shard of the file: the relative path, or its first
+             component so that a whole subtree is in the same shard
+    """
+    relative = os.path.relpath(path, folder)
+    if strategy == SHARD_BY_SUBTREE:
+        return relative.split(os.sep, 1)[0]
+    elif strategy == SHARD_BY_PATH:
+        return relative
+    raise ValueError("Unknown shard strategy %s" % strategy)
+
+
+def shard_of(key, n_shards):
+    """
+    Shard of a key, stable across processes and machines (unlike the salted str hash).
+
+    :param key: see shard_key
+    :param n_shards:
+    :return: shard number in 0, ..., n_shards - 1
+    """
+    return zlib.crc32(key.encode('utf-8', 'surrogateescape')) % n_shards
+
+
+def scan_shard(folder, shard, n_shards, strategy=SHARD_BY_PATH, recursive=True, file_filter=FILTER_NONE,
+               exclude_paths=()):
+    """
+    Scan the files of a shard.
+    With SHARD_BY_SUBTREE the subfolders of the other shards are not listed at all.
+
+    :param folder:
+    :param shard: shard number in 0, ..., n_shards - 1
+    :param n_shards:
+    :param strategy: one of SHARD_STRATEGIES
+    :return: iterator of Scanner.ScanEntry
+    """
+    if not 0 <= shard < n_shards:
+        raise ValueError("Shard %d is not in 0, ..., %d" % (shard, n_shards - 1))
+    folder = os.path.abspath(folder)
+    if strategy == SHARD_BY_SUBTREE:
+        with os.scandir(folder) as iterator:
+            others = [entry.path for entry in iterator
+                      if entry.is_dir(follow_symlinks=False) and entry.name not in DEFAULT_EXCLUDE_NAMES and
+                      shard_of(entry.name, n_shards) != shard]
+        exclude_paths = tuple(exclude_paths) + tuple(others)
+    for entry in scan(folder, recursive=recursive, file_filter=file_filter, exclude_paths=exclude_paths):
+        if shard_of(shard_key(entry.path, folder, strategy), n_shards) == shard:
+            yield entry
+
+
+def shard_store_path(persistence_folder, shard, n_shards, backend):
+    """
+    :param persistence_folder:
+    :param shard: shard number
+    :param n_shards:
+    :param backend: one of Store.BACKENDS
+    :return: path of the hash store of a shard
+    """
+    root, extension = os.path.splitext(BACKEND_FILE_NAMES[backend])
+    return os.path.join(persistence_folder, _SHARD_NAME % (root, shard, n_shards, extension))
+
+
+def find_shard_stores(persistence_folder, backend, n_shards=None):
+    """
+    Find the shard stores of a run, the stores left by a run with another number of shards are not merged.
+
+    :param persistence_folder:
+    :param backend: one of Store.BACKENDS
+    :param n_shards: number of shards of the run, None to take it from the shard stores
+    :return: sorted list of the paths of the shard stores of the backend
+    """
+    root, extension = os.path.splitext(BACKEND_FILE_NAMES[backend])
+    paths = dict()  # Map from number of shards to the paths of the stores
+    for name in os.listdir(persistence_folder):
+        match = _SHARD_PATTERN.match(name)
+        # The files of a shelve db can have a further extension, e.g. .db.dat
+        if match is None or match.group(1) != root:
+            continue
+        path = shard_store_path(persistence_folder, int(match.group(2)), int(match.group(3)), backend)
+        if (shelve_exists(path) if backend == BACKEND_SHELVE else os.path.exists(path)):
+            paths.setdefault(int(match.group(3)), set()).add(path)
+    if n_shards is None:
+        if len(paths) > 1:
+            raise ValueError("Shard stores of %s shards found in %s, give the number of shards to merge" %
+                             (" and ".join(str(count) for count in sorted(paths)), persistence_folder))
+        return sorted(next(iter(paths.values()), ()))
+    return sorted(paths.get(n_shards, ()))
+
+
+def hash_shard(folder, persistence_folder, shard, n_shards, strategy=SHARD_BY_PATH, backend=BACKEND_SHELVE,
+               recursive=True, engine=ENGINE_THREAD, workers=None, decode_size=None,
+               algorithms=(DEFAULT_ALGORITHM,), file_filter=FILTER_NONE, exclude_paths=(),
+               checkpoint_files=CHECKPOINT_FILES, checkpoint_interval=CHECKPOINT_SECONDS, metrics=None):
+    """
+    Hash the images of a shard in the shard hash store.
+    Shards can run as separate processes, or on separate nodes sharing the folder:
+    they only write their own store. A failed shard is resumed by running it again.
+
+    :return: 2-ple (path of the shard store, number of images)
+    """
+    db_path = shard_store_path(persistence_folder, shard, n_shards, backend)
+    entries = scan_shard(folder, shard, n_shards, strategy=strategy, recursive=recursive,
+                         file_filter=file_filter, exclude_paths=exclude_paths)
+    n_images = index_folder(folder, db_path, db_backend=backend, decode_size=decode_size, algorithms=algorithms,
+                            engine=engine, workers=workers, entries=entries,
+                            checkpoint_files=checkpoint_files, checkpoint_interval=checkpoint_interval,
+                            metrics=metrics)
+    return db_path, n_images
+
+
+def merge_stores(shard_paths, db_path, backend=None):
+    """
+    Copy the entries of the shard stores into a hash store.
+    The entries of the shards replace the ones already in the store.
+
+    :param shard_paths: paths of the shard stores, see find_shard_stores
+    :param db_path: destination hash store
+    :param backend: one of Store.BACKENDS, guessed from the paths by default
+    :return: number of merged entries
+    """
+    merged = 0
+    with open_hash_store(db_path, backend=backend, flag='c') as store:
+        for shard_path in shard_paths:
+            with open_hash_store(shard_path, backend=backend, flag='r') as shard:
+                for path, entry in shard.iter_entries():
+                    store.put_entry(path, entry)
+                    merged += 1
+    return merged
@@ -0,0 +1,992 @@
+#!/usr/bin/env python3
+
+import dbm
+import glob
+import json
+import os
+import shelve
+import sqlite3
+import time
+
+import numpy as np
+
+from .HashCache import HASH_ALGORITHM
+from .HashCache import entry_matches
+from .HashCache import make_entry
+from .Search import MultiIndexHashIndex
+from .Search import pair_distances
+
+BACKEND_SHELVE = "shelve"
+BACKEND_SQLITE = "sqlite"
+BACKEND_COLUMNAR = "columnar"
+BACKENDS = (BACKEND_SHELVE, BACKEND_SQLITE, BACKEND_COLUMNAR)
+
+# File names used for the hash store of each backend in the persistence folder
+BACKEND_FILE_NAMES = {
+    BACKEND_SHELVE: "hashes.db",
+    BACKEND_SQLITE: "hashes.sqlite",
+    BACKEND_COLUMNAR: "hashes.npz",
+}
+
+# File name of the false positives store in the persistence folder
+FALSE_POSITIVES_FILE_NAME = "false-positives.sqlite"
+# File name of the shelve false positives store of the older versions
+FALSE_POSITIVES_LEGACY_FILE_NAME = "false-positives.db"
+
+# File name of the store of the full digests of the files (exact duplicates) in the persistence folder
+DIGESTS_FILE_NAME = "digests.sqlite"
+
+# File name of the persisted search index of a hash algorithm in the persistence folder
+SEARCH_INDEX_FILE_NAME = "index-%s.npz"
+
+# Prefix of the shelve keys mapping an inode to a path.
+# Paths are absolute, so they never start with this prefix.
+_INODE_KEY_PREFIX = "inode:"
+
+# Number of rows written to SQLite in a single transaction
+SQLITE_BATCH_SIZE = 1000
+
+# Default checkpoint of the hash stores while hashing: every CHECKPOINT_FILES hashed files
+# or every CHECKPOINT_SECONDS seconds, whatever comes first
+CHECKPOINT_FILES = 1000
+CHECKPOINT_SECONDS = 60.0
+
+# Extension of the journal of the changes made to a columnar store after it was written
+_COLUMNAR_JOURNAL_EXTENSION = ".journal"
+
+# Integer fields of an entry, in the order they are stored
+_ENTRY_FIELDS = ('size', 'mtime_ns', 'ino', 'dev')
+# Optional image metadata stored with the entries, see HashCache.ImageMetadata
+_METADATA_FIELDS = ('width', 'height', 'format', 'sha256', 'bits', 'exif')
+_SQLITE_COLUMNS = ('hash', 'algorithm') + _ENTRY_FIELDS + _METADATA_FIELDS
+_SQLITE_SELECT = ", ".join(_SQLITE_COLUMNS)
+# Integer columns of the columnar store, a missing metadata value is stored as -1
+_COLUMNAR_INT_FIELDS = _ENTRY_FIELDS + ('width', 'height', 'bits', 'exif')
+
+
+def shelve_exists(path):
+    """
+    Return True if a shelve db exists at the given path.
+    Depending on the dbm module the files on disk can have an extension
+    (e.g. path.dat and path.dir for dbm.dumb).
+
+    :param path: path given to shelve.open
+    :return:
+    """
+    return path is not None and bool(dbm.whichdb(path))
+
+
+def backend_from_path(path):
+    """
+    Guess the backend of a hash store from its file name.
+
+    :param path:
+    :return: one of BACKENDS
+    """
+    _, extension = os.path.splitext(path)
+    if extension in ('.sqlite', '.sqlite3'):
+        return BACKEND_SQLITE
+    elif extension == '.npz':
+        return BACKEND_COLUMNAR
+    return BACKEND_SHELVE
+
+
+class Store:
+    """
+    Base class of the persistent stores.
+    Stores are context managers, the changes are saved on close.
+    """
+
+    def flush(self):
+        """
+        Save the pending changes.
+        """
+        pass
+
+    def checkpoint(self):
+        """
+        Save the pending changes so that they survive a crash.
+        Stores that are expensive to flush save only the changes since the last checkpoint.
+        """
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HashStore(Store):
+    """
+    Store of the hash entries, indexed by absolute path and hash algorithm.
+    An entry is a dict with the serialized hash, the hash algorithm and
+    the stat fields of the file (see HashCache.make_entry).
+    The hashes of a file computed with different algorithms are stored side by side.
+    """
+
+    def get_entry(self, path, algorithm):
+        """
+        :param path:
+        :param algorithm: hash algorithm version
+        :return: the entry of the path for the algorithm or None
+        """
+        raise NotImplementedError
+
+    def get_path_by_inode(self, dev, ino):
+        """
+        :param dev:
+        :param ino:
+        :return: the last path stored for the given inode or None
+        """
+        raise NotImplementedError
+
+    def put_entry(self, path, entry):
+        raise NotImplementedError
+
+    def delete_entry(self, path):
+        """
+        Delete the entries of all the algorithms of a path.
+        """
+        raise NotImplementedError
+
+    def iter_entries(self):
+        """
+        :return: iterator of 2-ples (path, entry), a path with several algorithms is returned more than once
+        """
+        raise NotImplementedError
+
+    def load_matrix(self, algorithm):
+        """
+        Load all the hashes computed with an algorithm.
+
+        :param algorithm: hash algorithm version
+        :return: 2-ple (paths, matrix), matrix is a uint8 array with a packed hash per row
+        """
+        paths = []
+        rows = []
+        for path, entry in self.iter_entries():
+            if entry['algorithm'] != algorithm:
+                continue
+            paths.append(path)
+            rows.append(_hash_to_bytes(entry['hash']))
+        return paths, _bytes_to_matrix(rows)
+
+
+def _hash_to_bytes(hash_str):
+    if len(hash_str) % 2 == 1:
+        hash_str = "0" + hash_str
+    return bytes.fromhex(hash_str)
+
+
+def _strings_to_blob(strings):
+    return np.frombuffer('\0'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def _blob_to_strings(blob):
+    return blob.tobytes().decode('utf-8').split('\0') if len(blob) else []
+
+
+def _bytes_to_matrix(rows):
+    if len(rows) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    width = max(len(row) for row in rows)
+    matrix = np.zeros((len(rows), width), dtype=np.uint8)
+    for i, row in enumerate(rows):
+        matrix[i, width - len(row):] = np.frombuffer(row, dtype=np.uint8)
+    return matrix
+
+
+class MemoryHashStore(HashStore):
+    """
+    Hash store kept in memory, used when no db is given.
+    """
+
+    def __init__(self):
+        self.entries = dict()  # Map from path to the entries by algorithm
+        self.inodes = dict()
+
+    def get_entry(self, path, algorithm):
+        return self.entries.get(path, {}).get(algorithm)
+
+    def get_path_by_inode(self, dev, ino):
+        return self.inodes.get((dev, ino))
+
+    def put_entry(self, path, entry):
+        self.entries.setdefault(path, dict())[entry['algorithm']] = entry
+        self.inodes[(entry['dev'], entry['ino'])] = path
+
+    def delete_entry(self, path):
+        for entry in self.entries.pop(path, {}).values():
+            if self.inodes.get((entry['dev'], entry['ino'])) == path:
+                del self.inodes[(entry['dev'], entry['ino'])]
+
+    def iter_entries(self):
+        for path, entries in list(self.entries.items()):
+            for entry in list(entries.values()):
+                yield path, entry
+
+
+class ShelveHashStore(HashStore):
+    """
+    Hash store on a shelve db, the value of a path is a map from algorithm to entry.
+    Entries are never modified in place so writeback is not needed.
+    """
+
+    def __init__(self, path, flag='c'):
+        self.db = shelve.open(path, flag=flag)
+
+    def _get_entries(self, path):
+        value = self.db.get(path)
+        # Entries written by older versions are bare hash strings, see iter_legacy_hashes
+        if not isinstance(value, dict):
+            return dict()
+        return value
+
+    def get_entry(self, path, algorithm):
+        return self._get_entries(path).get(algorithm)
+
+    def get_path_by_inode(self, dev, ino):
+        return self.db.get("%s%d:%d" % (_INODE_KEY_PREFIX, dev, ino))
+
+    def put_entry(self, path, entry):
+        entries = self._get_entries(path)
+        entries[entry['algorithm']] = entry
+        self.db[path] = entries
+        self.db["%s%d:%d" % (_INODE_KEY_PREFIX, entry['dev'], entry['ino'])] = path
+
+    def delete_entry(self, path):
+        if path in self.db:
+            for entry in self._get_entries(path).values():
+                inode_key = "%s%d:%d" % (_INODE_KEY_PREFIX, entry['dev'], entry['ino'])
+                if self.db.get(inode_key) == path:
+                    del self.db[inode_key]
+            del self.db[path]
+
+    def iter_entries(self):
+        for key in self.db:
+            if key.startswith(_INODE_KEY_PREFIX):
+                continue
+            for entry in self._get_entries(key).values():
+                yield key, entry
+
+    def iter_legacy_hashes(self):
+        """
+        :return: iterator of 2-ples (path, hash) for the bare hash strings written by older versions
+        """
+        for key in self.db:
+            value = self.db[key]
+            if isinstance(value, str) and not key.startswith(_INODE_KEY_PREFIX):
+                yield key, value
+
+    def flush(self):
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+
+
+class SqliteHashStore(HashStore):
+    """
+    Hash store on a SQLite db in WAL mode.
+    Writes are buffered and inserted in batches.
+    """
+
+    def __init__(self, path, flag='c'):
+        if flag == 'r':
+            self.connection = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self._create_schema()
+        self.pending = dict()  # Entries not yet written, by (path, algorithm)
+        self.pending_inodes = dict()  # Paths not yet written, by (dev, ino)
+
+    def _create_schema(self):
+        self.connection.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                                "path TEXT NOT NULL, algorithm TEXT NOT NULL, hash TEXT NOT NULL, "
+                                "size INTEGER, mtime_ns INTEGER, ino INTEGER, dev INTEGER, "
+                                "width INTEGER, height INTEGER, format TEXT, sha256 TEXT, bits INTEGER, exif INTEGER, "
+                                "PRIMARY KEY (path, algorithm))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS hashes_inode ON hashes (dev, ino)")
+        self.connection.commit()
+
+    @staticmethod
+    def _to_entry(row):
+        return dict(zip(_SQLITE_COLUMNS, row))
+
+    def get_entry(self, path, algorithm):
+        if (path, algorithm) in self.pending:
+            return self.pending[(path, algorithm)]
+        row = self.connection.execute("SELECT %s FROM hashes WHERE path = ? AND algorithm = ?" % _SQLITE_SELECT,
+                                      (path, algorithm)).fetchone()
+        return None if row is None else self._to_entry(row)
+
+    def get_path_by_inode(self, dev, ino):
+        if (dev, ino) in self.pending_inodes:
+            return self.pending_inodes[(dev, ino)]
+        row = self.connection.execute("SELECT path FROM hashes WHERE dev = ? AND ino = ? ORDER BY rowid DESC",
+                                      (dev, ino)).fetchone()
+        return None if row is None else row[0]
+
+    def put_entry(self, path, entry):
+        self.pending[(path, entry['algorithm'])] = entry
+        self.pending_inodes[(entry['dev'], entry['ino'])] = path
+        if len(self.pending) >= SQLITE_BATCH_SIZE:
+            self.flush()
+
+    def delete_entry(self, path):
+        for key in [key for key in self.pending if key[0] == path]:
+            del self.pending[key]
+        for key in [key for key, inode_path in self.pending_inodes.items() if inode_path == path]:
+            del self.pending_inodes[key]
+        self.connection.execute("DELETE FROM hashes WHERE path = ?", (path,))
+
+    def iter_entries(self):
+        self.flush()
+        cursor = self.connection.execute("SELECT path, %s FROM hashes" % _SQLITE_SELECT)
+        for row in cursor:
+            yield row[0], self._to_entry(row[1:])
+
+    def flush(self):
+        if len(self.pending) > 0:
+            rows = [(path,) + tuple(entry.get(column) for column in _SQLITE_COLUMNS)
+                    for (path, _), entry in self.pending.items()]
+            # Re-inserting moves the row to the end, so the last path of an inode has the highest rowid
+            self.connection.executemany("INSERT OR REPLACE INTO hashes (path, %s) VALUES (?%s)"
+                                        % (", ".join(_SQLITE_COLUMNS), ", ?" * len(_SQLITE_COLUMNS)), rows)
+            self.pending = dict()
+            self.pending_inodes = dict()
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class ColumnarHashStore(HashStore):
+    """
+    Hash store on a packed columnar file (numpy npz).
+    The path table, the stat and metadata columns and the uint8 hash matrix are loaded
+    with a single read on open and the whole file is rewritten on close.
+    A checkpoint only appends the changes to a journal next to the file,
+    the journal is replayed on open and removed when the file is rewritten.
+    """
+
+    def __init__(self, path, flag='c'):
+        self.path = path
+        self.readonly = flag == 'r'
+        self.changed = False
+        self.paths = []
+        self.algorithms = []
+        self.formats = []
+        self.columns = {field: np.zeros(0, dtype=np.int64) for field in _COLUMNAR_INT_FIELDS}
+        self.algorithm_ids = np.zeros(0, dtype=np.int16)
+        self.format_ids = np.zeros(0, dtype=np.int16)
+        self.digests = []
+        self.hash_lengths = np.zeros(0, dtype=np.int16)
+        self.matrix = np.zeros((0, 0), dtype=np.uint8)
+        if os.path.exists(path):
+            self._load()
+        self.rows = dict()  # Map from path to the rows by algorithm
+        for i, (row_path, algorithm_id) in enumerate(zip(self.paths, self.algorithm_ids)):
+            self.rows.setdefault(row_path, dict())[str(self.algorithms[algorithm_id])] = i
+        self.inodes = {(int(dev), int(ino)): self.paths[i]
+                       for i, (dev, ino) in enumerate(zip(self.columns['dev'], self.columns['ino']))}
+        self.deleted = set()  # Rows of the matrix no longer used
+        self.added = dict()  # Entries added after the load, by path and algorithm
+        self.journal_path = self.path + _COLUMNAR_JOURNAL_EXTENSION
+        self.unjournaled = []  # Changes since the last checkpoint
+        if os.path.exists(self.journal_path):
+            self._replay_journal()
+
+    def _replay_journal(self):
+        with open(self.journal_path) as hand:
+            for line in hand:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # Last line truncated by a crash
+                    continue
+                if 'delete' in change:
+                    self.delete_entry(change['delete'])
+                else:
+                    self.put_entry(change['path'], change['entry'])
+        self.unjournaled = []
+
+    def _load(self):
+        with np.load(self.path) as data:
+            self.paths = _blob_to_strings(data['paths_blob'])
+            self.algorithms = list(data['algorithms'])
+            for field in _COLUMNAR_INT_FIELDS:
+                self.columns[field] = data[field]
+            self.algorithm_ids = data['algorithm_ids']
+            self.hash_lengths = data['hash_lengths']
+            self.matrix = data['hashes']
+            self.formats = list(data['formats'])
+            self.format_ids = data['format_ids']
+            # A single empty digest is stored as an empty blob
+            self.digests = _blob_to_strings(data['sha256_blob']) or [""] * len(self.paths)
+
+    def _row_entry(self, row):
+        hash_length = int(self.hash_lengths[row])
+        hash_bytes = self.matrix[row].tobytes()
+        hash_hex = hash_bytes.hex()
+        hash_str = hash_hex[len(hash_hex) - hash_length:]
+        entry = {'hash': hash_str, 'algorithm': str(self.algorithms[self.algorithm_ids[row]])}
+        for field in _ENTRY_FIELDS:
+            entry[field] = int(self.columns[field][row])
+        for field in ('width', 'height', 'bits', 'exif'):
+            value = int(self.columns[field][row])
+            entry[field] = value if value >= 0 else None
+        format_id = int(self.format_ids[row])
+        entry['format'] = str(self.formats[format_id]) if format_id >= 0 else None
+        entry['sha256'] = self.digests[row] or None
+        return entry
+
+    def get_entry(self, path, algorithm):
+        if algorithm in self.added.get(path, {}):
+            return self.added[path][algorithm]
+        row = self.rows.get(path, {}).get(algorithm)
+        if row is None or row in self.deleted:
+            return None
+        return self._row_entry(row)
+
+    def get_path_by_inode(self, dev, ino):
+        return self.inodes.get((dev, ino))
+
+    def put_entry(self, path, entry):
+        row = self.rows.get(path, {}).get(entry['algorithm'])
+        if row is not None:
+            self.deleted.add(row)
+        self.added.setdefault(path, dict())[entry['algorithm']] = entry
+        self.inodes[(entry['dev'], entry['ino'])] = path
+        self.unjournaled.append({'path': path, 'entry': entry})
+        self.changed = True
+
+    def delete_entry(self, path):
+        rows = self.rows.get(path, {}).values()
+        inodes = [(entry['dev'], entry['ino']) for entry in self.added.pop(path, {}).values()]
+        inodes.extend((int(self.columns['dev'][row]), int(self.columns['ino'][row])) for row in rows)
+        for inode in inodes:
+            if self.inodes.get(inode) == path:
+                del self.inodes[inode]
+        self.deleted.update(rows)
+        self.unjournaled.append({'delete': path})
+        self.changed = True
+
+    def iter_entries(self):
+        for row, path in enumerate(self.paths):
+            if row not in self.deleted:
+                yield path, self._row_entry(row)
+        for path, entries in list(self.added.items()):
+            for entry in list(entries.values()):
+                yield path, entry
+
+    def load_matrix(self, algorithm):
+        if len(self.added) > 0 or len(self.deleted) > 0 or algorithm not in self.algorithms:
+            return super().load_matrix(algorithm)
+        # Select the rows straight from the loaded matrix
+        selected = self.algorithm_ids == self.algorithms.index(algorithm)
+        paths = [path for path, keep in zip(self.paths, selected) if keep]
+        width = int(np.max(self.hash_lengths[selected], initial=0) + 1) // 2
+        return paths, self.matrix[selected][:, self.matrix.shape[1] - width:]
+
+    def checkpoint(self):
+        if self.readonly or len(self.unjournaled) == 0:
+            return
+        with open(self.journal_path, "a") as hand:
+            hand.write("".join(json.dumps(change) + "\n" for change in self.unjournaled))
+            hand.flush()
+            os.fsync(hand.fileno())
+        self.unjournaled = []
+
+    def flush(self):
+        if self.readonly or not self.changed:
+            return
+        paths = []
+        algorithms = []
+        formats = []
+        columns = {field: [] for field in _COLUMNAR_INT_FIELDS}
+        algorithm_ids = []
+        format_ids = []
+        digests = []
+        hash_lengths = []
+        rows = []
+        for path, entry in self.iter_entries():
+            if entry['algorithm'] not in algorithms:
+                algorithms.append(entry['algorithm'])
+            image_format = entry.get('format')
+            if image_format is not None and image_format not in formats:
+                formats.append(image_format)
+            paths.append(path)
+            for field in _ENTRY_FIELDS:
+                columns[field].append(entry[field])
+            for field in ('width', 'height', 'bits', 'exif'):
+                columns[field].append(-1 if entry.get(field) is None else entry[field])
+            algorithm_ids.append(algorithms.index(entry['algorithm']))
+            format_ids.append(-1 if image_format is None else formats.index(image_format))
+            digests.append(entry.get('sha256') or "")
+            hash_lengths.append(len(entry['hash']))
+            rows.append(_hash_to_bytes(entry['hash']))
+        arrays = {field: np.array(values, dtype=np.int64) for field, values in columns.items()}
+        # Write to a temporary file so a crash does not corrupt the store
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as hand:
+            np.savez(hand, paths_blob=_strings_to_blob(paths), algorithms=np.array(algorithms, dtype=str),
+                     algorithm_ids=np.array(algorithm_ids, dtype=np.int16),
+                     formats=np.array(formats, dtype=str), format_ids=np.array(format_ids, dtype=np.int16),
+                     sha256_blob=_strings_to_blob(digests),
+                     hash_lengths=np.array(hash_lengths, dtype=np.int16),
+                     hashes=_bytes_to_matrix(rows), **arrays)
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.unjournaled = []
+        self.changed = False
+
+
+class Checkpointer:
+    """
+    Checkpoint a store every n_files changes or every interval seconds,
+    so an interrupted run loses at most one interval of work.
+    """
+
+    def __init__(self, store, n_files=CHECKPOINT_FILES, interval=CHECKPOINT_SECONDS):
+        self.store = store
+        self.n_files = n_files
+        self.interval = interval
+        self.count = 0
+        self.last = time.monotonic()
+
+    def update(self, n_files=1):
+        """
+        :param n_files: number of files changed in the store
+        :return: True if a checkpoint was made
+        """
+        self.count += n_files
+        if self.count < self.n_files and time.monotonic() - self.last < self.interval:
+            return False
+        self.store.checkpoint()
+        self.count = 0
+        self.last = time.monotonic()
+        return True
+
+
+def open_hash_store(path, backend=None, flag='c'):
+    """
+    Open a hash store.
+    Allows empty path, in that case the store is kept in memory.
+
+    :param path: path of the store
+    :param backend: one of BACKENDS, by default it is guessed from the path
+    :param flag: 'c' to create the store if missing, 'r' for read only
+    :return: a HashStore
+    """
+    if path is None:
+        return MemoryHashStore()
+    if backend is None:
+        backend = backend_from_path(path)
+    if backend == BACKEND_SHELVE:
+        return ShelveHashStore(path, flag=flag)
+    elif backend == BACKEND_SQLITE:
+        return SqliteHashStore(path, flag=flag)
+    elif backend == BACKEND_COLUMNAR:
+        return ColumnarHashStore(path, flag=flag)
+    raise ValueError("Unknown backend %s" % backend)
+
+
+def migrate_shelve(shelve_path, store):
+    """
+    Copy the entries of a shelve hash db to another store.
+    The bare hash strings written by older versions were computed with HASH_ALGORITHM
+    on the full image: they are stored with the current stat of their file, unless the
+    file is gone or was modified after the db was last written.
+
+    :param shelve_path: path of the shelve db
+    :param store: destination HashStore
+    :return: number of migrated entries
+    """
+    # Depending on the dbm module the db is made of several files, e.g. path.dat and path.dir
+    db_mtime_ns = max(os.stat(db_file).st_mtime_ns for db_file in glob.glob(glob.escape(shelve_path) + "*"))
+    migrated = 0
+    with ShelveHashStore(shelve_path, flag='r') as source:
+        for path, entry in source.iter_entries():
+            store.put_entry(path, entry)
+            migrated += 1
+        for path, hash_str in source.iter_legacy_hashes():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_mtime_ns > db_mtime_ns:
+                continue
+            store.put_entry(path, make_entry(stat, hash_str, HASH_ALGORITHM))
+            migrated += 1
+    store.flush()
+    return migrated
+
+
+def prepare_hash_store(persistence_folder, backend):
+    """
+    Return the path of the hash store in a persistence folder.
+    The first time a backend other than shelve is used, the hashes of an
+    existing shelve db are migrated to the new store.
+
+    :param persistence_folder:
+    :param backend: one of BACKENDS
+    :return: path of the hash store
+    """
+    path = os.path.join(persistence_folder, BACKEND_FILE_NAMES[backend])
+    if backend == BACKEND_SHELVE or os.path.exists(path):
+        return path
+    shelve_path = os.path.join(persistence_folder, BACKEND_FILE_NAMES[BACKEND_SHELVE])
+    if shelve_exists(shelve_path):
+        with open_hash_store(path, backend=backend) as store:
+            migrate_shelve(shelve_path, store)
+    return path
+
+
+def search_index_path(persistence_folder, algorithm):
+    """
+    :param persistence_folder:
+    :param algorithm: hash algorithm version
+    :return: path of the search index of the algorithm
+    """
+    return os.path.join(persistence_folder, SEARCH_INDEX_FILE_NAME % algorithm.replace("@", "-"))
+
+
+class SearchIndexStore(Store):
+    """
+    Search index over the hashes of an algorithm, persisted across runs (numpy npz).
+    New hashes are appended to a multi-index hashing index and the rows of the
+    removed paths are only marked as deleted, the file is compacted when it is rewritten.
+    The index tables are rebuilt with a vectorised sort when the file is loaded.
+    """
+
+    def __init__(self, path, algorithm, n_bits, flag='c'):
+        self.path = path
+        self.algorithm = algorithm
+        self.n_bits = n_bits
+        self.readonly = flag == 'r'
+        self.changed = False
+        self.paths = []
+        packed = np.zeros((0, (n_bits + 63) // 64), dtype=np.uint64)
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                # An index of another algorithm is rebuilt from scratch
+                if str(data['algorithm']) == algorithm and int(data['n_bits']) == n_bits:
+                    self.paths = _blob_to_strings(data['paths_blob'])
+                    packed = data['hashes']
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.alive = np.ones(len(self.paths), dtype=bool)
+        self.index = MultiIndexHashIndex(packed, n_bits)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, path):
+        return path in self.rows
+
+    def add(self, paths, packed):
+        """
+        Add the hashes of some paths, replacing the hashes already stored for them.
+
+        :param paths: list of paths
+        :param packed: uint64 array with the packed hash of each path
+        :return:
+        """
+        self.remove([path for path in paths if path in self.rows])
+        rows = self.index.add(packed)
+        self.paths.extend(paths)
+        self.rows.update(zip(paths, rows.tolist()))
+        self.alive = np.concatenate([self.alive, np.ones(len(paths), dtype=bool)])
+        self.changed = True
+
+    def remove(self, paths):
+        """
+        :param paths: paths to remove from the index, the unknown paths are ignored
+        """
+        for path in paths:
+            row = self.rows.pop(path, None)
+            if row is not None:
+                self.alive[row] = False
+                self.changed = True
+
+    def diff(self, paths, packed):
+        """
+        :param paths: list of paths
+        :param packed: uint64 array with the packed hash of each path
+        :return: indexes in paths of the hashes that are not stored or differ from the stored ones
+        """
+        rows = np.array([self.rows.get(path, -1) for path in paths], dtype=np.int64)
+        known = rows >= 0
+        unchanged = np.zeros(len(paths), dtype=bool)
+        unchanged[known] = np.all(self.index.packed[rows[known]] == packed[known], axis=1)
+        return np.nonzero(~unchanged)[0]
+
+    def update(self, paths, packed):
+        """
+        Synchronise the index with the hashes of a scan: the new and changed hashes
+        are added and the paths that were not scanned are removed.
+
+        :param paths: list of all the scanned paths
+        :param packed: uint64 array with the packed hash of each path
+        :return: indexes in paths of the new and changed hashes
+        """
+        changed = self.diff(paths, packed)
+        scanned = set(paths)
+        self.remove([path for path in self.rows if path not in scanned])
+        self.add([paths[i] for i in changed], packed[changed])
+        return changed
+
+    def query(self, needles, max_distance):
+        """
+        Find the stored hashes within a distance from each needle.
+
+        :param needles: uint64 array with shape (n_needles, n_words)
+        :param max_distance: maximum number of different bits
+        :return: list with a 2-ple (paths, distances) for each needle
+        """
+        result = []
+        for needle, rows in zip(needles, self.index.query_radius(needles, max_distance)):
+            rows = rows[self.alive[rows]]
+            distances = pair_distances(np.repeat(needle[None, :], len(rows), axis=0), self.index.packed[rows])
+            result.append(([self.paths[row] for row in rows], distances))
+        return result
+
+    def flush(self):
+        if self.readonly or not self.changed or self.path is None:
+            return
+        rows = np.nonzero(self.alive)[0]
+        # Write to a temporary file so a crash does not corrupt the index
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as hand:
+            np.savez(hand, algorithm=np.array(self.algorithm), n_bits=np.array(self.n_bits),
+                     paths_blob=_strings_to_blob([self.paths[row] for row in rows]),
+                     hashes=self.index.packed[rows])
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+class DigestStore(Store):
+    """
+    Store of the full digests of the files on a SQLite db, one row per path.
+    A digest is valid while the file has the same stat, like the hash entries,
+    and the digests are kept apart from the perceptual hashes.
+    """
+
+    def __init__(self, path, flag='c'):
+        """
+        :param path:
+        :param flag: 'c' to create the store if missing, 'r' for read only
+        """
+        if flag == 'r':
+            self.connection = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS digests ("
+                                    "path TEXT NOT NULL PRIMARY KEY, algorithm TEXT NOT NULL, hash TEXT NOT NULL, "
+                                    "size INTEGER, mtime_ns INTEGER, ino INTEGER, dev INTEGER)")
+            self.connection.commit()
+        self.pending = dict()  # Entries not yet written, by path
+
+    def get_digest(self, path, stat, algorithm):
+        """
+        :param path: absolute path of the file
+        :param stat: os.stat_result of the file
+        :param algorithm: digest algorithm version
+        :return: the hex digest, None if it is not stored or the file changed
+        """
+        entry = self.pending.get(path)
+        if entry is None:
+            row = self.connection.execute("SELECT algorithm, hash, size, mtime_ns, ino, dev FROM digests "
+                                          "WHERE path = ?", (path,)).fetchone()
+            entry = None if row is None else dict(zip(('algorithm', 'hash') + _ENTRY_FIELDS, row))
+        return entry['hash'] if entry_matches(entry, stat, algorithm) else None
+
+    def put_digest(self, path, stat, digest, algorithm):
+        """
+        :param path: absolute path of the file
+        :param stat: os.stat_result of the file
+        :param digest: hex digest
+        :param algorithm: digest algorithm version
+        """
+        self.pending[path] = {'algorithm': algorithm, 'hash': digest, 'size': stat.st_size,
+                              'mtime_ns': stat.st_mtime_ns, 'ino': stat.st_ino, 'dev': stat.st_dev}
+        if len(self.pending) >= SQLITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            columns = ('algorithm', 'hash') + _ENTRY_FIELDS
+            rows = [(path,) + tuple(entry[column] for column in columns) for path, entry in self.pending.items()]
+            self.connection.executemany("INSERT OR REPLACE INTO digests (path, %s) VALUES (?%s)"
+                                        % (", ".join(columns), ", ?" * len(columns)), rows)
+            self.pending = dict()
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class FalsePositivesStore(Store):
+    """
+    Store of the false positives: unordered pairs of paths that are not duplicates.
+    """
+
+    def iter_pairs(self):
+        """
+        :return: iterator of 2-ples (first, second) with first < second, a pair can be returned more than once
+        """
+        raise NotImplementedError
+
+    def add_pairs(self, pairs):
+        """
+        Add false positives.
+
+        :param pairs: iterable of 2-ples of paths, in any order
+        :return:
+        """
+        raise NotImplementedError
+
+    def add(self, path, false_positives):
+        """
+        Add false positives to a path.
+
+        :param path:
+        :param false_positives: list of paths
+        :return:
+        """
+        self.add_pairs((path, false_positive) for false_positive in false_positives)
+
+
+def canonical_pair(first, second):
+    """
+    :return: the unordered pair as a 2-ple sorted by path
+    """
+    return (first, second) if first < second else (second, first)
+
+
+class ShelveFalsePositivesStore(FalsePositivesStore):
+    """
+    False positives store on a shelve db, the format of the older versions:
+    a map from path to the list of paths that are not duplicates of it.
+    """
+
+    def __init__(self, path, flag='c'):
+        self.db = shelve.open(path, flag=flag)
+
+    def iter_pairs(self):
+        for path, false_positives in self.db.items():
+            for false_positive in false_positives:
+                if false_positive != path:
+                    yield canonical_pair(path, false_positive)
+
+    def add_pairs(self, pairs):
+        by_path = dict()
+        for first, second in pairs:
+            by_path.setdefault(first, set()).add(second)
+            by_path.setdefault(second, set()).add(first)
+        for path, false_positives in by_path.items():
+            elements = self.db.get(path) or []
+            known = set(elements)
+            self.db[path] = elements + sorted(false_positives - known)
+
+    def flush(self):
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+
+
+class SqliteFalsePositivesStore(FalsePositivesStore):
+    """
+    False positives store on a SQLite db, one row per canonical pair.
+    """
+
+    def __init__(self, path, flag='c'):
+        if flag == 'r':
+            self.connection = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS false_positives ("
+                                    "first TEXT NOT NULL, second TEXT NOT NULL, "
+                                    "PRIMARY KEY (first, second)) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS false_positives_second "
+                                    "ON false_positives (second)")
+            self.connection.commit()
+
+    def iter_pairs(self):
+        return iter(self.connection.execute("SELECT first, second FROM false_positives"))
+
+    def add_pairs(self, pairs):
+        batch = []
+        for first, second in pairs:
+            if first == second:
+                continue
+            batch.append(canonical_pair(first, second))
+            if len(batch) >= SQLITE_BATCH_SIZE:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+
+    def _insert(self, batch):
+        self.connection.executemany("INSERT OR IGNORE INTO false_positives (first, second) VALUES (?, ?)", batch)
+
+    def flush(self):
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def open_false_positives_store(path, flag='c'):
+    """
+    Open the false positives store, the backend is guessed from the file name.
+    A legacy shelve path is redirected to the SQLite store next to it once it was migrated,
+    so the restore info written by older versions keeps working.
+
+    :param path:
+    :param flag: 'c' to create the store if missing, 'r' for read only
+    :return: a FalsePositivesStore or None if the store does not exist and flag is 'r'
+    """
+    if backend_from_path(path) == BACKEND_SHELVE:
+        sqlite_path = os.path.join(os.path.dirname(path), FALSE_POSITIVES_FILE_NAME)
+        if os.path.basename(path) == FALSE_POSITIVES_LEGACY_FILE_NAME and os.path.exists(sqlite_path):
+            path = sqlite_path
+    if backend_from_path(path) == BACKEND_SQLITE:
+        if flag == 'r' and not os.path.exists(path):
+            return None
+        return SqliteFalsePositivesStore(path, flag=flag)
+    if flag == 'r' and not shelve_exists(path):
+        return None
+    return ShelveFalsePositivesStore(path, flag=flag)
+
+
+def prepare_false_positives_store(persistence_folder):
+    """
+    Return the path of the false positives store in a persistence folder.
+    The false positives of an existing shelve db are migrated the first time.
+
+    :param persistence_folder:
+    :return: path of the false positives store
+    """
+    path = os.path.join(persistence_folder, FALSE_POSITIVES_FILE_NAME)
+    if os.path.exists(path):
+        return path
+    shelve_path = os.path.join(persistence_folder, FALSE_POSITIVES_LEGACY_FILE_NAME)
+    with SqliteFalsePositivesStore(path) as store:
+        if shelve_exists(shelve_path):
+            with ShelveFalsePositivesStore(shelve_path, flag='r') as legacy:
+                store.add_pairs(legacy.iter_pairs())
+    return path
@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from .Common import print_to_stdout
+from .DuplicateIndex import DuplicateIndex
+from .HashCache import content_prefix
+from .HashCache import entry_metadata
+from .HashCache import store_hashes
+from .Hashing import ALGORITHMS
+from .Hashing import DEFAULT_ALGORITHM
+from .Hashing import algorithm_tag
+from .Matcher import ENGINE_THREAD
+from .Matcher import _compute_hash_iterator
+from .Matcher import _content_false_positives
+from .Matcher import _false_positive_content_prefixes
+from .Matcher import _load_false_positives
+from .Matcher import _prepare_duplicates_folder
+from .Mover import MOVE_WORKERS
+from .Mover import apply_plan
+from .Mover import next_group_id
+from .Mover import plan_group
+from .Ranking import DEFAULT_RANKING
+from .Ranking import best_images
+from .Scanner import DEFAULT_EXCLUDE_NAMES
+from .Scanner import FILTER_NONE
+from .Scanner import ScanEntry
+from .Scanner import accept_path
+from .Scanner import scan
+from .Search import hex_to_packed
+from .Search import threshold_to_distance
+from .Store import SearchIndexStore
+from .Store import open_hash_store
+
+WATCHER_WATCHDOG = "watchdog"
+WATCHER_POLLING = "polling"
+
+# Seconds between two scans of the polling watcher
+POLL_INTERVAL = 2.0
+# Seconds a file must stay unchanged before it is hashed, so the files being copied are not read
+SETTLE_TIME = 1.0
+# Seconds between two saves of the search index
+INDEX_SAVE_INTERVAL = 300.0
+
+
+def watchdog_available():
+    """
+    :return: True if the watchdog package (inotify and the other native watchers) is installed
+    """
+    try:
+        import watchdog  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class PollingWatcher:
+    """
+    Watch a folder by scanning it periodically, used when watchdog is not installed.
+    """
+
+    def __init__(self, folder, recursive=True, file_filter=FILTER_NONE, exclude_paths=(), interval=POLL_INTERVAL):
+        self.folder = folder
+        self.recursive = recursive
+        self.file_filter = file_filter
+        self.exclude_paths = exclude_paths
+        self.interval = interval
+        self.snapshot = dict()  # Map from path to (size, mtime_ns)
+
+    def prime(self, entries):
+        """
+        Set the files already known.
+
+        :param entries: iterable of Scanner.ScanEntry
+        """
+        self.snapshot = {path: (stat.st_size, stat.st_mtime_ns) for path, stat in entries}
+
+    def poll(self, timeout):
+        """
+        Wait for the changes.
+
+        :param timeout: maximum seconds to wait
+        :return: 3-ple (changed, removed, removed_folders) lists of paths,
+                 the files of a removed folder are all reported as removed
+        """
+        time.sleep(min(timeout, self.interval))
+        snapshot = {path: (stat.st_size, stat.st_mtime_ns)
+                    for path, stat in scan(self.folder, recursive=self.recursive, file_filter=self.file_filter,
+                                           exclude_paths=self.exclude_paths)}
+        changed = [path for path, signature in snapshot.items() if self.snapshot.get(path) != signature]
+        removed = [path for path in self.snapshot if path not in snapshot]
+        self.snapshot = snapshot
+        return changed, removed, []
+
+    def close(self):
+        pass
+
+
+class WatchdogWatcher:
+    """
+    Watch a folder with the native file system events (inotify on Linux) through watchdog.
+    """
+
+    def __init__(self, folder, recursive=True, file_filter=FILTER_NONE, exclude_paths=()):
+        from watchdog.events import EVENT_TYPE_CREATED
+        from watchdog.events import EVENT_TYPE_DELETED
+        from watchdog.events import EVENT_TYPE_MODIFIED
+        from watchdog.events import EVENT_TYPE_MOVED
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+        self.folder = folder
+        self.recursive = recursive
+        self.file_filter = file_filter
+        self.exclude_paths = exclude_paths
+        self.events = queue.Queue()  # 2-ples (path, True if the path is a folder)
+        events = self.events
+        file_event_types = (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED, EVENT_TYPE_DELETED)
+        # A folder is modified whenever a file is created in it, only the new and moved folders are scanned
+        folder_event_types = (EVENT_TYPE_CREATED, EVENT_TYPE_MOVED, EVENT_TYPE_DELETED)
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type not in (folder_event_types if event.is_directory else file_event_types):
+                    return
+                events.put((event.src_path, event.is_directory))
+                if event.event_type == EVENT_TYPE_MOVED:
+                    events.put((event.dest_path, event.is_directory))
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), folder, recursive=recursive)
+        self.observer.start()
+
+    def prime(self, entries):
+        pass
+
+    def poll(self, timeout):
+        paths = set()
+        try:
+            paths.add(self.events.get(timeout=timeout))
+            while True:
+                paths.add(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        changed = []
+        removed = []
+        removed_folders = []
+        for path, is_directory in paths:
+            if is_directory and os.path.isdir(path):
+                # A folder moved in the tree does not report its files
+                changed.extend(entry.path for entry in scan(path, recursive=self.recursive,
+                                                            file_filter=self.file_filter,
+                                                            exclude_paths=self.exclude_paths))
+            elif os.path.isfile(path):
+                if accept_path(path, self.file_filter):
+                    changed.append(path)
+            elif is_directory and not os.path.exists(path):
+                # The files of a folder moved out of the tree are not reported
+                removed_folders.append(path)
+            elif not os.path.exists(path):
+                removed.append(path)
+        return list(dict.fromkeys(changed)), removed, removed_folders
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+class _QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, duplicate_daemon):
+        super().__init__(socket_path, _QueryHandler)
+        self.duplicate_daemon = duplicate_daemon
+
+
+class _QueryHandler(socketserver.StreamRequestHandler):
+    """
+    A JSON object per line is read and answered, see DuplicateDaemon.handle_request.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.duplicate_daemon.handle_request(json.loads(line))
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+def query_socket(socket_path, path=None, hash_str=None, threshold=None):
+    """
+    Ask a running daemon for the duplicates of an image.
+
+    :param socket_path: query socket of the daemon
+    :param path: path of the image
+    :param hash_str: serialized hash of the image, instead of the path
+    :param threshold: similarity threshold, the one of the daemon by default
+    :return: the response, a dict with the list of duplicates {'path': ..., 'distance': ...} or an error
+    """
+    request = {key: value for key, value in (('path', path), ('hash', hash_str), ('threshold', threshold))
+               if value is not None}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        with connection.makefile('rw', encoding='utf-8') as hand:
+            hand.write(json.dumps(request) + "\n")
+            hand.flush()
+            return json.loads(hand.readline())
+
+
+class DuplicateDaemon:
+    """
+    Keep the hash store and the search index of a folder loaded and look for
+    the duplicates of the images as soon as they arrive.
+    The hash store is used only by the thread calling run, the search index
+    is shared with the query socket under a lock.
+    """
+
+    def __init__(self, folder, db_path, index_path, threshold=0.1, duplicates_folder=None,
+                 false_positives_db_path=None, recursive=True, file_filter=FILTER_NONE, decode_size=None,
+                 algorithm=DEFAULT_ALGORITHM, socket_path=None, workers=None, watcher=None,
+                 poll_interval=POLL_INTERVAL, settle_time=SETTLE_TIME, move_workers=MOVE_WORKERS, quiet=False,
+                 ranking=DEFAULT_RANKING):
+        """
+        :param folder: folder to watch
+        :param db_path: hash store, None to keep the hashes in memory
+        :param index_path: search index file, None to keep the index in memory
+        :param threshold: threshold under which images are considered duplicates
+        :param duplicates_folder: folder where the duplicates are moved to, None to only report them
+        :param false_positives_db_path: db to load the false positives from
+        :param file_filter: filter of the files, one of Scanner.FILTERS
+        :param algorithm: hashing algorithm, one of Hashing.INDEXABLE_ALGORITHMS
+        :param socket_path: path of the query socket, None for no socket
+        :param watcher: WATCHER_WATCHDOG or WATCHER_POLLING, watchdog if it is installed by default
+        :param poll_interval: seconds between two scans of the polling watcher
+        :param settle_time: seconds a file must stay unchanged before it is hashed
+        :param ranking: keys ranking the image kept in each group, see Ranking.RANK_KEYS
+        """
+        self.folder = os.path.abspath(folder)
+        self.db_path = db_path
+        self.index_path = index_path
+        self.threshold = threshold
+        self.duplicates_folder = duplicates_folder
+        self.false_positives_db_path = false_positives_db_path
+        self.recursive = recursive
+        self.file_filter = file_filter
+        self.decode_size = decode_size
+        self.algorithm = algorithm
+        self.tag = algorithm_tag(decode_size, algorithm)
+        self.n_bits = ALGORITHMS[algorithm].n_bits
+        self.socket_path = socket_path
+        self.workers = workers
+        self.watcher_type = watcher
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.move_workers = move_workers
+        self.ranking = ranking
+        self.quiet = quiet
+        self.exclude_paths = () if duplicates_folder is None else (duplicates_folder,)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.ready = threading.Event()
+        self.pending = dict()  # Files not settled yet, map from path to ((size, mtime_ns), first seen)
+        self.db = None
+        self.index = None
+        self.duplicate_index = None
+        self.watcher = None
+        self.server = None
+        self.false_positives = dict()
+        self.content_prefixes = set()  # See Matcher._false_positive_content_prefixes
+        self.next_group_id = 1
+
+    def _log(self, text):
+        not self.quiet and print_to_stdout(text)
+
+    def _is_excluded(self, path):
+        parts = os.path.relpath(path, self.folder).split(os.sep)
+        if any(part in DEFAULT_EXCLUDE_NAMES for part in parts):
+            return True
+        return any(os.path.commonpath([path, os.path.abspath(excluded)]) == os.path.abspath(excluded)
+                   for excluded in self.exclude_paths)
+
+    def start(self):
+        """
+        Load the stores, synchronise the index with the folder and start the watcher and the query socket.
+        """
+        self.db = open_hash_store(self.db_path)
+        self.index = SearchIndexStore(self.index_path, self.tag, self.n_bits)
+        self.duplicate_index = DuplicateIndex(self.index, self.algorithm, self.decode_size, self.threshold)
+        self.false_positives = _load_false_positives(self.false_positives_db_path)
+        self.content_prefixes = _false_positive_content_prefixes(self.false_positives)
+        if self.duplicates_folder is not None:
+            os.makedirs(self.duplicates_folder, exist_ok=True)
+            _prepare_duplicates_folder(self.duplicates_folder, self.false_positives_db_path, self.move_workers,
+                                       self.quiet)
+            self.next_group_id = next_group_id(self.duplicates_folder)
+        self._log("# Indexing %s" % self.folder)
+        entries = list(scan(self.folder, recursive=self.recursive, file_filter=self.file_filter,
+                            exclude_paths=self.exclude_paths))
+        paths, packed = self._hash(entries)
+        with self.lock:
+            self.index.update(paths, packed)
+        self.index.flush()
+        if self.watcher_type is None:
+            self.watcher_type = WATCHER_WATCHDOG if watchdog_available() else WATCHER_POLLING
+        if self.watcher_type == WATCHER_WATCHDOG:
+            self.watcher = WatchdogWatcher(self.folder, self.recursive, self.file_filter, self.exclude_paths)
+        else:
+            self.watcher = PollingWatcher(self.folder, self.recursive, self.file_filter, self.exclude_paths,
+                                          interval=self.poll_interval)
+            self.watcher.prime(entries)
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = _QueryServer(self.socket_path, self)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._log("# Watching %d images" % len(self.index))
+        self.ready.set()
+
+    def _hash(self, entries):
+        """
+        Hash files through the hashing pipeline, the hashes are cached in the hash store.
+
+        :param entries: list of Scanner.ScanEntry
+        :return: 2-ple (paths, packed hashes) of the images
+        """
+        paths = []
+        hash_strs = []
+        iterator = _compute_hash_iterator(self.folder, self.db, engine=ENGINE_THREAD, workers=self.workers,
+                                          decode_size=self.decode_size, algorithms=(self.algorithm,),
+                                          entries=entries)
+        for path, hashes, stat, cached, metadata in iterator:
+            if not cached:
+                store_hashes(self.db, path, stat, hashes, metadata)
+            paths.append(path)
+            hash_strs.append(hashes[self.tag])
+        self.db.flush()
+        return paths, hex_to_packed(hash_strs, self.n_bits)
+
+    def run(self):
+        """
+        Process the changes until stop is called.
+        """
+        if not self.ready.is_set():
+            self.start()
+        last_save = time.monotonic()
+        try:
+            while not self.stopped.is_set():
+                timeout = self.settle_time if len(self.pending) > 0 else self.poll_interval
+                changed, removed, removed_folders = self.watcher.poll(timeout)
+                self._remove([path for path in removed if not self._is_excluded(path)],
+                             [path for path in removed_folders if not self._is_excluded(path)])
+                self._track([path for path in changed if not self._is_excluded(path)])
+                self.process(self._settled())
+                if time.monotonic() - last_save >= INDEX_SAVE_INTERVAL:
+                    with self.lock:
+                        self.index.flush()
+                    last_save = time.monotonic()
+        finally:
+            self.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _track(self, paths):
+        now = time.monotonic()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.pending.pop(path, None)
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if path not in self.pending or self.pending[path][0] != signature:
+                self.pending[path] = (signature, now)
+
+    def _settled(self):
+        """
+        :return: list of Scanner.ScanEntry of the pending files that did not change for settle_time
+        """
+        now = time.monotonic()
+        entries = []
+        for path, (signature, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != signature:
+                self.pending[path] = ((stat.st_size, stat.st_mtime_ns), now)
+            elif now - since >= self.settle_time:
+                del self.pending[path]
+                entries.append(ScanEntry(path, stat))
+        return entries
+
+    def _remove(self, paths, folders=()):
+        """
+        Remove files from the index, the removed folders are swept for the files under them.
+
+        :param paths: list of paths of files
+        :param folders: list of paths of folders
+        """
+        with self.lock:
+            self.index.remove(paths)
+            if len(folders) > 0:
+                prefixes = tuple(folder + os.sep for folder in folders)
+                self.index.remove([indexed for indexed in self.index.rows if indexed.startswith(prefixes)])
+
+    def process(self, entries):
+        """
+        Hash new files and report or move their duplicates.
+
+        :param entries: list of Scanner.ScanEntry
+        :return: map from path to the list of its duplicates
+        """
+        result = dict()
+        if len(entries) == 0:
+            return result
+        paths, packed = self._hash(entries)
+        max_distance = threshold_to_distance(self.threshold, self.n_bits)
+        with self.lock:
+            changed = self.index.diff(paths, packed)
+            # Added before the query, so the files arriving together are matched too
+            self.index.add([paths[i] for i in changed], packed[changed])
+            matches = self.index.query(packed[changed], max_distance)
+        content_false_positives = self._content_false_positives(
+            [paths[i] for i in changed] + [match for match_paths, _ in matches for match in match_paths])
+        handled = set()
+        for i, (match_paths, _) in zip(changed, matches):
+            path = paths[i]
+            if path in handled:
+                continue
+            false_positives = self.false_positives.get(path, set()) | content_false_positives.get(path, set())
+            duplicates = sorted(match for match in match_paths if match != path and match not in handled and
+                                match not in false_positives and os.path.exists(match))
+            if len(duplicates) == 0:
+                continue
+            handled.update([path] + duplicates)
+            result[path] = duplicates
+            self._log("Duplicates found for %s: %s" % (path, ", ".join(duplicates)))
+        if self.duplicates_folder is not None:
+            self._move(result)
+        return result
+
+    def _content_false_positives(self, paths):
+        """
+        :param paths: paths of the new files and of their matches
+        :return: map from path to the set of its false positives by content, see Matcher._content_false_positives
+        """
+        if len(self.content_prefixes) == 0:
+            return dict()
+        candidates = []
+        metadata = dict()
+        for path in dict.fromkeys(paths):
+            entry = self.db.get_entry(path, self.tag)
+            if entry is None:
+                continue
+            candidates.append((content_prefix(self.tag, entry['hash']), path))
+            info = entry_metadata(entry)
+            if info is not None:
+                metadata[path] = info
+        return _content_false_positives(self.false_positives, self.content_prefixes, candidates, metadata, dict())
+
+    def _move(self, result):
+        groups = [[path] + duplicates for path, duplicates in result.items()]
+        # The images are ranked from the metadata cached while hashing
+        metadata = dict()
+        for path in (path for paths in groups for path in paths):
+            entry = self.db.get_entry(path, self.tag)
+            info = None if entry is None else entry_metadata(entry)
+            if info is not None:
+                metadata[path] = info
+        plan = []
+        for paths, best in zip(groups, best_images(groups, metadata, self.ranking)):
+            move = plan_group(self.next_group_id, self.duplicates_folder, best, paths)
+            self.next_group_id += 1
+            plan.append(move)
+        apply_plan(self.duplicates_folder, plan, metadata, workers=self.move_workers)
+        self._remove([path for move in plan for _, path in move.duplicates])
+
+    def handle_request(self, request):
+        """
+        Answer a query of the socket.
+
+        :param request: dict with the 'path' or the serialized 'hash' of an image and an optional 'threshold'
+        :return: dict with the list of the duplicates, {'path': ..., 'distance': ...} sorted by distance
+        """
+        threshold = request.get('threshold', self.threshold)
+        path = request.get('path')
+        hash_str = request.get('hash')
+        if hash_str is None:
+            if path is None:
+                return {'error': "A path or a hash is required"}
+            # Hashed out of the lock, the index is not needed
+            hash_str = self.duplicate_index.hash(path)
+            if hash_str is None:
+                return {'error': "Cannot read the image %s" % path}
+        exclude = None if path is None else [os.path.abspath(path)]
+        with self.lock:
+            matches, = self.duplicate_index.query_hashes([hash_str], threshold, exclude)
+        return {'duplicates': [match._asdict() for match in matches]}
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.index is not None:
+            with self.lock:
+                self.index.close()
+            self.index = None
+            self.duplicate_index = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def watch(folder, db_path=None, index_path=None, **kwargs):
+    """
+    Run a DuplicateDaemon until interrupted, see DuplicateDaemon for the arguments.
+    """
+    daemon = DuplicateDaemon(folder, db_path, index_path, **kwargs)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+
+from ..dupimage import Benchmark
+
+from .common import Common
+
+
+class BenchmarkAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+        Structure is
+            corpus/
+            work/
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_benchmark")
+        self.corpus_folder = os.path.join(self._test_main_folder, "corpus")
+        self.work_folder = os.path.join(self._test_main_folder, "work")
+        os.mkdir(self.work_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def testBenchmarkOnSyntheticCorpus(self):
+        # Given a synthetic corpus of 3 images with their near duplicates
+        variants = [Benchmark.VARIANT_RECOMPRESSED, Benchmark.VARIANT_COLOUR_SHIFTED]
+        self.assertEqual(Benchmark.generate_corpus(self.corpus_folder, 3, size=64, variants=variants, workers=1), 9)
+        # When the benchmark runs on it
+        results = Benchmark.run_benchmark(self.corpus_folder, self.work_folder, workers=1, sample=4, move=True)
+        # Then every image is grouped with its near duplicates
+        self.assertEqual((results['groups'], results['duplicates']), (3, 6))
+        # And every stage is measured
+        self.assertEqual(list(results['stages']), ["scan", "decode", "hash", "hash_pipeline", "db_load",
+                                                   "build_tree", "query", "neighbours", "grouping", "move"])
+        self.assertEqual(results['stages']['hash_pipeline']['items'], 9)
+        self.assertEqual(results['stages']['decode']['items'], 4)
+        self.assertTrue(results['stages']['query']['latency']['p99_ms'] >= 0)
+        # And the results can be saved as JSON
+        self.assertEqual(json.loads(json.dumps(results)), results)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from ..dupimage import Clustering
+from ..dupimage import Matcher
+from .common import Common
+from .common import to_relpath
+from .common import AT_DATA_FOLDER
+
+
+def _graph(n_hashes, *edges):
+    rows = [edge[0] for edge in edges] + [edge[1] for edge in edges]
+    cols = [edge[1] for edge in edges] + [edge[0] for edge in edges]
+    return csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_hashes, n_hashes))
+
+
+class ClusteringAT(Common):
+
+    def testTransitiveDuplicatesAreGrouped(self):
+        # Given three hashes where a ~ b and b ~ c but not a ~ c
+        graph = _graph(3, (0, 1), (1, 2))
+        files_by_hash = [["/c.png"], ["/b.png"], ["/a.png", "/a_copy.png"]]
+        # When the duplicates are grouped greedily
+        greedy = dict(Clustering.find_groups(graph, files_by_hash, {}, clustering=Clustering.CLUSTERING_GREEDY))
+        # Then the group is split
+        self.assertEqual(greedy, {"/c.png": ["/b.png"], "/a.png": ["/a_copy.png", "/b.png"]})
+        # When the duplicates are grouped by components
+        components = list(Clustering.find_groups(graph, files_by_hash, {},
+                                                 clustering=Clustering.CLUSTERING_COMPONENTS))
+        # Then all the files are in the same group
+        self.assertEqual(components, [("/a.png", ["/a_copy.png", "/b.png", "/c.png"])])
+
+    def testComponentsDoNotDependOnOrder(self):
+        graph = _graph(4, (0, 1), (2, 3))
+        files_by_hash = [["/d.png"], ["/a.png"], ["/c.png", "/e.png"], ["/b.png"]]
+        expected = list(Clustering.component_groups(graph, files_by_hash, {}))
+        # When the hashes are found in reverse order
+        reversed_graph = _graph(4, (3, 2), (1, 0))
+        reversed_files = [list(reversed(files)) for files in reversed(files_by_hash)]
+        # Then the groups are the same
+        self.assertEqual(list(Clustering.component_groups(reversed_graph, reversed_files, {})), expected)
+        self.assertEqual(expected, [("/a.png", ["/d.png"]), ("/b.png", ["/c.png", "/e.png"])])
+
+    def testFalsePositivesAreKeptApart(self):
+        # Given files with the same hash, one of them is a false positive of another
+        graph = _graph(2, (0, 1))
+        files_by_hash = [["/a.png", "/b.png"], ["/c.png"]]
+        false_positives = {"/a.png": ["/b.png"], "/b.png": ["/a.png"]}
+        # When the duplicates are grouped by components
+        groups = list(Clustering.component_groups(graph, files_by_hash, false_positives))
+        # Then the false positives are not grouped, even through c
+        self.assertEqual(groups, [("/a.png", ["/c.png"])])
+        # And without c the files are not grouped
+        self.assertEqual(list(Clustering.component_groups(_graph(1), files_by_hash[:1], false_positives)), [])
+
+    def testFindRecursiveComponents(self):
+        # Given a folder with subfolders
+        folder = os.path.join(AT_DATA_FOLDER, "recursive")
+        # When the duplicates are grouped by components
+        result = Matcher.find_similar(folder, recursive=True, threshold=0.1, print_result=False, quiet=True,
+                                      clustering=Clustering.CLUSTERING_COMPONENTS)
+        # Then the first path of each group is the anchor
+        result = to_relpath(result, folder=folder)
+        self.assertEqual(result, {
+            "cat_duplicate1.jpg": ["cats/cat_best.png", "cats/cat_duplicate2.jpg"],
+            "house_best.png": ["misc/house_duplicate.jpg"],
+        })
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+from PIL import Image
+
+from ..dupimage import Matcher
+from ..dupimage.DuplicateIndex import open_duplicate_index
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+
+class DuplicateIndexAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+        Structure is
+            data/
+            .db/{hashes.sqlite, index.npz}
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_duplicate_index")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        db_folder = os.path.join(self._test_main_folder, ".db")
+        os.mkdir(db_folder)
+        self.db_path = os.path.join(db_folder, "hashes.sqlite")
+        self.index_path = os.path.join(db_folder, "index.npz")
+        # The archive is indexed by a previous run
+        Matcher.find_similar(self.test_folder, db_path=self.db_path, index_path=self.index_path, quiet=True)
+        self.house = os.path.join(self.test_folder, "house_best.png")
+        self.house_duplicate = os.path.join(self.test_folder, "misc", "house_duplicate.jpg")
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def testQueryImages(self):
+        # Given an index loaded from the hash store
+        with open_duplicate_index(db_path=self.db_path) as index:
+            # When an indexed image is queried by path
+            matches = index.query(self.house)
+            # Then its duplicates are found, but not the image itself
+            self.assertEqual([match.path for match in matches], [self.house_duplicate])
+            # When an upload is queried by content
+            with open(self.house, "rb") as hand:
+                content = hand.read()
+            # Then the indexed image is found as an exact match
+            self.assertEqual(index.query(content)[0], (self.house, 0))
+            with Image.open(self.house) as image:
+                self.assertEqual(index.query(image)[0], (self.house, 0))
+            # And the threshold can be changed per query
+            self.assertEqual(len(index.query(os.path.join(self.test_folder, "misc", "tree.jpg"), threshold=0.5)), 5)
+
+    def testQueryBatch(self):
+        # Given the index persisted by a previous run
+        with open_duplicate_index(index_path=self.index_path) as index:
+            self.assertEqual(len(index), 6)
+            # When a batch of uploads is checked
+            results = index.query_batch([self.house_duplicate, b"not an image",
+                                         os.path.join(self.test_folder, "missing.png")])
+            # Then every upload gets its matches, None if it cannot be read
+            self.assertEqual([match.path for match in results[0]], [self.house])
+            self.assertEqual(results[1:], [None, None])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+
+from ..dupimage import Exact
+from ..dupimage import Matcher
+from ..dupimage import Store
+from ..dupimage.Scanner import scan
+
+from .common import Common
+from .common import to_relpath
+from .common import AT_DATA_FOLDER
+
+
+class ExactAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+
+        Structure:
+            data/
+                (recursive test data)
+                house_copy.png (copy of house_best.png)
+                misc/cat_copy.jpg (copy of cat_duplicate1.jpg)
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_exact")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        shutil.copy(os.path.join(self.test_folder, "house_best.png"), os.path.join(self.test_folder, "house_copy.png"))
+        shutil.copy(os.path.join(self.test_folder, "cat_duplicate1.jpg"),
+                    os.path.join(self.test_folder, "misc", "cat_copy.jpg"))
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def testSameHeadAndTailAreNotExact(self):
+        # Given two large files with the same size, head and tail
+        first = os.path.join(self._test_main_folder, "first.bin")
+        second = os.path.join(self._test_main_folder, "second.bin")
+        copy = os.path.join(self._test_main_folder, "copy.bin")
+        size = 4 * Exact.PARTIAL_DIGEST_SIZE
+        for path, middle in ((first, b'a'), (second, b'b'), (copy, b'a')):
+            with open(path, "wb") as hand:
+                hand.write(bytes(size // 2) + middle + bytes(size // 2))
+        # Then only the real copy is grouped
+        groups = Exact.find_exact_groups(scan(self._test_main_folder, recursive=False))
+        self.assertEqual(groups, [[copy, first]])
+
+    def testFindExactOnly(self):
+        result = Matcher.find_exact(self.test_folder, quiet=True)
+        result = to_relpath(result, folder=self.test_folder)
+        self.assertEqual(result, {"cat_duplicate1.jpg": ["cats/cat_duplicate2.jpg", "misc/cat_copy.jpg"],
+                                  "house_best.png": ["house_copy.png"]})
+
+    def testExactPrepassKeepsTheCopies(self):
+        # When the exact duplicates are hashed only once
+        result = Matcher.find_similar(self.test_folder, threshold=0.1, quiet=True, exact_prepass=True,
+                                      clustering="components")
+        # Then the copies are in the groups of their original
+        result = to_relpath(result, folder=self.test_folder)
+        self.assertEqual(result, {
+            "cat_duplicate1.jpg": ["cats/cat_best.png", "cats/cat_duplicate2.jpg", "misc/cat_copy.jpg"],
+            "house_best.png": ["house_copy.png", "misc/house_duplicate.jpg"],
+        })
+
+    def testDigestsAreNotStoredWithTheHashes(self):
+        # When the exact prepass caches the digests of the copies
+        db_path = os.path.join(self._test_main_folder, "hashes.npz")
+        digests_db_path = os.path.join(self._test_main_folder, Store.DIGESTS_FILE_NAME)
+        Matcher.find_similar(self.test_folder, db_path=db_path, quiet=True, exact_prepass=True,
+                             digests_db_path=digests_db_path)
+        # Then the hash store only has the image hashes, packed in 8 bytes
+        with Store.open_hash_store(db_path, flag='r') as store:
+            self.assertEqual({entry['algorithm'] for _, entry in store.iter_entries()}, {"whash-v1"})
+            _, matrix = store.load_matrix("whash-v1")
+            self.assertEqual(matrix.shape[1], 8)
+        # And the digests are in their own store
+        path = os.path.join(self.test_folder, "house_copy.png")
+        with Store.DigestStore(digests_db_path, flag='r') as store:
+            self.assertIsNotNone(store.get_digest(path, os.stat(path), Exact.FULL_DIGEST_ALGORITHM))
+
+    def testExactFilesAreMovedWithoutDecoding(self):
+        # Given byte-identical files that are not images
+        folder = os.path.join(self._test_main_folder, "text")
+        os.mkdir(folder)
+        paths = [os.path.join(folder, name) for name in ("b.txt", "a.txt")]
+        for path in paths:
+            with open(path, "w") as hand:
+                hand.write("not an image\n" * Exact.PARTIAL_DIGEST_SIZE)
+        digests_db_path = os.path.join(self._test_main_folder, Store.DIGESTS_FILE_NAME)
+        duplicates_folder = os.path.join(self._test_main_folder, "duplicates")
+        stats = [os.stat(path) for path in paths]
+        # When they are moved
+        Matcher.find_exact(folder, quiet=True, duplicates_folder=duplicates_folder, digests_db_path=digests_db_path)
+        # Then the first path is kept
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[0]))
+        # And their digests are cached for the next run
+        with Store.DigestStore(digests_db_path, flag='r') as store:
+            for path, stat in zip(paths, stats):
+                self.assertIsNotNone(store.get_digest(path, stat, Exact.FULL_DIGEST_ALGORITHM))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+
+from ..dupimage import Matcher
+from ..dupimage.Common import compute_sha256
+from ..dupimage.HashCache import HASH_ALGORITHM
+from ..dupimage.Store import open_hash_store
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+
+class HashCacheAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+
+        Structure:
+            data/
+            hashes.db
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_hash_cache")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        test_data = os.path.join(AT_DATA_FOLDER, "mark-duplicates")
+        shutil.copytree(test_data, self.test_folder, dirs_exist_ok=True)
+        self.db_path = os.path.join(self._test_main_folder, "hashes.db")
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def _hashFolder(self, algorithms=("whash",)):
+        """
+        Hash the test folder and save the hashes on the db.
+
+        :return: map from path relative to the test folder to True if the hash was cached
+        """
+        cached = dict()
+        with open_hash_store(self.db_path) as db:
+            for result in Matcher._compute_hash_iterator(self.test_folder, db, recursive=True,
+                                                         algorithms=algorithms):
+                if not result.cached:
+                    Matcher.store_hashes(db, result.path, result.stat, result.hashes, result.metadata)
+                cached[os.path.relpath(result.path, self.test_folder)] = result.cached
+        return cached
+
+    def testUnchangedFilesAreCached(self):
+        # Given a folder already hashed
+        first_run = self._hashFolder()
+        self.assertFalse(any(first_run.values()))
+        # When the folder is hashed again
+        second_run = self._hashFolder()
+        # Then all the hashes are read from the db
+        self.assertEqual(len(second_run), 4)
+        self.assertTrue(all(second_run.values()))
+
+    def testEditedFileIsRehashed(self):
+        # Given a folder already hashed
+        self._hashFolder()
+        # When a file is edited
+        path = os.path.join(self.test_folder, "house.png")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        # Then only that file is hashed again
+        cached = self._hashFolder()
+        self.assertFalse(cached["house.png"])
+        self.assertTrue(cached["cat.png"])
+
+    def testMovedFileIsRecognised(self):
+        # Given a folder already hashed
+        self._hashFolder()
+        # When a file is moved
+        os.mkdir(os.path.join(self.test_folder, "moved"))
+        os.rename(os.path.join(self.test_folder, "house.png"), os.path.join(self.test_folder, "moved/house.png"))
+        # Then its hash is read from the db
+        cached = self._hashFolder()
+        self.assertTrue(cached["moved/house.png"])
+        # And it is stored under its new path
+        with open_hash_store(self.db_path, flag='r') as db:
+            self.assertIsNotNone(db.get_entry(os.path.join(self.test_folder, "moved/house.png"), HASH_ALGORITHM))
+            self.assertIsNone(db.get_entry(os.path.join(self.test_folder, "house.png"), HASH_ALGORITHM))
+
+    def testAlgorithmsAreStoredSideBySide(self):
+        # Given a folder already hashed with an algorithm
+        self._hashFolder()
+        # When another algorithm is requested the files are hashed again
+        self.assertFalse(any(self._hashFolder(algorithms=("whash", "phash")).values()))
+        # Then the hashes of both algorithms are cached
+        self.assertTrue(all(self._hashFolder(algorithms=("whash", "phash")).values()))
+        self.assertTrue(all(self._hashFolder(algorithms=("phash",)).values()))
+        self.assertTrue(all(self._hashFolder().values()))
+
+    def testDigestOfTheKeptFileIsStored(self):
+        # Given a folder with duplicates
+        duplicates_folder = os.path.join(self._test_main_folder, "duplicates")
+        os.mkdir(duplicates_folder)
+        # When the duplicates are moved
+        result = Matcher.find_similar(self.test_folder, db_path=self.db_path, duplicates_folder=duplicates_folder,
+                                      quiet=True)
+        # Then the sha256 of the kept files is cached with their hashes
+        kept = [path for anchor, duplicates in result.items() for path in [anchor] + duplicates
+                if os.path.exists(path)]
+        self.assertEqual(len(kept), 1)
+        with open_hash_store(self.db_path, flag='r') as db:
+            entry = db.get_entry(kept[0], HASH_ALGORITHM)
+        self.assertEqual(entry['sha256'], compute_sha256(kept[0]))
+        # And the metadata is read from the db on the next run
+        cached = self._hashFolder()
+        self.assertTrue(all(cached.values()))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import os
+import shelve
+import shutil
+import tempfile
+import time
+import imagehash
+from PIL import Image
+
+from ..dupimage import Matcher
+from ..dupimage import Search
+from ..dupimage import Store
+from ..dupimage.HashCache import HASH_ALGORITHM
+from ..dupimage.HashCache import make_entry
+from ..dupimage.Hashing import algorithm_tag
+from ..dupimage.Ranking import image_info
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+
+class HashStoreAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+
+        Structure:
+            data/
+            .db/
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_hash_store")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        test_data = os.path.join(AT_DATA_FOLDER, "recursive")
+        shutil.copytree(test_data, self.test_folder, dirs_exist_ok=True)
+        self.db_folder = os.path.join(self._test_main_folder, ".db")
+        os.mkdir(self.db_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def assertStoreContainsFolder(self, db_path, backend):
+        with Store.open_hash_store(db_path, backend=backend, flag='r') as store:
+            entries = dict(store.iter_entries())
+            paths, matrix = store.load_matrix(HASH_ALGORITHM)
+        self.assertEqual(len(entries), 6)
+        self.assertEqual(matrix.shape, (6, 8))
+        self.assertArrayEquals(paths, list(entries.keys()))
+        for path, row in zip(paths, matrix):
+            self.assertEqual(row.tobytes().hex(), entries[path]['hash'])
+        # The image metadata is stored with the hashes
+        with Image.open(paths[0]) as image:
+            expected = (image.size[0], image.size[1], image.format, os.path.getsize(paths[0]),
+                        image_info(image)[3], int('exif' in image.info))
+        entry = entries[paths[0]]
+        self.assertEqual((entry['width'], entry['height'], entry['format'], entry['size'], entry['bits'],
+                          entry['exif']), expected)
+        self.assertIsNone(entry['sha256'])
+
+    def testBackendsStoreTheHashes(self):
+        for backend in Store.BACKENDS:
+            # Given a store with the hashes of a folder
+            db_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[backend])
+            Matcher.index_folder(self.test_folder, db_path, db_backend=backend)
+            # Then all the hashes can be read back
+            self.assertStoreContainsFolder(db_path, backend)
+            # And the matches are the same for every backend
+            result = Matcher.find_similar(self.test_folder, db_path=db_path, db_backend=backend, quiet=True)
+            self.assertEqual(len(result), 2)
+
+    def testShelveIsMigrated(self):
+        # Given a persistence folder with a shelve db
+        shelve_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[Store.BACKEND_SHELVE])
+        Matcher.index_folder(self.test_folder, shelve_path)
+        # When a new backend is used
+        db_path = Store.prepare_hash_store(self.db_folder, Store.BACKEND_SQLITE)
+        # Then the hashes are migrated
+        self.assertStoreContainsFolder(db_path, Store.BACKEND_SQLITE)
+
+    def testLegacyShelveIsMigrated(self):
+        # Given a shelve db written by an older version, with a bare hash string for each path
+        shelve_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[Store.BACKEND_SHELVE])
+        paths = sorted(os.path.join(folder, name) for folder, _, names in os.walk(self.test_folder)
+                       for name in names)
+        hashes = dict()
+        with shelve.open(shelve_path) as db:
+            for path in paths:
+                with Image.open(path) as image:
+                    hashes[path] = str(imagehash.whash(image))
+                db[path] = hashes[path]
+        # And a file modified after the db was written
+        modified = paths[0]
+        os.utime(modified, ns=(os.stat(modified).st_atime_ns, time.time_ns() + 10 ** 10))
+        # When a new backend is used
+        db_path = Store.prepare_hash_store(self.db_folder, Store.BACKEND_SQLITE)
+        # Then the hashes of the other files are migrated and valid for the current files
+        with Store.open_hash_store(db_path, backend=Store.BACKEND_SQLITE, flag='r') as store:
+            entries = dict(store.iter_entries())
+        self.assertEqual(sorted(entries.keys()), paths[1:])
+        for path, entry in entries.items():
+            self.assertEqual(entry['hash'], hashes[path])
+            self.assertEqual(entry['algorithm'], HASH_ALGORITHM)
+            self.assertEqual((entry['size'], entry['mtime_ns']),
+                             (os.stat(path).st_size, os.stat(path).st_mtime_ns))
+
+    def testBackendsStoreSeveralAlgorithms(self):
+        for backend in Store.BACKENDS:
+            # Given a store with the hashes of a folder computed with several algorithms
+            db_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[backend])
+            Matcher.index_folder(self.test_folder, db_path, db_backend=backend,
+                                 algorithms=("whash", "phash", "crop_resistant"))
+            # Then the hashes of every algorithm are stored side by side
+            with Store.open_hash_store(db_path, backend=backend, flag='r') as store:
+                entries = list(store.iter_entries())
+                path = entries[0][0]
+                for name in ("whash", "phash", "crop_resistant"):
+                    tag = algorithm_tag(name=name)
+                    self.assertEqual(len([entry for _, entry in entries if entry['algorithm'] == tag]), 6)
+                    self.assertEqual(store.get_entry(path, tag)['algorithm'], tag)
+                self.assertEqual(len(store.load_matrix(algorithm_tag(name="phash"))[0]), 6)
+
+    def testSearchIndexIsUpdated(self):
+        # Given a search index saved with some hashes
+        packed = Search.hex_to_packed(["00000000000000ff", "00000000000000fe", "ff00000000000000"], 64)
+        index_path = Store.search_index_path(self.db_folder, HASH_ALGORITHM)
+        with Store.SearchIndexStore(index_path, HASH_ALGORITHM, 64) as index:
+            index.add(["/a.png", "/b.png", "/c.png"], packed)
+        # When it is updated with a scan where a file changed, one was deleted and one is new
+        scanned = Search.hex_to_packed(["00000000000000ff", "ff00000000000001", "00000000000000fc"], 64)
+        with Store.SearchIndexStore(index_path, HASH_ALGORITHM, 64) as index:
+            changed = index.update(["/a.png", "/c.png", "/d.png"], scanned)
+        # Then only the changed and new files are returned
+        self.assertEqual(changed.tolist(), [1, 2])
+        # And the saved index has the hashes of the scan
+        with Store.SearchIndexStore(index_path, HASH_ALGORITHM, 64, flag='r') as index:
+            self.assertEqual(len(index), 3)
+            self.assertFalse("/b.png" in index)
+            (paths, distances), = index.query(scanned[:1], 2)
+            self.assertEqual(sorted(zip(paths, distances.tolist())), [("/a.png", 0), ("/d.png", 2)])
+        # And an index of another algorithm is not reused
+        with Store.SearchIndexStore(index_path, algorithm_tag(name='phash'), 64, flag='r') as index:
+            self.assertEqual(len(index), 0)
+
+    def testCheckpointSurvivesACrash(self):
+        # Given the hashes of a folder
+        db_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[Store.BACKEND_SQLITE])
+        Matcher.index_folder(self.test_folder, db_path, db_backend=Store.BACKEND_SQLITE)
+        with Store.open_hash_store(db_path, flag='r') as store:
+            entries = list(store.iter_entries())
+        # When they are copied in a columnar store checkpointed every 4 files
+        columnar_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[Store.BACKEND_COLUMNAR])
+        store = Store.open_hash_store(columnar_path, backend=Store.BACKEND_COLUMNAR, flag='c')
+        checkpointer = Store.Checkpointer(store, n_files=4, interval=3600)
+        checkpoints = []
+        for path, entry in entries:
+            store.put_entry(path, entry)
+            checkpoints.append(checkpointer.update())
+        self.assertEqual(checkpoints, [False, False, False, True, False, False])
+        # And the run is interrupted before the store is closed
+        del store
+        # Then the checkpointed entries are read back
+        with Store.open_hash_store(columnar_path, backend=Store.BACKEND_COLUMNAR, flag='c') as store:
+            self.assertEqual(len(list(store.iter_entries())), 4)
+        # And the journal is removed once the store is rewritten
+        self.assertFalse(os.path.exists(columnar_path + ".journal"))
+
+    def testJournalIsNextToTheStore(self):
+        # Given a columnar store with some hashes
+        columnar_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[Store.BACKEND_COLUMNAR])
+        Matcher.index_folder(self.test_folder, columnar_path, db_backend=Store.BACKEND_COLUMNAR)
+        # When it is reopened, changed and checkpointed
+        store = Store.open_hash_store(columnar_path, backend=Store.BACKEND_COLUMNAR, flag='c')
+        path, entry = next(store.iter_entries())
+        store.put_entry(path, entry)
+        store.checkpoint()
+        # Then the journal is written next to the store, not next to the images
+        self.assertTrue(os.path.exists(columnar_path + ".journal"))
+        self.assertFalse(os.path.exists(path + ".journal"))
+        store.close()
+
+    def testDeletedEntryIsNotFoundByInode(self):
+        for backend in Store.BACKENDS:
+            # Given a store with the entry of a file not flushed yet
+            db_path = os.path.join(self.db_folder, Store.BACKEND_FILE_NAMES[backend])
+            path = os.path.join(self.test_folder, "house_best.png")
+            with Store.open_hash_store(db_path, backend=backend) as store:
+                store.put_entry(path, make_entry(os.stat(path), "00ff"))
+                # When it is deleted
+                store.delete_entry(path)
+                # Then it is not found through its inode
+                self.assertIsNone(store.get_path_by_inode(os.stat(path).st_dev, os.stat(path).st_ino))
@@ -6,6 +6,7 @@ import tempfile
 
 from ..dupimage import Matcher
 from ..dupimage import Restore
+from ..dupimage import Store
 
 from .common import Common
 from .common import AT_DATA_FOLDER
@@ -28,6 +29,7 @@ class MarkFalsePositivesAT(Common):
         shutil.copytree(test_data, self.test_folder, dirs_exist_ok=True)
         db_folder = os.path.join(self.test_folder, ".db")
         os.mkdir(db_folder)
+        self.db_folder = db_folder
         self.db_path = os.path.join(db_folder, "hashes.db")
         self.false_positives_db_path = os.path.join(db_folder, "false-positives.db")
         # Duplicates folder
@@ -38,6 +40,38 @@ class MarkFalsePositivesAT(Common):
         shutil.rmtree(self._test_main_folder)
 
     def testFalsePositivesAreMarked(self):
+        self.assertFalsePositivesAreMarked()
+
+    def testFalsePositivesAreMarkedInSqlite(self):
+        self.false_positives_db_path = Store.prepare_false_positives_store(self.db_folder)
+        self.assertFalsePositivesAreMarked()
+        with Store.open_false_positives_store(self.false_positives_db_path, flag='r') as store:
+            pair = Store.canonical_pair(os.path.join(self.test_folder, "cat_false_positive.jpg"),
+                                        os.path.join(self.test_folder, "cat.png"))
+            self.assertTrue(pair in set(store.iter_pairs()))
+
+    def testFalsePositivesSurviveRenames(self):
+        # Given false positives stored with their content ids, renamed after the restore
+        self.false_positives_db_path = Store.prepare_false_positives_store(self.db_folder)
+        # Then they are still not moved
+        self.assertFalsePositivesAreMarked(reorganise=True)
+
+    def testLegacyFalsePositivesAreMigrated(self):
+        # Given false positives in a shelve written by an older version
+        legacy_path = os.path.join(self.db_folder, Store.FALSE_POSITIVES_LEGACY_FILE_NAME)
+        with Store.ShelveFalsePositivesStore(legacy_path) as store:
+            store.add("/b.png", ["/a.png", "/c.png"])
+            store.add("/a.png", ["/b.png"])
+        # When the store is prepared
+        path = Store.prepare_false_positives_store(self.db_folder)
+        # Then the pairs are migrated once, in canonical order
+        with Store.open_false_positives_store(path, flag='r') as store:
+            self.assertEqual(sorted(store.iter_pairs()), [("/a.png", "/b.png"), ("/b.png", "/c.png")])
+        # And the legacy path is redirected to the migrated store
+        with Store.open_false_positives_store(legacy_path) as store:
+            self.assertIsInstance(store, Store.SqliteFalsePositivesStore)
+
+    def assertFalsePositivesAreMarked(self, reorganise=False):
         # Given a folder with duplicates removed
         # - Find matches
         Matcher.find_similar(self.test_folder, recursive=True, duplicates_folder=self.duplicates_folder,
@@ -61,6 +95,12 @@ class MarkFalsePositivesAT(Common):
         # - Ensure false positive is restored
         false_positive_path = os.path.join(self.test_folder, "cat_false_positive.jpg")
         self.assertTrue(os.path.exists(false_positive_path))
+        if reorganise:
+            # - Rename and move the false positive
+            reorganised_path = os.path.join(self.test_folder, "reorganised", "renamed_cat.jpg")
+            os.makedirs(os.path.dirname(reorganised_path))
+            os.rename(false_positive_path, reorganised_path)
+            false_positive_path = reorganised_path
         # When the duplicates are moved again
         Matcher.find_similar(self.test_folder, recursive=True, duplicates_folder=self.duplicates_folder,
                              db_path=self.db_path, false_positives_db_path=self.false_positives_db_path, quiet=True)
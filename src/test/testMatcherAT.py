@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import csv
+import json
 import os
+import shutil
+import tempfile
+from PIL import Image
 
 from ..dupimage import Matcher
+from ..dupimage.Output import open_sink
 from .common import Common
 from .common import to_relpath
 from .common import AT_DATA_FOLDER
@@ -45,3 +51,126 @@ class MatcherAT(Common):
         self.assertTrue(len(result.keys()), 2)
         self.assertDuplicatesInResult(result, "cat_duplicate1.jpg", "cats/cat_duplicate2.jpg", "cats/cat_best.png")
         self.assertDuplicatesInResult(result, "house_best.png", "misc/house_duplicate.jpg")
+
+    def testFindRecursiveProcessEngine(self):
+        # Given a folder with subfolders
+        folder = os.path.join(AT_DATA_FOLDER, "recursive")
+        # When the user hashes the images with worker processes
+        result = Matcher.find_similar(folder, recursive=True, threshold=0.1, print_result=False, quiet=True,
+                                      engine=Matcher.ENGINE_PROCESS, workers=2)
+        # Then the duplicates are the same found by the thread engine
+        result = to_relpath(result, folder=folder)
+        self.assertEqual(len(result.keys()), 2)
+        self.assertDuplicatesInResult(result, "cat_duplicate1.jpg", "cats/cat_duplicate2.jpg", "cats/cat_best.png")
+        self.assertDuplicatesInResult(result, "house_best.png", "misc/house_duplicate.jpg")
+
+    def testFindRecursiveFastDecode(self):
+        # Given a folder with subfolders
+        folder = os.path.join(AT_DATA_FOLDER, "recursive")
+        # When the images are decoded at a reduced size
+        result = Matcher.find_similar(folder, recursive=True, threshold=0.1, print_result=False, quiet=True,
+                                      decode_size=128)
+        # Then the same duplicates are found
+        result = to_relpath(result, folder=folder)
+        self.assertEqual(len(result.keys()), 2)
+        self.assertDuplicatesInResult(result, "cat_duplicate1.jpg", "cats/cat_duplicate2.jpg", "cats/cat_best.png")
+        self.assertDuplicatesInResult(result, "house_best.png", "misc/house_duplicate.jpg")
+
+    def testFastDecodeOfPaletteImages(self):
+        # Given large palette images, which Image.reduce cannot handle
+        test_folder = tempfile.mkdtemp(suffix="dif_palette")
+        try:
+            image = Image.open(os.path.join(AT_DATA_FOLDER, "recursive", "house_best.png")).convert('RGB')
+            image = image.resize((1024, 1024)).convert('P', palette=Image.ADAPTIVE)
+            image.save(os.path.join(test_folder, "house.png"))
+            image.save(os.path.join(test_folder, "house.gif"))
+            # When the images are decoded at a reduced size, also for a colour algorithm
+            for algorithm in ('whash', 'colorhash'):
+                result = Matcher.find_similar(test_folder, threshold=0.1, print_result=False, quiet=True,
+                                              decode_size=256, algorithm=algorithm)
+                # Then they are hashed and found as duplicates
+                result = to_relpath(result, folder=test_folder)
+                self.assertDuplicatesInResult(result, "house.png", "house.gif")
+        finally:
+            shutil.rmtree(test_folder)
+
+    def testConfirmAlgorithmRemovesCandidates(self):
+        # Given a folder where the color hashes of different images are similar
+        folder = os.path.join(AT_DATA_FOLDER, "recursive")
+        coarse = Matcher.find_similar(folder, threshold=0.1, quiet=True, algorithm="colorhash")
+        self.assertEqual(len(coarse.keys()), 1)
+        # When the candidates must also match the wavelet hash
+        result = Matcher.find_similar(folder, threshold=0.1, quiet=True, algorithm="colorhash",
+                                      confirm_algorithm="whash", confirm_threshold=0.1)
+        # Then only the real duplicates are found
+        result = to_relpath(result, folder=folder)
+        self.assertEqual(len(result.keys()), 2)
+        self.assertDuplicatesInResult(result, "cat_duplicate1.jpg", "cats/cat_duplicate2.jpg", "cats/cat_best.png")
+        self.assertDuplicatesInResult(result, "house_best.png", "misc/house_duplicate.jpg")
+
+    def testIncrementalRunOnlyReportsChangedImages(self):
+        # Given a folder indexed by a previous run
+        main_folder = tempfile.mkdtemp(suffix="dif_incremental")
+        self.addCleanup(shutil.rmtree, main_folder)
+        folder = os.path.join(main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), folder)
+        index_path = os.path.join(main_folder, "index.npz")
+        result = Matcher.find_similar(folder, threshold=0.1, quiet=True, index_path=index_path, incremental=True)
+        self.assertEqual(len(result), 2)
+        # When nothing changed
+        result = Matcher.find_similar(folder, threshold=0.1, quiet=True, index_path=index_path, incremental=True)
+        # Then no duplicates are reported again
+        self.assertEqual(result, {})
+        # When a duplicate arrives
+        shutil.copy(os.path.join(folder, "house_best.png"), os.path.join(folder, "house_copy.png"))
+        result = Matcher.find_similar(folder, threshold=0.1, quiet=True, index_path=index_path, incremental=True)
+        # Then only its group is reported
+        result = to_relpath(result, folder=folder)
+        self.assertEqual(len(result), 1)
+        self.assertDuplicatesInResult(result, "house_best.png", "house_copy.png", "misc/house_duplicate.jpg")
+
+    def testInterruptedRunIsNotIndexed(self):
+        main_folder = tempfile.mkdtemp(suffix="dif_interrupted")
+        self.addCleanup(shutil.rmtree, main_folder)
+        index_path = os.path.join(main_folder, "index.npz")
+
+        class FailingSink:
+            def write_group(self, record):
+                raise RuntimeError("Interrupted")
+
+        # When a run fails while the groups are handled
+        with self.assertRaises(RuntimeError):
+            Matcher.find_similar(os.path.join(AT_DATA_FOLDER, "recursive"), threshold=0.1, quiet=True,
+                                 index_path=index_path, incremental=True, sink=FailingSink())
+        # Then the next incremental run still reports all the groups
+        result = Matcher.find_similar(os.path.join(AT_DATA_FOLDER, "recursive"), threshold=0.1, quiet=True,
+                                      index_path=index_path, incremental=True)
+        self.assertEqual(len(result), 2)
+
+    def testGroupsAreStreamedToASink(self):
+        folder = os.path.join(AT_DATA_FOLDER, "recursive")
+        output_folder = tempfile.mkdtemp(suffix="dif_output")
+        self.addCleanup(shutil.rmtree, output_folder)
+        jsonl_path = os.path.join(output_folder, "groups.jsonl")
+        csv_path = os.path.join(output_folder, "groups.csv")
+        # When the groups are written to a JSON lines sink and not kept
+        with open_sink(jsonl_path) as sink:
+            result = Matcher.find_similar(folder, quiet=True, sink=sink, keep_result=False)
+        self.assertEqual(result, dict())
+        # Then every group is written with its distances and the byte-identical files
+        with open(jsonl_path) as hand:
+            records = [json.loads(line) for line in hand]
+        self.assertEqual([record['group'] for record in records], [1, 2])
+        cats, = [record for record in records if len(record['members']) == 2]
+        exact = {os.path.basename(path): flag for path, flag in zip(cats['members'], cats['exact'])}
+        self.assertEqual(os.path.basename(cats['anchor']), "cat_duplicate1.jpg")
+        self.assertEqual(exact, {"cat_best.png": False, "cat_duplicate2.jpg": True})
+        self.assertEqual(len(cats['distances']), 3)
+        # When the groups are written to a CSV sink
+        with open_sink(csv_path) as sink:
+            Matcher.find_similar(folder, quiet=True, sink=sink)
+        # Then there is a row for each duplicate
+        with open(csv_path, newline="") as hand:
+            rows = list(csv.DictReader(hand))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(sorted(row['group'] for row in rows), ["1", "2", "2"])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from ..dupimage import Matcher
+from ..dupimage.Metrics import Metrics
+from ..dupimage.Metrics import MetricsFile
+from ..dupimage.Metrics import Progress
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+
+class MetricsAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+        Structure is
+            data/
+            hashes.sqlite
+            metrics.jsonl
+            metrics.prom
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_metrics")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        self.db_path = os.path.join(self._test_main_folder, "hashes.sqlite")
+        self.jsonl_path = os.path.join(self._test_main_folder, "metrics.jsonl")
+        self.prometheus_path = os.path.join(self._test_main_folder, "metrics.prom")
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def testRunIsMeasured(self):
+        # Given a broken image in the folder
+        with open(os.path.join(self.test_folder, "broken.png"), "wb") as hand:
+            hand.write(b"not an image")
+        # When the duplicates are found
+        metrics = Metrics([MetricsFile(self.jsonl_path)], interval=0)
+        Matcher.find_similar(self.test_folder, db_path=self.db_path, quiet=True, metrics=metrics)
+        # Then the pipeline is counted
+        self.assertEqual(metrics.counters['files_scanned'], 7)
+        self.assertEqual(metrics.counters['cache_misses'], 7)
+        self.assertEqual(metrics.counters['hashes_computed'], 6)
+        self.assertEqual(metrics.counters['decode_failures'], 1)
+        self.assertEqual(metrics.counters['groups'], 2)
+        self.assertTrue(metrics.counters['bytes_read'] > 0)
+        # And every stage is timed
+        self.assertEqual(sorted(metrics.stages), ["grouping", "hash", "index", "neighbours"])
+        # And the snapshots are dumped as JSON lines
+        with open(self.jsonl_path) as hand:
+            snapshots = [json.loads(line) for line in hand]
+        self.assertEqual(snapshots[-1]['counters'], metrics.counters)
+        # When the run is repeated
+        metrics = Metrics([MetricsFile(self.prometheus_path)])
+        Matcher.find_similar(self.test_folder, db_path=self.db_path, quiet=True, metrics=metrics)
+        # Then the hashes are read from the cache
+        self.assertEqual(metrics.counters['cache_hits'], 6)
+        self.assertFalse('hashes_computed' in metrics.counters)
+        # And the metrics are written in the Prometheus text format
+        with open(self.prometheus_path) as hand:
+            lines = hand.read().splitlines()
+        self.assertTrue("dupimage_cache_hits_total 6" in lines)
+        self.assertTrue("dupimage_neighbours_count 3" in lines)
+
+    def testProgressIsWrittenToItsFile(self):
+        # Given a progress reporter writing to its own file, e.g. stderr when the groups go to stdout
+        hand = io.StringIO()
+        metrics = Metrics([Progress(hand)], interval=0)
+        # When the duplicates are found
+        Matcher.find_similar(self.test_folder, db_path=self.db_path, quiet=True, metrics=metrics)
+        # Then the progress of every stage is written to that file
+        lines = hand.getvalue().splitlines()
+        self.assertTrue(len(lines) > 0)
+        self.assertTrue(all(line.startswith("# ") for line in lines))
+        self.assertTrue(any(line.startswith("# hash: 6/6 files") for line in lines))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+
+from ..dupimage import Matcher
+from ..dupimage import Mover
+from ..dupimage.Common import read_info_file
+from ..dupimage.HashCache import ImageMetadata
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+
+class MoverAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+
+        Structure:
+            data/
+            duplicates/
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_mover")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        self.duplicates_folder = os.path.join(self._test_main_folder, "duplicates")
+        os.mkdir(self.duplicates_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def _path(self, name):
+        return os.path.join(self.test_folder, name)
+
+    def testInterruptedMovesAreResumed(self):
+        # Given a plan with two groups
+        cats = [self._path("cats/cat_best.png"), self._path("cat_duplicate1.jpg"), self._path("cats/cat_duplicate2.jpg")]
+        houses = [self._path("house_best.png"), self._path("misc/house_duplicate.jpg")]
+        plan = [Mover.plan_group(1, self.duplicates_folder, cats[0], cats),
+                Mover.plan_group(2, self.duplicates_folder, houses[0], houses)]
+        # When the run is interrupted after a file of the first group is moved
+        journal_path = os.path.join(self.duplicates_folder, Mover.JOURNAL_FILE_NAME)
+        with open(journal_path, "w") as hand:
+            hand.write(json.dumps({'plan': [move._asdict() for move in plan]}) + "\n")
+            hand.write('{"do')
+        os.makedirs(plan[0].folder)
+        os.rename(cats[1], os.path.join(plan[0].folder, "1_cat_duplicate1.jpg"))
+        # Then the next run completes all the moves
+        self.assertEqual(Mover.resume_moves(self.duplicates_folder), 2)
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertTrue(os.path.exists(cats[0]))
+        self.assertFalse(os.path.exists(cats[2]) or os.path.exists(houses[1]))
+        basefile, duplicates = read_info_file(plan[0].folder)
+        self.assertEqual(basefile, cats[0])
+        self.assertArrayEquals(duplicates, [("1_cat_duplicate1.jpg", cats[1]), ("2_cat_duplicate2.jpg", cats[2])])
+        self.assertDuplicates(self.duplicates_folder, "house_best.png", "house_duplicate.jpg")
+        # And there is nothing left to resume
+        self.assertEqual(Mover.resume_moves(self.duplicates_folder), 0)
+
+    def testKeptImagesAreNotMovedByOtherGroups(self):
+        # Given overlapping groups where the image kept by the first group is a duplicate in the second one
+        cat_best, cat_duplicate = self._path("cats/cat_best.png"), self._path("cat_duplicate1.jpg")
+        house_best, house_duplicate = self._path("house_best.png"), self._path("misc/house_duplicate.jpg")
+        pixels = {house_best: 4, cat_best: 3, house_duplicate: 2, cat_duplicate: 1}
+        metadata = {path: ImageMetadata(width, 1, "PNG", os.path.getsize(path), None) for path, width in pixels.items()}
+        groups = [(cat_duplicate, [cat_best]), (house_best, [cat_best, house_duplicate])]
+        # When the moves are planned
+        plan = Matcher._plan_moves(self.duplicates_folder, groups, metadata)
+        # Then the kept image is not moved by the other group
+        self.assertEqual([(move.best, move.duplicates) for move in plan],
+                         [(cat_best, [(1, cat_duplicate)]), (house_best, [(1, house_duplicate)])])
+        # And the groups can be moved in parallel
+        Mover.apply_plan(self.duplicates_folder, plan, metadata)
+        self.assertTrue(os.path.exists(cat_best))
+        self.assertFalse(os.path.exists(cat_duplicate) or os.path.exists(house_duplicate))
+
+    def testNextGroupIdFollowsTheLargestId(self):
+        # Given group folders with a gap, the info and journal files of the duplicates folder
+        for name in ("1_cat.png", "4_house.png", "notes"):
+            os.mkdir(os.path.join(self.duplicates_folder, name))
+        for name in ("info.json", Mover.JOURNAL_FILE_NAME):
+            open(os.path.join(self.duplicates_folder, name), "w").close()
+        # Then the next group follows the largest id
+        self.assertEqual(Mover.next_group_id(self.duplicates_folder), 5)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+from ..dupimage import Ranking
+from ..dupimage.HashCache import ImageMetadata
+
+from .common import Common
+
+
+class RankingAT(Common):
+
+    def setUp(self):
+        # Metadata read while hashing, the files are never opened
+        self.metadata = {
+            "/big.jpg": ImageMetadata(200, 100, "JPEG", 3000, None, 24, True, 3),
+            "/big.png": ImageMetadata(100, 200, "PNG", 9000, None, 24, False, 2),
+            "/small.png": ImageMetadata(50, 50, "PNG", 1000, None, 8, False, 1),
+            "/old.webp": ImageMetadata(200, 100, "WEBP", 2000, None, None, None, 0),
+        }
+
+    def testDefaultRanking(self):
+        # Given groups of duplicates
+        groups = [["/small.png", "/big.jpg", "/big.png"], ["/old.webp", "/big.jpg"], ["/small.png", "/old.webp"]]
+        # When the best images are picked with the default ranking
+        best = Ranking.best_images(groups, self.metadata)
+        # Then the largest image is kept, and the lossless format on a tie
+        self.assertEqual(best, ["/big.png", "/big.jpg", "/old.webp"])
+
+    def testConfigurableRanking(self):
+        paths = list(self.metadata)
+        # When the images are ranked by EXIF presence, then by file size
+        ranks = Ranking.rank_images(paths, self.metadata, Ranking.parse_ranking("exif,size"))
+        # Then the unknown values rank last
+        self.assertEqual(sorted(paths, key=ranks.get), ["/big.jpg", "/big.png", "/small.png", "/old.webp"])
+        # When the oldest file is preferred
+        ranks = Ranking.rank_images(paths, self.metadata, Ranking.parse_ranking("-mtime"))
+        self.assertEqual(sorted(paths, key=ranks.get), ["/old.webp", "/small.png", "/big.png", "/big.jpg"])
+        # And an unknown key is rejected
+        self.assertRaises(ValueError, Ranking.parse_ranking, "pixels,colour")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import shutil
+import tempfile
+import threading
+
+from ..dupimage import Scanner
+from ..dupimage.Common import PERSISTENCE_FOLDER_NAME
+from ..dupimage.Common import iter_prefetch
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+
+class ScannerAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+
+        Structure:
+            data/
+                (recursive test data)
+                notes.txt
+                renamed.txt (a png image)
+                .duplicate-image-finder/hashes.sqlite
+                duplicates/1_cat.png/1_cat.png
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_scanner")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        with open(os.path.join(self.test_folder, "notes.txt"), "w") as hand:
+            hand.write("not an image")
+        shutil.copy(os.path.join(self.test_folder, "house_best.png"), os.path.join(self.test_folder, "renamed.txt"))
+        persistence_folder = os.path.join(self.test_folder, PERSISTENCE_FOLDER_NAME)
+        os.mkdir(persistence_folder)
+        open(os.path.join(persistence_folder, "hashes.sqlite"), "w").close()
+        self.duplicates_folder = os.path.join(self.test_folder, "duplicates")
+        os.makedirs(os.path.join(self.duplicates_folder, "1_cat.png"))
+        shutil.copy(os.path.join(self.test_folder, "house_best.png"),
+                    os.path.join(self.duplicates_folder, "1_cat.png", "1_cat.png"))
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def _scan(self, **kwargs):
+        entries = list(Scanner.scan(self.test_folder, exclude_paths=(self.duplicates_folder,), **kwargs))
+        for path, stat in entries:
+            self.assertEqual(os.stat(path).st_ino, stat.st_ino)
+        return [os.path.relpath(path, self.test_folder) for path, _ in entries]
+
+    def testScanPrunesExcludedFolders(self):
+        paths = self._scan()
+        self.assertArrayEquals(paths, ["cat_duplicate1.jpg", "cats/cat_best.png", "cats/cat_duplicate2.jpg",
+                                       "house_best.png", "misc/house_duplicate.jpg", "misc/tree.jpg",
+                                       "notes.txt", "renamed.txt"])
+
+    def testScanFiltersFiles(self):
+        # The extension filter skips the image with the wrong extension
+        paths = self._scan(file_filter=Scanner.FILTER_EXTENSION)
+        self.assertEqual(len(paths), 6)
+        self.assertFalse("notes.txt" in paths or "renamed.txt" in paths)
+        # The magic filter reads the content
+        paths = self._scan(file_filter=Scanner.FILTER_MAGIC)
+        self.assertEqual(len(paths), 7)
+        self.assertTrue("renamed.txt" in paths)
+        self.assertFalse("notes.txt" in paths)
+
+    def testScanFolderOnly(self):
+        paths = self._scan(recursive=False)
+        self.assertArrayEquals(paths, ["cat_duplicate1.jpg", "house_best.png", "notes.txt", "renamed.txt"])
+
+    def testPrefetchStopsWhenClosedEarly(self):
+        # Given a scan read ahead by a background thread that fills its queue
+        threads = threading.active_count()
+        entries = Scanner.scan(self.test_folder)
+        prefetched = iter_prefetch(entries, 1)
+        next(prefetched)
+        # When the consumer stops early
+        prefetched.close()
+        # Then the thread ends and the scan is closed
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(inspect.getgeneratorstate(entries), inspect.GEN_CLOSED)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from ..dupimage import Search
+
+from .common import Common
+
+
+class SearchAT(Common):
+
+    def setUp(self):
+        # Random 64 bit hashes with a few near duplicates
+        random = np.random.default_rng(0)
+        bits = random.random((3000, 64)) < 0.5
+        bits[7] = bits[5]
+        bits[11] = bits[10]
+        bits[11, :4] = ~bits[11, :4]
+        bits[21] = bits[20]
+        bits[21, :10] = ~bits[21, :10]
+        self.bits = bits
+        self.packed = Search.pack_hashes(bits)
+
+    def _pairs(self, index, max_distance):
+        pairs = set()
+        for rows, cols, distances in index.iter_pairs(max_distance):
+            pairs.update(zip(rows.tolist(), cols.tolist(), distances.tolist()))
+        return pairs
+
+    def testPackingRoundTrip(self):
+        self.assertTrue((Search.unpack_hashes(self.packed, 64) == self.bits).all())
+        hash_strs = [Search.packed_to_hex(row, 64) for row in self.packed]
+        self.assertTrue((Search.hex_to_packed(hash_strs, 64) == self.packed).all())
+
+    def testIndexesFindTheSamePairs(self):
+        # Given the same hashes indexed by every backend
+        for backend in Search.INDEXES:
+            index = Search.build_index(self.packed, 64, backend=backend)
+            # Then only the near duplicates are found
+            self.assertEqual(self._pairs(index, 6), {(5, 7, 0), (10, 11, 4)})
+            matches = index.query_radius(self.packed[[5, 10, 20]], 6)
+            self.assertArrayEquals(matches[0].tolist(), [5, 7])
+            self.assertArrayEquals(matches[1].tolist(), [10, 11])
+            self.assertArrayEquals(matches[2].tolist(), [20])
+
+    def testMultiIndexHashingIsIncremental(self):
+        # Given an index built from a part of the hashes
+        index = Search.MultiIndexHashIndex(self.packed[:1000], 64)
+        # When the other hashes are added in batches
+        for start in range(1000, len(self.packed), 700):
+            index.add(self.packed[start:start + 700])
+        # Then the results are the same of an index built at once
+        expected = Search.PopcountIndex(self.packed, 64).query_radius(self.packed, 6)
+        actual = index.query_radius(self.packed, 6)
+        for expected_matches, actual_matches in zip(expected, actual):
+            self.assertEqual(sorted(expected_matches.tolist()), sorted(actual_matches.tolist()))
+
+    def testMultiIndexHashingIsRepartitioned(self):
+        # Given an index of a few hashes
+        index = Search.MultiIndexHashIndex(self.packed[:100], 64)
+        self.assertEqual(len(index.substrings), 4)
+        # When it grows past 2^16 hashes
+        grown = np.concatenate([self.packed, Search.pack_hashes(np.random.default_rng(1).random((70000, 64)) < 0.5)])
+        for start in range(100, len(grown), 3000):
+            index.add(grown[start:start + 3000])
+            # Then the buffer searched by brute force stays small
+            self.assertLess(index.size - index.merged, Search.MIH_MERGE_SIZE)
+        # And the substrings are longer
+        self.assertEqual(len(index.substrings), 3)
+        expected = Search.PopcountIndex(grown, 64).query_radius(self.packed, 6)
+        actual = index.query_radius(self.packed, 6)
+        for expected_matches, actual_matches in zip(expected, actual):
+            self.assertEqual(sorted(expected_matches.tolist()), sorted(actual_matches.tolist()))
+
+    def testRadiusGraph(self):
+        # When all the pairs are found with a single query
+        graph = Search.radius_graph(Search.build_index(self.packed, 64), 6)
+        # Then the graph is symmetric and keeps the distances, even when 0
+        self.assertEqual(graph.shape, (3000, 3000))
+        self.assertEqual(graph.nnz, 4)
+        self.assertEqual(graph.indices[graph.indptr[7]], 5)
+        self.assertEqual(graph[10, 11], 4)
+        self.assertEqual(graph[11, 10], 4)
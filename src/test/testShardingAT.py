@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+
+from ..dupimage import Matcher
+from ..dupimage import Scanner
+from ..dupimage import Sharding
+from ..dupimage import Store
+from ..dupimage.HashCache import HASH_ALGORITHM
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+from .common import to_relpath
+
+
+class ShardingAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+        Structure is
+            data/
+            data/.duplicate-image-finder/
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_sharding")
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        self.persistence_folder = os.path.join(self.test_folder, ".duplicate-image-finder")
+        os.mkdir(self.persistence_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self._test_main_folder)
+
+    def assertShardsCoverTheFolder(self, strategy, n_shards):
+        paths = []
+        for shard in range(n_shards):
+            shard_path, n_images = Sharding.hash_shard(self.test_folder, self.persistence_folder, shard, n_shards,
+                                                       strategy=strategy, backend=Store.BACKEND_SQLITE)
+            with Store.open_hash_store(shard_path, flag='r') as store:
+                shard_paths = [path for path, _ in store.iter_entries()]
+            self.assertEqual(len(shard_paths), n_images)
+            paths.extend(shard_paths)
+        # Every image is hashed by exactly one shard
+        self.assertArrayEquals(paths, [entry.path for entry in Scanner.scan(self.test_folder)])
+
+    def testShardsByPath(self):
+        self.assertShardsCoverTheFolder(Sharding.SHARD_BY_PATH, 3)
+
+    def testShardsBySubtree(self):
+        self.assertShardsCoverTheFolder(Sharding.SHARD_BY_SUBTREE, 2)
+        # The files of a subtree are in the same shard
+        shard = Sharding.shard_of("cats", 2)
+        with Store.open_hash_store(Sharding.shard_store_path(self.persistence_folder, shard, 2,
+                                                             Store.BACKEND_SQLITE), flag='r') as store:
+            self.assertTrue(store.get_entry(os.path.join(self.test_folder, "cats", "cat_best.png"),
+                                            HASH_ALGORITHM) is not None)
+            self.assertTrue(store.get_entry(os.path.join(self.test_folder, "cats", "cat_duplicate2.jpg"),
+                                            HASH_ALGORITHM) is not None)
+
+    def testMergedShardsAreMatchedGlobally(self):
+        # Given a folder hashed in shards
+        for shard in range(3):
+            Sharding.hash_shard(self.test_folder, self.persistence_folder, shard, 3, backend=Store.BACKEND_SQLITE)
+        # When the shard stores are merged
+        shard_paths = Sharding.find_shard_stores(self.persistence_folder, Store.BACKEND_SQLITE)
+        self.assertEqual(len(shard_paths), 3)
+        db_path = Store.prepare_hash_store(self.persistence_folder, Store.BACKEND_SQLITE)
+        self.assertEqual(Sharding.merge_stores(shard_paths, db_path), 6)
+        # Then the duplicates are found across the shards
+        result = Matcher.find_similar(self.test_folder, db_path=db_path, db_backend=Store.BACKEND_SQLITE,
+                                      quiet=True)
+        result = to_relpath(result, folder=self.test_folder)
+        self.assertEqual(len(result), 2)
+
+    def testStaleShardStoresAreNotMerged(self):
+        # Given the stores of a run with 2 shards, left next to a run with 3 shards
+        for shard in range(2):
+            Sharding.hash_shard(self.test_folder, self.persistence_folder, shard, 2, backend=Store.BACKEND_SQLITE)
+        for shard in range(3):
+            Sharding.hash_shard(self.test_folder, self.persistence_folder, shard, 3, backend=Store.BACKEND_SQLITE)
+        # Then only the stores of the given number of shards are found
+        shard_paths = Sharding.find_shard_stores(self.persistence_folder, Store.BACKEND_SQLITE, n_shards=3)
+        self.assertEqual(shard_paths, [Sharding.shard_store_path(self.persistence_folder, shard, 3,
+                                                                 Store.BACKEND_SQLITE) for shard in range(3)])
+        # And the mixed set is rejected without a number of shards
+        with self.assertRaises(ValueError):
+            Sharding.find_shard_stores(self.persistence_folder, Store.BACKEND_SQLITE)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from PIL import Image
+
+from ..dupimage import Store
+from ..dupimage import Watcher
+from ..dupimage.Common import compute_sha256
+from ..dupimage.HashCache import content_id
+from ..dupimage.Hashing import algorithm_tag
+from ..dupimage.Hashing import hash_image
+from ..dupimage.Scanner import ScanEntry
+
+from .common import Common
+from .common import AT_DATA_FOLDER
+
+# Seconds to wait for the daemon to notice a change
+TIMEOUT = 20
+
+
+class WatcherAT(Common):
+
+    def setUp(self):
+        """
+        Set the folders for the test.
+        Structure is
+            data/
+            duplicates/
+            index.npz
+            query.sock
+        """
+        self._test_main_folder = tempfile.mkdtemp(suffix="dif_watcher")
+        # Removed after the daemon is stopped
+        self.addCleanup(shutil.rmtree, self._test_main_folder)
+        self.test_folder = os.path.join(self._test_main_folder, "data")
+        shutil.copytree(os.path.join(AT_DATA_FOLDER, "recursive"), self.test_folder)
+        self.duplicates_folder = os.path.join(self._test_main_folder, "duplicates")
+        self.index_path = os.path.join(self._test_main_folder, "index.npz")
+        self.socket_path = os.path.join(self._test_main_folder, "query.sock")
+
+    def startDaemon(self, **kwargs):
+        daemon = Watcher.DuplicateDaemon(self.test_folder, None, self.index_path, watcher=Watcher.WATCHER_POLLING,
+                                         poll_interval=0.1, settle_time=0.1, quiet=True, **kwargs)
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(daemon.stop)
+        self.assertTrue(daemon.ready.wait(TIMEOUT))
+        return daemon
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timeout")
+            time.sleep(0.05)
+
+    def testQuerySocket(self):
+        # Given a daemon watching a folder
+        self.startDaemon(socket_path=self.socket_path)
+        house = os.path.join(self.test_folder, "house_best.png")
+        # When another tool asks for the duplicates of an image
+        response = Watcher.query_socket(self.socket_path, path=house)
+        # Then the indexed duplicates are returned
+        self.assertEqual([duplicate['path'] for duplicate in response['duplicates']],
+                         [os.path.join(self.test_folder, "misc", "house_duplicate.jpg")])
+        # And the errors are reported
+        self.assertTrue('error' in Watcher.query_socket(self.socket_path, path=self._test_main_folder))
+
+    def testDuplicatesAreMovedOnArrival(self):
+        # Given a daemon watching a folder
+        self.startDaemon(duplicates_folder=self.duplicates_folder, socket_path=self.socket_path)
+        # When a copy of an image arrives
+        copy_path = os.path.join(self.test_folder, "misc", "house_copy.png")
+        shutil.copy(os.path.join(self.test_folder, "house_best.png"), copy_path + ".tmp")
+        os.rename(copy_path + ".tmp", copy_path)
+        # Then its group is moved to the duplicates folder
+        house = os.path.join(self.test_folder, "house_best.png")
+        self.waitFor(lambda: not os.path.exists(copy_path) or not os.path.exists(house))
+        self.assertFalse(os.path.exists(os.path.join(self.test_folder, "misc", "house_duplicate.jpg")))
+        # And the moved files are removed from the index
+        best = house if os.path.exists(house) else copy_path
+        self.assertEqual(Watcher.query_socket(self.socket_path, path=best)['duplicates'], [])
+
+    def testContentFalsePositivesAreNotReported(self):
+        # Given two images restored as false positives, stored by content only
+        house = os.path.join(self.test_folder, "house_best.png")
+        duplicate = os.path.join(self.test_folder, "misc", "house_duplicate.jpg")
+        content_ids = []
+        for path in (house, duplicate):
+            with Image.open(path) as image:
+                content_ids.append(content_id(algorithm_tag(), hash_image(image), compute_sha256(path)))
+        false_positives_db_path = os.path.join(self._test_main_folder, Store.FALSE_POSITIVES_FILE_NAME)
+        with Store.open_false_positives_store(false_positives_db_path) as store:
+            store.add_pairs([tuple(content_ids)])
+        daemon = Watcher.DuplicateDaemon(self.test_folder, None, self.index_path, watcher=Watcher.WATCHER_POLLING,
+                                         false_positives_db_path=false_positives_db_path, quiet=True)
+        daemon.start()
+        self.addCleanup(daemon.close)
+        # When one of them is renamed
+        renamed = os.path.join(self.test_folder, "house_renamed.jpg")
+        os.rename(duplicate, renamed)
+        daemon._remove([duplicate])
+        # Then it is not reported as a duplicate of the other one
+        self.assertEqual(daemon.process([ScanEntry(renamed, os.stat(renamed))]), dict())